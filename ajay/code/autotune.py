@@ -0,0 +1,165 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+import multiprocessing
+import os
+import socket
+import time
+
+import numpy as np
+from six.moves import xrange  # pylint: disable=redefined-builtin
+import tensorflow as tf
+
+from benchmark import model_flags, print_table
+from qa_model import build_model
+from train import FLAGS
+from util import tuned_model
+
+import logging
+
+logging.basicConfig(level=logging.INFO)
+
+tf.app.flags.DEFINE_integer("autotune_runs", 5, "Timed calls per trial (after 2 warmup calls).")
+tf.app.flags.DEFINE_string("autotune_parallel_iterations", "1,8,16,32,64", "Comma-separated parallel_iterations values tried.")
+tf.app.flags.DEFINE_string("autotune_batch_sizes", "16,32,64,100,200", "Comma-separated batch sizes tried.")
+tf.app.flags.DEFINE_integer("autotune_q_len", 30, "Question length of the trial batches.")
+
+
+def int_list(value):
+    return [int(v) for v in value.split(",") if v]
+
+
+def thread_configs(cpus):
+    """
+    (intra_op, inter_op) thread pool sizes tried: powers of two up to @cpus intra-op
+    threads, each with 1, 2 or 4 inter-op threads, after TF's defaults (0, 0).
+    """
+    intra = sorted(set([n for n in [1, 2, 4, 8, 16, 32, 64] if n < cpus] + [cpus]))
+    inter = sorted(set(min(n, cpus) for n in [1, 2, 4]))
+    return [(0, 0)] + [(a, b) for a in intra for b in inter]
+
+
+def session_config(intra_op_threads, inter_op_threads):
+    # per-session pools, the process-wide ones are sized once by the first session
+    return tf.ConfigProto(intra_op_parallelism_threads=intra_op_threads,
+                          inter_op_parallelism_threads=inter_op_threads,
+                          use_per_session_threads=True)
+
+
+def time_call(fn, runs=None, warmup=2):
+    """
+    Returns the mean wall time in seconds of @fn().
+    """
+    runs = runs or FLAGS.autotune_runs
+    for _ in xrange(warmup):
+        fn()
+    tic = time.time()
+    for _ in xrange(runs):
+        fn()
+    return (time.time() - tic) / runs
+
+
+class Trials(object):
+    """
+    Times QASystem.optimize and QASystem.decode on random batches of ctx_len long
+    paragraphs, for models of the FLAGS architecture built with a given parallel_iterations
+    and run in sessions with given thread pools.
+    """
+    def __init__(self, ctx_len, q_len):
+        self.ctx_len = ctx_len
+        self.q_len = q_len
+        self.embeddings = np.random.randn(1000, FLAGS.embedding_size).astype(np.float32)
+
+    def batch(self, batch_size):
+        vocab_size = self.embeddings.shape[0]
+        return (np.random.randint(vocab_size, size=(batch_size, self.ctx_len)),
+                np.random.randint(vocab_size, size=(batch_size, self.q_len)),
+                np.sort(np.random.randint(self.ctx_len, size=(batch_size, 2)), axis=1),
+                np.full(batch_size, self.ctx_len, dtype=np.int32),
+                np.full(batch_size, self.q_len, dtype=np.int32))
+
+    def run(self, parallel_iterations, configs, batch_sizes, mode):
+        """
+        :param configs: list of (intra_op, inter_op) thread pool sizes
+        :param mode: "train" times optimize, "decode" times decode
+        :return: list of (intra_op, inter_op, batch size, secs per call), for every config
+                 and batch size
+        """
+        results = []
+        with tf.Graph().as_default() as graph:
+            qa = build_model(model_flags(parallel_iterations=parallel_iterations), self.embeddings, self.ctx_len,
+                             self.q_len, training=mode == "train")
+            init = tf.global_variables_initializer()
+            for intra_op_threads, inter_op_threads in configs:
+                with tf.Session(graph=graph, config=session_config(intra_op_threads, inter_op_threads)) as sess:
+                    sess.run(init, qa.initializer_feed())
+                    for batch_size in batch_sizes:
+                        batch = self.batch(batch_size)
+                        step = qa.optimize if mode == "train" else qa.decode
+                        secs = time_call(lambda: step(sess, *batch))
+                        results.append((intra_op_threads, inter_op_threads, batch_size, secs))
+        return results
+
+
+def tune(trials, mode, batch_size, batch_sizes, cpus):
+    """
+    Tunes the @mode settings one after the other, each with the best values found so far:
+    parallel_iterations with TF's default thread pools, then the thread pool sizes and,
+    for decode, the batch size with the highest examples/s.
+    :return: (tuned settings, table rows)
+    """
+    rows = []
+    times = {}
+    for p in int_list(FLAGS.autotune_parallel_iterations):
+        times[p] = trials.run(p, [(0, 0)], [batch_size], mode)[0][3]
+        rows.append([mode, "parallel_iterations %d" % p, 1000 * times[p], batch_size / times[p]])
+    parallel_iterations = min(times, key=times.get)
+
+    results = trials.run(parallel_iterations, thread_configs(cpus), [batch_size], mode)
+    for intra_op_threads, inter_op_threads, _, secs in results:
+        rows.append([mode, "threads %d intra, %d inter" % (intra_op_threads, inter_op_threads), 1000 * secs,
+                     batch_size / secs])
+    intra_op_threads, inter_op_threads, _, _ = min(results, key=lambda r: r[3])
+
+    tuned = {"parallel_iterations": parallel_iterations, "intra_op_threads": intra_op_threads,
+             "inter_op_threads": inter_op_threads}
+    results = trials.run(parallel_iterations, [(intra_op_threads, inter_op_threads)], batch_sizes, mode)
+    for _, _, size, secs in results:
+        rows.append([mode, "batch_size %d" % size, 1000 * secs, size / secs])
+    if mode == "decode":
+        tuned["batch_size"] = max(results, key=lambda r: r[2] / r[3])[2]
+    return tuned, rows
+
+
+def main(_):
+    cpus = multiprocessing.cpu_count()
+    ctx_len = FLAGS.window_size or FLAGS.output_size
+    trials = Trials(ctx_len, FLAGS.autotune_q_len)
+    batch_sizes = int_list(FLAGS.autotune_batch_sizes)
+
+    tic = time.time()
+    train, train_rows = tune(trials, "train", FLAGS.batch_size, batch_sizes, cpus)
+    decode, decode_rows = tune(trials, "decode", FLAGS.batch_size, batch_sizes, cpus)
+    logging.info("Tuned in %.1f secs", time.time() - tic)
+
+    print_table("Autotune on %s (%d cpus), model_type %s, state_size %d, %d context tokens, %d question tokens" % (
+        socket.gethostname(), cpus, FLAGS.model_type, FLAGS.state_size, ctx_len, FLAGS.autotune_q_len),
+        ["mode", "trial", "ms/call", "examples/s"], train_rows + decode_rows)
+
+    tuned = {}
+    if os.path.exists(FLAGS.autotune_path):
+        with open(FLAGS.autotune_path) as f:
+            tuned = json.load(f)
+    # train.py and qa_answer.py only use the settings for the same model
+    tuned[socket.gethostname()] = {"train": train, "decode": decode, "model": tuned_model(FLAGS)}
+    with open(FLAGS.autotune_path, 'w') as fout:
+        json.dump(tuned, fout, indent=2, sort_keys=True)
+    logging.info("Wrote the settings of %s to %s: train %s, decode %s", socket.gethostname(), FLAGS.autotune_path,
+                 train, decode)
+    logging.info("The training batch_size is not changed, as it also changes the optimization")
+
+
+if __name__ == "__main__":
+    tf.app.run()
@@ -0,0 +1,499 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import itertools
+import multiprocessing
+import os
+import resource
+import shutil
+import tempfile
+import time
+from os.path import join as pjoin
+
+import numpy as np
+from six.moves import xrange  # pylint: disable=redefined-builtin
+import tensorflow as tf
+
+from qa_model import Encoder, build_model
+from train import FLAGS, get_normalized_train_dir, initialize_data, initialize_embeddings, initialize_model
+from util import load_model_flags, minibatches, pad_sequences
+
+import logging
+
+logging.basicConfig(level=logging.INFO)
+
+tf.app.flags.DEFINE_string("bench", "attention", "Which benchmark to run: attention, encoders, decoders, rnn_backends, shared_encoder, checkpoint, embeddings, distill, towers, memory")
+tf.app.flags.DEFINE_integer("bench_batch_size", 32, "Batch size used by the benchmarks.")
+tf.app.flags.DEFINE_integer("bench_q_len", 30, "Question length used by the benchmarks.")
+tf.app.flags.DEFINE_integer("bench_runs", 10, "Timed runs per measurement (after 2 warmup runs).")
+tf.app.flags.DEFINE_string("bench_model_types", "gru,flow,conv", "Comma-separated model types compared by the encoders benchmark.")
+tf.app.flags.DEFINE_integer("bench_train_steps", 0, "Train every model type for this many steps on data_dir and report val F1 / EM, 0 only measures step time.")
+tf.app.flags.DEFINE_integer("bench_eval_sample", 1000, "Number of val examples the F1 / EM comparison is computed on.")
+
+
+def time_run(sess, fetches, feed_dict, runs=None, warmup=2):
+    """
+    Returns the mean wall time in seconds of sess.run(@fetches, @feed_dict).
+    """
+    runs = runs or FLAGS.bench_runs
+    for _ in xrange(warmup):
+        sess.run(fetches, feed_dict)
+    tic = time.time()
+    for _ in xrange(runs):
+        sess.run(fetches, feed_dict)
+    return (time.time() - tic) / runs
+
+
+def print_table(title, header, rows):
+    print("")
+    print(title)
+    print(" | ".join("%-22s" % h for h in header))
+    for row in rows:
+        print(" | ".join("%-22s" % (("%.4f" % c) if isinstance(c, float) else c) for c in row))
+
+
+def bench_attention():
+    """
+    Per-step cost of the in-loop attention cells (GRUAttnCell, LSTMAttnCell,
+    MatchLSTMCell) against the Precomputed* cells, on output_size long contexts.
+    """
+    batch_size, ctx_len, q_len = FLAGS.bench_batch_size, FLAGS.output_size, FLAGS.bench_q_len
+    size, embed_size = FLAGS.state_size, FLAGS.embedding_size
+
+    ctx = tf.placeholder(tf.float32, shape=(None, None, embed_size))
+    ctx_lengths = tf.placeholder(tf.int32, shape=(None,))
+    question_states = tf.placeholder(tf.float32, shape=(None, None, size))
+    q_lengths = tf.placeholder(tf.int32, shape=(None,))
+
+    variants = []
+    for model_type in ["gru", "lstm", "match"]:
+        for precompute in [False, True]:
+            name = "%s_%s" % (model_type, "precomputed" if precompute else "in_loop")
+            with tf.variable_scope(name):
+                outputs, _ = Encoder(size, name="encoder").encode(ctx, ctx_lengths,
+                                                                   attention_inputs=question_states,
+                                                                   model_type=model_type,
+                                                                   bidir=False,
+                                                                   attention_lengths=q_lengths,
+                                                                   precompute_attention=precompute)
+            params = [v for v in tf.trainable_variables() if v.name.startswith(name + "/")]
+            grads = tf.gradients(tf.reduce_sum(outputs), params)
+            variants.append((name, outputs, grads))
+
+    feed = {ctx: np.random.randn(batch_size, ctx_len, embed_size),
+            ctx_lengths: np.full(batch_size, ctx_len, dtype=np.int32),
+            question_states: np.random.randn(batch_size, q_len, size),
+            q_lengths: np.random.randint(q_len // 2, q_len + 1, size=batch_size)}
+
+    rows = []
+    with tf.Session() as sess:
+        sess.run(tf.global_variables_initializer())
+        for name, outputs, grads in variants:
+            forward = time_run(sess, outputs, feed)
+            backward = time_run(sess, grads, feed)
+            rows.append((name, 1000 * forward / ctx_len, 1000 * backward / ctx_len))
+
+    print_table("Attention cells, batch %d, %d context steps, %d question slots" % (batch_size, ctx_len, q_len),
+                ["cell", "forward ms/step", "fwd+bwd ms/step"], rows)
+
+
+def bench_shared_encoder():
+    """
+    Separate question and paragraph encoder calls against one weight-shared call over
+    both, for the model_type encoders (flow or conv).
+    """
+    compare_models("Encoder sharing with model_type %s" % FLAGS.model_type, "encoders",
+                   [("separate", {"share_encoder": 0}), ("shared", {"share_encoder": 1})])
+
+
+def bench_rnn_backends():
+    """
+    Per-timestep cost of the attention-free GRU and LSTM encoders for every rnn_backend,
+    on output_size long sequences. The fused backend is fed time-major.
+    """
+    batch_size, seq_len = FLAGS.bench_batch_size, FLAGS.output_size
+    size, embed_size = FLAGS.state_size, FLAGS.embedding_size
+
+    inputs = tf.placeholder(tf.float32, shape=(None, None, embed_size))
+    lengths = tf.placeholder(tf.int32, shape=(None,))
+    inputs_time_major = tf.transpose(inputs, [1, 0, 2])
+
+    variants = []
+    for model_type in ["gru", "lstm"]:
+        for backend in ["basic", "block", "fused"]:
+            name = "%s_%s" % (model_type, backend)
+            time_major = backend == "fused"
+            encoder = Encoder(size, name=name, rnn_backend=backend, parallel_iterations=FLAGS.parallel_iterations,
+                              swap_memory=bool(FLAGS.swap_memory))
+            outputs, _ = encoder.encode(inputs_time_major if time_major else inputs, lengths,
+                                        model_type=model_type, bidir=False, time_major=time_major)
+            params = [v for v in tf.trainable_variables() if v.name.startswith(name + "/")]
+            grads = tf.gradients(tf.reduce_sum(outputs), params)
+            variants.append((name, outputs, grads))
+
+    feed = {inputs: np.random.randn(batch_size, seq_len, embed_size),
+            lengths: np.full(batch_size, seq_len, dtype=np.int32)}
+
+    rows = []
+    with tf.Session() as sess:
+        sess.run(tf.global_variables_initializer())
+        for name, outputs, grads in variants:
+            forward = time_run(sess, outputs, feed)
+            backward = time_run(sess, grads, feed)
+            rows.append((name, 1000 * forward / seq_len, 1000 * backward / seq_len))
+
+    print_table("RNN backends, batch %d, %d steps, parallel_iterations %d" % (batch_size, seq_len,
+                                                                             FLAGS.parallel_iterations),
+                ["encoder", "forward ms/step", "fwd+bwd ms/step"], rows)
+
+
+def model_flags(**overrides):
+    """
+    A copy of FLAGS with some values replaced, to build several model variants in one run.
+    """
+    values = dict(FLAGS.__flags)
+    values.update(overrides)
+    return argparse.Namespace(**values)
+
+
+def load_split(prefix, max_ctx_len):
+    """
+    Loads @prefix ("train" or "val") from FLAGS.data_dir in the padded layout QASystem.train
+    uses, contexts truncated to @max_ctx_len.
+    :return: (array of [context, question, span, context length, question length] rows, paragraph words)
+    """
+    context_ids = [ids[:max_ctx_len] for ids in initialize_data(pjoin(FLAGS.data_dir, prefix + ".ids.context"))]
+    question_ids = initialize_data(pjoin(FLAGS.data_dir, prefix + ".ids.question"))
+    answer_spans = initialize_data(pjoin(FLAGS.data_dir, prefix + ".span"))
+    context = initialize_data(pjoin(FLAGS.data_dir, prefix + ".context"), keep_as_string=True)
+
+    ctx, mask_ctx = pad_sequences(context_ids, max_ctx_len)
+    q, mask_q = pad_sequences(question_ids)
+    data = np.array([list(ctx), list(q), answer_spans, list(mask_ctx), list(mask_q)], dtype=object).T
+    return data, context
+
+
+def compare_models(title, label, variants):
+    """
+    Step time of full QASystem variants, forward only and for a full training step, on
+    batches of output_size long contexts. With bench_train_steps > 0 every variant is
+    also trained for that many steps on data_dir and its val F1 / EM is reported, so
+    throughput can be traded against accuracy at equal training budget.
+
+    :param variants: list of (name, dict of flag overrides)
+    """
+    batch_size, ctx_len, q_len = FLAGS.bench_batch_size, FLAGS.output_size, FLAGS.bench_q_len
+
+    if FLAGS.bench_train_steps > 0:
+        train_set, _ = load_split("train", ctx_len)
+        val_set, val_context = load_split("val", ctx_len)
+        embeddings = initialize_embeddings(FLAGS.embed_path or pjoin(FLAGS.data_dir, "glove.trimmed.{}.npz".format(
+            FLAGS.embedding_size)))
+        max_q_len = max(max(train_set[:, 4]), max(val_set[:, 4]))
+    else:
+        embeddings = np.random.randn(1000, FLAGS.embedding_size).astype(np.float32)
+        max_q_len = q_len
+
+    vocab_size = embeddings.shape[0]
+    ctx_batch = np.random.randint(vocab_size, size=(batch_size, ctx_len))
+    q_batch = np.random.randint(vocab_size, size=(batch_size, q_len))
+    spans = np.sort(np.random.randint(ctx_len, size=(batch_size, 2)), axis=1)
+
+    rows = []
+    for name, overrides in variants:
+        with tf.Graph().as_default():
+            qa = build_model(model_flags(**overrides), embeddings, ctx_len, max_q_len)
+            num_params = sum(np.prod(v.get_shape().as_list()) for v in tf.trainable_variables())
+            feed = {qa.context_placeholder: ctx_batch,
+                    qa.question_placeholder: q_batch,
+                    qa.answer_span_placeholder: spans,
+                    qa.mask_ctx_placeholder: np.full(batch_size, ctx_len, dtype=np.int32),
+                    qa.mask_q_placeholder: np.full(batch_size, q_len, dtype=np.int32),
+                    qa.dropout_placeholder: FLAGS.dropout}
+
+            with tf.Session() as sess:
+                sess.run(tf.global_variables_initializer(), qa.initializer_feed())
+                forward = time_run(sess, [qa.start_probs, qa.end_probs], feed)
+                step = time_run(sess, [qa.train_op, qa.loss], feed)
+                row = [name, int(num_params), 1000 * forward, 1000 * step, batch_size / forward]
+
+                if FLAGS.bench_train_steps > 0:
+                    batches = itertools.cycle(minibatches(train_set, FLAGS.batch_size))
+                    tic = time.time()
+                    for batch in itertools.islice(batches, FLAGS.bench_train_steps):
+                        qa.optimize(sess, *batch)
+                    train_time = time.time() - tic
+                    f1, em = qa.evaluate_answer(sess, val_set, val_context, sample=FLAGS.bench_eval_sample)
+                    row += [train_time, f1, em]
+            rows.append(row)
+
+    header = [label, "params", "forward ms/batch", "train ms/step", "forward examples/s"]
+    if FLAGS.bench_train_steps > 0:
+        header += ["%d steps secs" % FLAGS.bench_train_steps, "val F1", "val EM"]
+    print_table("%s, batch %d, %d context tokens, %d question tokens" % (title, batch_size, ctx_len, q_len),
+                header, rows)
+
+
+def bench_checkpoint():
+    """
+    Graph construction, GraphDef size and checkpoint save / restore cost with the embedding
+    matrix stored as a graph constant and checkpointed, and with feed_embeddings.
+    """
+    embed_path = FLAGS.embed_path or pjoin(FLAGS.data_dir, "glove.trimmed.{}.npz".format(FLAGS.embedding_size))
+    if tf.gfile.Exists(embed_path):
+        embeddings = initialize_embeddings(embed_path)
+    else:
+        embeddings = np.random.randn(100000, FLAGS.embedding_size).astype(np.float32)
+
+    rows = []
+    save_dir = tempfile.mkdtemp()
+    try:
+        for feed_embeddings in [0, 1]:
+            with tf.Graph().as_default() as graph:
+                tic = time.time()
+                qa = build_model(model_flags(feed_embeddings=feed_embeddings), embeddings, FLAGS.output_size,
+                                 FLAGS.bench_q_len)
+                build_time = time.time() - tic
+                graph_bytes = graph.as_graph_def().ByteSize()
+
+                with tf.Session() as sess:
+                    sess.run(tf.global_variables_initializer(), qa.initializer_feed())
+                    path = pjoin(save_dir, "feed%d" % feed_embeddings, "model")
+                    os.makedirs(os.path.dirname(path))
+                    tic = time.time()
+                    qa.saver.save(sess, path)
+                    save_time = time.time() - tic
+                    checkpoint_bytes = sum(os.path.getsize(pjoin(os.path.dirname(path), f))
+                                           for f in os.listdir(os.path.dirname(path)))
+                    tic = time.time()
+                    qa.saver.restore(sess, path)
+                    if qa.embedding_placeholder is not None:
+                        sess.run(qa.embeddings.initializer, qa.initializer_feed())
+                    restore_time = time.time() - tic
+
+            rows.append(("feed_embeddings=%d" % feed_embeddings, build_time, graph_bytes / 2. ** 20, save_time,
+                         checkpoint_bytes / 2. ** 20, restore_time))
+    finally:
+        shutil.rmtree(save_dir)
+
+    print_table("Embedding matrix of %d x %d" % embeddings.shape,
+                ["variant", "build secs", "GraphDef MB", "save secs", "checkpoint MB", "restore secs"], rows)
+
+
+def rss_mb():
+    """
+    Current resident set size of this process in MB (Linux only, 0 elsewhere).
+    """
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024.
+    except IOError:
+        pass
+    return 0.
+
+
+def bench_embeddings():
+    """
+    Load time and resident memory of the trimmed embedding matrix stored as the original
+    float64 compressed npz and as uncompressed float32 / float16 npy, memory-mapped by
+    initialize_embeddings. The float32 copy is what the graph is initialized from.
+    """
+    embed_path = FLAGS.embed_path or pjoin(FLAGS.data_dir, "glove.trimmed.{}.npz".format(FLAGS.embedding_size))
+    if tf.gfile.Exists(embed_path):
+        glove = np.asarray(initialize_embeddings(embed_path), dtype=np.float64)
+    else:
+        glove = np.random.randn(100000, FLAGS.embedding_size)
+
+    rows = []
+    save_dir = tempfile.mkdtemp()
+    try:
+        files = [("npz float64", pjoin(save_dir, "glove.npz")),
+                 ("npy float32", pjoin(save_dir, "glove32.npy")),
+                 ("npy float16", pjoin(save_dir, "glove16.npy"))]
+        np.savez_compressed(files[0][1], glove=glove)
+        np.save(files[1][1], glove.astype(np.float32))
+        np.save(files[2][1], glove.astype(np.float16))
+        shape = glove.shape
+        del glove
+
+        for name, path in files:
+            before = rss_mb()
+            tic = time.time()
+            embeddings = initialize_embeddings(path)
+            load_time = time.time() - tic
+            loaded = rss_mb()
+            tic = time.time()
+            # np.asarray would return a float32 memmap as is, without reading its pages
+            as_float32 = np.array(embeddings, dtype=np.float32)
+            copy_time = time.time() - tic
+            rows.append((name, os.path.getsize(path) / 2. ** 20, 1000 * load_time, loaded - before,
+                         1000 * copy_time, rss_mb() - before))
+            del embeddings, as_float32
+    finally:
+        shutil.rmtree(save_dir)
+
+    print_table("Embedding files, %d x %d" % shape,
+                ["format", "file MB", "load ms", "load RSS MB", "float32 copy ms", "total RSS MB"], rows)
+
+
+def bench_encoders():
+    """
+    The model types in bench_model_types, e.g. the recurrent gru model against the
+    convolutional one.
+    """
+    model_types = FLAGS.bench_model_types.split(",")
+    compare_models("Model types", "model_type", [(m, {"model_type": m}) for m in model_types])
+
+
+def bench_decoders():
+    """
+    The recurrent start/end decoder against the feed-forward pointer decoder, both on
+    top of the model_type encoders.
+    """
+    compare_models("Decoders with model_type %s" % FLAGS.model_type, "decoder_type",
+                   [(d, {"decoder_type": d}) for d in ["rnn", "pointer"]])
+
+
+def bench_towers():
+    """
+    Scaling of data-parallel training with 1, 2, 4 and 8 towers at the same global batch
+    size: forward and training step time, and examples/s.
+    """
+    compare_models("Data-parallel towers with model_type %s" % FLAGS.model_type, "num_towers",
+                   [(str(n), {"num_towers": n}) for n in [1, 2, 4, 8]])
+
+
+def bench_distill():
+    """
+    Parameters, val F1 / EM and answering time of the teacher in teacher_dir against the
+    student distilled from it in train_dir, each built with the flags.json of its directory
+    and evaluated on the same bench_eval_sample val examples.
+    """
+    val_set, val_context = load_split("val", FLAGS.output_size)
+    embeddings = initialize_embeddings(FLAGS.embed_path or pjoin(FLAGS.data_dir, "glove.trimmed.{}.npz".format(
+        FLAGS.embedding_size)))
+    max_q_len = max(val_set[:, 4])
+
+    rows = []
+    for name, train_dir in [("teacher", FLAGS.teacher_dir), ("student", FLAGS.train_dir)]:
+        flags = load_model_flags(train_dir, FLAGS.__flags)
+        with tf.Graph().as_default():
+            qa = build_model(flags, embeddings, FLAGS.output_size, max_q_len, training=False)
+            num_params = sum(np.prod(v.get_shape().as_list()) for v in tf.trainable_variables())
+            with tf.Session() as sess:
+                initialize_model(sess, qa, get_normalized_train_dir(train_dir))
+                qa.evaluate_answer(sess, val_set, val_context, sample=FLAGS.bench_batch_size)  # warmup
+                np.random.seed(0)
+                tic = time.time()
+                f1, em = qa.evaluate_answer(sess, val_set, val_context, sample=FLAGS.bench_eval_sample)
+                answer_time = time.time() - tic
+        rows.append((name, "%s state_size %d" % (flags.model_type, flags.state_size), int(num_params), f1, em,
+                     1000 * answer_time / FLAGS.bench_eval_sample))
+
+    print_table("Distillation, %d val examples" % FLAGS.bench_eval_sample,
+                ["model", "config", "params", "val F1", "val EM", "answer ms/example"], rows)
+
+
+def memory_trial(overrides, results):
+    """
+    Builds the model with the flag @overrides, runs bench_runs QASystem.optimize steps on a
+    random batch and puts (peak step MB, secs per step, final loss) on @results. Runs in its
+    own process, so the peak resident size is that of this setting alone.
+
+    Every setting starts from the same variable values and trains without dropout on the
+    same batch, so the final losses only differ where a setting changes the gradients.
+    """
+    batch_size, ctx_len, q_len = FLAGS.bench_batch_size, FLAGS.output_size, FLAGS.bench_q_len
+    np.random.seed(0)
+    embeddings = np.random.randn(1000, FLAGS.embedding_size).astype(np.float32)
+    batch = (np.random.randint(1000, size=(batch_size, ctx_len)), np.random.randint(1000, size=(batch_size, q_len)),
+             np.sort(np.random.randint(ctx_len, size=(batch_size, 2)), axis=1),
+             np.full(batch_size, ctx_len, dtype=np.int32), np.full(batch_size, q_len, dtype=np.int32))
+    overrides = dict(overrides, dropout=0.)
+    with tf.Graph().as_default():
+        qa = build_model(model_flags(**overrides), embeddings, ctx_len, q_len)
+        # by name, the settings build the variables in different orders
+        variables = sorted(tf.trainable_variables(), key=lambda v: v.op.name)
+        placeholders = [tf.placeholder(v.dtype.base_dtype, shape=v.get_shape()) for v in variables]
+        assign_op = tf.group(*[v.assign(p) for v, p in zip(variables, placeholders)])
+        with tf.Session() as sess:
+            sess.run(tf.global_variables_initializer(), qa.initializer_feed())
+            rng = np.random.RandomState(0)
+            sess.run(assign_op, dict((p, rng.uniform(-0.1, 0.1, size=p.get_shape().as_list()))
+                                     for p in placeholders))
+            before = rss_mb()
+            qa.optimize(sess, *batch)
+            tic = time.time()
+            for _ in xrange(FLAGS.bench_runs):
+                loss = qa.optimize(sess, *batch)
+            step = (time.time() - tic) / FLAGS.bench_runs
+    # ru_maxrss is in KB on Linux
+    results.put((resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024. - before, step, float(loss)))
+
+
+def bench_memory():
+    """
+    Peak memory of a training step against its time for the settings that bound the
+    activations kept for backprop over output_size long paragraphs: recompute_segments
+    (context encoder activations of one segment at a time, its forward pass runs twice),
+    swap_memory (moves the RNN loop activations from the GPU to host memory, so it only
+    helps on a GPU), parallel_iterations (fewer timesteps in flight) and accum_steps
+    (micro-batches). Every setting runs in a fresh process.
+
+    The final loss column checks that recompute_segments, swap_memory and
+    parallel_iterations leave the gradients unchanged: their rows should match the
+    baseline up to float rounding. accum_steps clips every micro-batch on its own, so
+    its losses may differ slightly.
+    """
+    variants = [("baseline", {}),
+                ("recompute_segments 4", {"recompute_segments": 4}),
+                ("recompute_segments 8", {"recompute_segments": 8}),
+                ("recompute_segments 16", {"recompute_segments": 16}),
+                ("swap_memory", {"swap_memory": 1}),
+                ("parallel_iterations 1", {"parallel_iterations": 1}),
+                ("parallel_iterations 8", {"parallel_iterations": 8}),
+                ("accum_steps 2", {"accum_steps": 2}),
+                ("accum_steps 4", {"accum_steps": 4}),
+                ("swap_memory, accum_steps 4", {"swap_memory": 1, "accum_steps": 4})]
+    rows = []
+    for name, overrides in variants:
+        results = multiprocessing.Queue()
+        trial = multiprocessing.Process(target=memory_trial, args=(overrides, results))
+        trial.start()
+        peak, step, loss = results.get()
+        trial.join()
+        rows.append([name, peak, 1000 * step, FLAGS.bench_batch_size / step, peak - rows[0][1] if rows else 0.,
+                     loss])
+
+    print_table("Training step memory with model_type %s, batch %d, %d context tokens, %d question tokens" % (
+        FLAGS.model_type, FLAGS.bench_batch_size, FLAGS.output_size, FLAGS.bench_q_len),
+        ["setting", "peak step MB", "train ms/step", "examples/s", "MB change",
+         "loss after %d steps" % (FLAGS.bench_runs + 1)], rows)
+
+
+BENCHMARKS = {
+    "attention": bench_attention,
+    "encoders": bench_encoders,
+    "decoders": bench_decoders,
+    "rnn_backends": bench_rnn_backends,
+    "shared_encoder": bench_shared_encoder,
+    "checkpoint": bench_checkpoint,
+    "embeddings": bench_embeddings,
+    "distill": bench_distill,
+    "towers": bench_towers,
+    "memory": bench_memory,
+}
+
+
+def main(_):
+    if FLAGS.bench not in BENCHMARKS:
+        raise ValueError("Unknown benchmark %s, choose one of %s" % (FLAGS.bench, sorted(BENCHMARKS)))
+    BENCHMARKS[FLAGS.bench]()
+
+
+if __name__ == "__main__":
+    tf.app.run()
@@ -0,0 +1,90 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+
+
+class Cascade(object):
+    """
+    A cheap model that answers every question first. Questions whose answer has a joint
+    start / end probability under @threshold are escalated to the expensive model, see
+    qa_answer.cascade_spans. Counts the questions and the time spent in both tiers.
+
+    Arguments:
+        -session: the session the cheap model was restored in (None for numpy bundles)
+        -model: the cheap model, anything with QASystem.decode
+        -threshold: questions answered with a lower confidence are escalated
+    """
+    def __init__(self, session, model, threshold):
+        self.session = session
+        self.model = model
+        self.threshold = threshold
+        self.questions = 0
+        self.escalated = 0
+        self.cheap_time = 0.
+        self.expensive_time = 0.
+
+    def escalation_rate(self):
+        return self.escalated / self.questions if self.questions else 0.
+
+    def __str__(self):
+        return "cascade: %d questions, %d escalated (%.1f%%) at threshold %.3f, %.2f secs cheap, %.2f secs expensive" % (
+            self.questions, self.escalated, 100 * self.escalation_rate(), self.threshold, self.cheap_time,
+            self.expensive_time)
+
+
+def calibrate_threshold(confidence, cheap_f1, expensive_f1, max_f1_loss):
+    """
+    Picks the lowest threshold whose cascade F1 is at most @max_f1_loss (in F1 points)
+    below the F1 of answering everything with the expensive model. Escalating
+    the k least confident questions gives the cascade F1 of threshold confidence[k],
+    and the smallest such k that is good enough and does not split questions of equal
+    confidence is chosen.
+
+    :param confidence: cheap model confidence of every question of a held-out set
+    :param cheap_f1: F1 (0 to 1) of the cheap model's answer to every question
+    :param expensive_f1: F1 (0 to 1) of the expensive model's answer to every question
+    :return: (threshold, fraction escalated, cascade F1 in points)
+    """
+    confidence = np.asarray(confidence, dtype=np.float64)
+    cheap_f1 = np.asarray(cheap_f1, dtype=np.float64)
+    expensive_f1 = np.asarray(expensive_f1, dtype=np.float64)
+    n = len(confidence)
+
+    order = np.argsort(confidence, kind="mergesort")
+    # cascade F1 sum when the first k of @order are escalated, for k = 0..n
+    gains = np.concatenate([[0.], np.cumsum(expensive_f1[order] - cheap_f1[order])])
+    cascade_f1 = 100. * (cheap_f1.sum() + gains) / n
+    target = 100. * expensive_f1.mean() - max_f1_loss
+
+    # a threshold escalates all questions of equal confidence together, so only the k
+    # that end a group of equal confidences can be chosen (k = n always meets the target)
+    boundary = np.concatenate([[True], confidence[order[1:]] != confidence[order[:-1]], [True]])
+    k = int(np.argmax((cascade_f1 >= target - 1e-9) & boundary))
+    threshold = confidence[order[k]] if k < n else np.inf
+    escalated = confidence < threshold
+    f1 = 100. * np.where(escalated, expensive_f1, cheap_f1).mean()
+    return threshold, escalated.mean(), f1
+
+
+def test_calibrate_threshold():
+    rng = np.random.RandomState(0)
+    for trial in range(200):
+        n = rng.randint(1, 30)
+        # few distinct values, so many questions share a confidence
+        confidence = rng.randint(5, size=n) / 4.
+        cheap_f1 = rng.randint(3, size=n) / 2.
+        expensive_f1 = rng.randint(3, size=n) / 2.
+        max_f1_loss = rng.choice([0., 1., 5., 20.])
+        threshold, escalated, f1 = calibrate_threshold(confidence, cheap_f1, expensive_f1, max_f1_loss)
+
+        # lowest of the thresholds that escalate whole confidence groups meeting the target
+        target = 100. * expensive_f1.mean() - max_f1_loss
+        for t in sorted(set(confidence)) + [np.inf]:
+            t_f1 = 100. * np.where(confidence < t, expensive_f1, cheap_f1).mean()
+            if t_f1 >= target - 1e-9:
+                break
+        assert threshold == t, (trial, threshold, t)
+        assert np.isclose(f1, t_f1)
+        assert np.isclose(escalated, (confidence < t).mean())
@@ -0,0 +1,135 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import glob
+import json
+import os
+import threading
+import time
+from os.path import join as pjoin
+
+from six.moves import queue
+import tensorflow as tf
+
+import logging
+
+logging.basicConfig(level=logging.INFO)
+
+CHECKPOINTS_FILE = "checkpoints.json"
+
+
+def best_checkpoint(train_dir):
+    """
+    :return: path of the checkpoint in @train_dir with the highest val F1 recorded by
+             CheckpointManager, None when there is no record
+    """
+    if not os.path.exists(pjoin(train_dir, CHECKPOINTS_FILE)):
+        return None
+    with open(pjoin(train_dir, CHECKPOINTS_FILE)) as f:
+        checkpoints = json.load(f)
+    if not checkpoints:
+        return None
+    return pjoin(train_dir, max(checkpoints, key=lambda c: (c["f1"], c["step"]))["name"])
+
+
+class CheckpointManager(object):
+    """
+    Saves checkpoints of @variables to @train_dir without stalling training on disk I/O.
+    save() only copies the variable values out of the session; a background thread writes
+    them as train_dir/model-<step> with a Saver of its own graph, so the files load with
+    the model's saver.
+
+    Keeps the @keep checkpoints with the highest val F1 and the latest one, and deletes
+    the others (@keep 0 keeps all). The kept checkpoints and their F1 are listed in
+    train_dir/checkpoints.json, see best_checkpoint; the TF checkpoint state points at
+    the latest one, so training resumes from it.
+    """
+    def __init__(self, variables, train_dir, keep):
+        self.variables = variables
+        self.train_dir = train_dir
+        self.keep = keep
+        self.checkpoints = []
+        if os.path.exists(pjoin(train_dir, CHECKPOINTS_FILE)):
+            with open(pjoin(train_dir, CHECKPOINTS_FILE)) as f:
+                self.checkpoints = json.load(f)
+
+        # variables of the same names, assigned the snapshot values before every write
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            self.placeholders = [tf.placeholder(v.dtype.base_dtype, shape=v.get_shape()) for v in variables]
+            copies = [tf.Variable(p, name=v.op.name, trainable=False) for v, p in zip(variables, self.placeholders)]
+            self.assign_op = tf.group(*[c.initializer for c in copies])
+            self.saver = tf.train.Saver(var_list=dict((v.op.name, c) for v, c in zip(variables, copies)),
+                                        max_to_keep=0)
+        self.session = tf.Session(graph=self.graph)
+
+        # at most one snapshot waits while another is written
+        self.queue = queue.Queue(maxsize=1)
+        self.error = None
+        self.writer = threading.Thread(target=self.run)
+        self.writer.daemon = True
+        self.writer.start()
+
+    def save(self, session, step, f1):
+        """
+        Snapshots the variables of @session as checkpoint @step with val F1 @f1 and queues
+        the write.
+        """
+        self.check()
+        tic = time.time()
+        values = session.run(self.variables)
+        self.queue.put((values, step, f1))
+        logging.info("Snapshot of checkpoint %d in %.2f secs", step, time.time() - tic)
+
+    def close(self):
+        """
+        Waits for the queued checkpoints to be written.
+        """
+        self.queue.put(None)
+        self.writer.join()
+        self.session.close()
+        self.check()
+
+    def check(self):
+        if self.error is not None:
+            raise self.error
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            if self.error is not None:
+                continue
+            try:
+                self.write(*item)
+            except Exception as e:  # pylint: disable=broad-except
+                logging.exception("Writing checkpoint %d failed", item[1])
+                self.error = e
+
+    def write(self, values, step, f1):
+        tic = time.time()
+        name = "model-%d" % step
+        self.session.run(self.assign_op, dict(zip(self.placeholders, values)))
+        self.saver.save(self.session, pjoin(self.train_dir, name), write_meta_graph=False)
+
+        self.checkpoints = [c for c in self.checkpoints if c["name"] != name]
+        self.checkpoints.append({"name": name, "step": step, "f1": float(f1)})
+        if self.keep > 0:
+            best = sorted(self.checkpoints, key=lambda c: (c["f1"], c["step"]), reverse=True)[:self.keep]
+            kept = [c for c in self.checkpoints if c in best or c["name"] == name]
+            for c in self.checkpoints:
+                if c not in kept:
+                    prefix = pjoin(self.train_dir, c["name"])
+                    for path in glob.glob(prefix) + glob.glob(prefix + ".*"):
+                        os.remove(path)
+            self.checkpoints = kept
+
+        with open(pjoin(self.train_dir, CHECKPOINTS_FILE), 'w') as fout:
+            json.dump(self.checkpoints, fout, indent=2)
+        # relative paths, train_dir is a symlink to the real directory
+        tf.train.update_checkpoint_state(self.train_dir, name,
+                                         all_model_checkpoint_paths=[c["name"] for c in self.checkpoints])
+        logging.info("Wrote checkpoint %d (val F1 %.4f) in %.2f secs, keeping %s", step, f1, time.time() - tic,
+                     ", ".join(c["name"] for c in self.checkpoints))
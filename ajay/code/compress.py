@@ -0,0 +1,200 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import itertools
+import json
+import time
+from os.path import join as pjoin
+
+import numpy as np
+import tensorflow as tf
+
+from benchmark import load_split, print_table, time_run
+from qa_model import build_model
+from train import FLAGS, get_normalized_train_dir, initialize_embeddings, initialize_model
+from util import load_model_flags, minibatches
+
+import logging
+
+logging.basicConfig(level=logging.INFO)
+
+tf.app.flags.DEFINE_integer("compress_state_size", 0, "state_size of the pruned model (default: half the state_size of the model in train_dir).")
+tf.app.flags.DEFINE_string("compress_dir", "", "Where to write the pruned and fine-tuned model (default: {train_dir}_pruned).")
+tf.app.flags.DEFINE_integer("compress_steps", 200, "Fine-tuning steps of the pruned model.")
+tf.app.flags.DEFINE_integer("compress_eval_sample", 1000, "Number of val examples the F1 / EM comparison is computed on.")
+
+
+def cell_layout(scope, cell, inputs, units):
+    """
+    Layout of the variables of one GRUCell / BasicLSTMCell in @scope, see model_layout.
+    """
+    if cell == "gru":
+        return {scope + "/GRUCell/Gates/Linear/Matrix": [inputs + [units], [units, units]],
+                scope + "/GRUCell/Gates/Linear/Bias": [[units, units]],
+                scope + "/GRUCell/Candidate/Linear/Matrix": [inputs + [units], [units]],
+                scope + "/GRUCell/Candidate/Linear/Bias": [[units]]}
+    return {scope + "/BasicLSTMCell/Linear/Matrix": [inputs + [units], [units] * 4],
+            scope + "/BasicLSTMCell/Linear/Bias": [[units] * 4]}
+
+
+def model_layout(flags):
+    """
+    Describes every state_size-wide axis of the variables of the recurrent model (question
+    encoder, MatchLSTM encoder and rnn decoder, without the unused context encoder pass).
+    Each axis is a concatenation of segments: an int is a block of that many inputs that is
+    kept whole, a string names a group of state_size hidden units that is pruned as one,
+    e.g. the rows [embedding, h] of a GRU gate matrix are [embedding_size, "question"] and
+    its columns [r, u] are ["question", "question"].
+
+    :return: dict of variable name to list of axes
+    """
+    cell, E = flags.model_type, flags.embedding_size
+    match = "qa/context_encoder/RNN/MatchLSTMCell"
+
+    layout = cell_layout("qa/question_encoder/RNN", cell, [E], "question")
+    layout.update({match + "/Attn/Linear/Matrix": [[E, "match"], ["attention"]],
+                   match + "/Attn/Linear/Bias": [["attention"]],
+                   match + "/Attn/W_q": [[1], ["question"], ["attention"]],
+                   match + "/w_score": [[1], [1], ["attention"]],
+                   match + "/Linear/Matrix": [[E, "attention", "match"], ["match"] * 4],
+                   match + "/Linear/Bias": [["match"] * 4]})
+    layout.update(cell_layout("qa/decoder/start_decoder/RNN", cell, ["match"], "start"))
+    layout.update(cell_layout("qa/decoder/end_decoder/RNN", cell, ["start"], "end"))
+    layout.update({"qa/decoder/W_start": [[1], [1], ["start"]],
+                   "qa/decoder/W_end": [[1], [1], ["end"]]})
+    return layout
+
+
+def axis_index(axis, units, state_size):
+    """
+    Indices of an axis laid out as @axis that remain when the unit groups keep @units.
+    """
+    index, offset = [], 0
+    for segment in axis:
+        if isinstance(segment, int):
+            index.append(offset + np.arange(segment))
+            offset += segment
+        else:
+            index.append(offset + units[segment])
+            offset += state_size
+    return np.concatenate(index)
+
+
+def select_units(layout, values, state_size, new_size):
+    """
+    Scores every hidden unit by the squared magnitude of all weights it reads or writes
+    (its gate columns, and its rows in the recurrent and downstream matrices) and keeps the
+    @new_size highest scoring units of every group, in their original order.
+    """
+    scores = {}
+    for name, axes in layout.items():
+        value = values[name]
+        for a, axis in enumerate(axes):
+            squares = np.square(value).sum(axis=tuple(i for i in range(value.ndim) if i != a))
+            offset = 0
+            for segment in axis:
+                if isinstance(segment, int):
+                    offset += segment
+                    continue
+                scores.setdefault(segment, np.zeros(state_size))
+                scores[segment] += squares[offset:offset + state_size]
+                offset += state_size
+    return dict((group, np.sort(np.argsort(-score, kind="mergesort")[:new_size])) for group, score in scores.items())
+
+
+def prune(layout, values, state_size, new_size):
+    units = select_units(layout, values, state_size, new_size)
+    pruned = {}
+    for name, axes in layout.items():
+        value = values[name]
+        for a, axis in enumerate(axes):
+            value = np.take(value, axis_index(axis, units, state_size), axis=a)
+        pruned[name] = value
+    return pruned
+
+
+def measure(name, sess, qa, val_set, val_context, feed):
+    num_params = sum(v.get_shape().num_elements() for v in tf.trainable_variables())
+    forward = time_run(sess, [qa.start_probs, qa.end_probs], feed)
+    np.random.seed(0)
+    f1, em = qa.evaluate_answer(sess, val_set, val_context, sample=FLAGS.compress_eval_sample)
+    return [name, int(num_params), 1000 * forward, f1, em]
+
+
+def main(_):
+    flags = load_model_flags(FLAGS.train_dir, FLAGS.__flags)
+    if flags.model_type not in ("gru", "lstm") or flags.decoder_type != "rnn" or flags.rnn_backend != "basic":
+        raise ValueError("Only gru / lstm models with the rnn decoder and the basic rnn_backend can be pruned")
+    state_size = flags.state_size
+    new_size = FLAGS.compress_state_size or state_size // 2
+    compress_dir = FLAGS.compress_dir or FLAGS.train_dir.rstrip("/") + "_pruned"
+
+    embeddings = initialize_embeddings(FLAGS.embed_path or pjoin(FLAGS.data_dir, "glove.trimmed.{}.npz".format(
+        FLAGS.embedding_size)))
+    ctx_len = flags.output_size
+    train_set, _ = load_split("train", ctx_len)
+    val_set, val_context = load_split("val", ctx_len)
+    max_q_len = max(max(train_set[:, 4]), max(val_set[:, 4]))
+
+    batch = val_set[:FLAGS.batch_size]
+    feed_values = [np.array(list(col)) for col in batch.T]
+
+    def feed(qa):
+        return {qa.context_placeholder: feed_values[0], qa.question_placeholder: feed_values[1],
+                qa.mask_ctx_placeholder: feed_values[3], qa.mask_q_placeholder: feed_values[4],
+                qa.dropout_placeholder: FLAGS.dropout}
+
+    # the trained model and its variables
+    layout = model_layout(flags)
+    rows = []
+    with tf.Graph().as_default():
+        qa = build_model(flags, embeddings, ctx_len, max_q_len, training=False)
+        with tf.Session() as sess:
+            initialize_model(sess, qa, get_normalized_train_dir(FLAGS.train_dir))
+            rows.append(measure("state_size %d" % state_size, sess, qa, val_set, val_context, feed(qa)))
+            variables = dict((v.op.name, v) for v in tf.global_variables())
+            values = dict((name, sess.run(variables[name])) for name in layout)
+
+    tic = time.time()
+    pruned = prune(layout, values, state_size, new_size)
+    logging.info("Pruned %d variables from %d to %d units in %.2f secs", len(pruned), state_size, new_size,
+                 time.time() - tic)
+
+    # the same graph at the reduced width, initialized with the pruned weights
+    pruned_flags = load_model_flags(FLAGS.train_dir, FLAGS.__flags)
+    pruned_flags.state_size = new_size
+    pruned_flags.prune_dead = 1
+    pruned_flags.teacher_dir = ""
+    with tf.Graph().as_default():
+        qa = build_model(pruned_flags, embeddings, ctx_len, max_q_len)
+        with tf.Session() as sess:
+            sess.run(tf.global_variables_initializer(), qa.initializer_feed())
+            for v in tf.trainable_variables():
+                if v.op.name not in pruned:
+                    raise ValueError("No pruned value for %s" % v.op.name)
+                sess.run(v.assign(pruned[v.op.name]))
+            rows.append(measure("pruned to %d" % new_size, sess, qa, val_set, val_context, feed(qa)))
+
+            tic = time.time()
+            batches = itertools.cycle(minibatches(train_set, FLAGS.batch_size))
+            for step in itertools.islice(batches, FLAGS.compress_steps):
+                qa.optimize(sess, *step)
+            logging.info("Fine-tuned %d steps in %.1f secs", FLAGS.compress_steps, time.time() - tic)
+            rows.append(measure("pruned to %d, fine-tuned" % new_size, sess, qa, val_set, val_context, feed(qa)))
+
+            qa.saver.save(sess, pjoin(get_normalized_train_dir(compress_dir), "model"))
+    with open(pjoin(compress_dir, "flags.json"), 'w') as fout:
+        json.dump(vars(pruned_flags), fout)
+    logging.info("Saved the pruned model to %s, load it with --state_size=%d --prune_dead=1", compress_dir, new_size)
+
+    for row in rows[1:]:
+        row += [row[3] - rows[0][3]]
+    rows[0] += [0.]
+    print_table("Structured pruning, %d val examples, forward batch of %d" % (FLAGS.compress_eval_sample,
+                                                                             FLAGS.batch_size),
+                ["model", "params", "forward ms/batch", "val F1", "val EM", "F1 change"], rows)
+
+
+if __name__ == "__main__":
+    tf.app.run()
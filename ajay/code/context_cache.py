@@ -0,0 +1,91 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+
+class ContextCache(object):
+    """
+    LRU cache of the question-independent paragraph representations computed by
+    QASystem.context_repr, keyed by a hash of the paragraph token ids.
+
+    Arguments:
+        -capacity: maximum number of paragraphs kept, the least recently used one is
+                   evicted first
+    """
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(context_ids):
+        return hashlib.sha1(np.asarray(context_ids, dtype=np.int32).tobytes()).hexdigest()
+
+    def get(self, key):
+        with self.lock:
+            value = self.entries.pop(key, None)
+            if value is None:
+                self.misses += 1
+                return None
+            # re-insert to mark as most recently used
+            self.entries[key] = value
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = value
+            while len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __str__(self):
+        return "context cache: %d/%d paragraphs, %d hits, %d misses (hit rate %.1f%%)" % (
+            len(self.entries), self.capacity, self.hits, self.misses, 100 * self.hit_rate())
+
+
+def test_context_cache():
+    rng = np.random.RandomState(0)
+    for capacity in [1, 2, 5]:
+        cache = ContextCache(capacity)
+        # reference LRU order, least recently used first
+        order = []
+        hits = misses = 0
+        for _ in range(500):
+            key = ContextCache.key(rng.randint(8, size=2))
+            if rng.rand() < 0.5:
+                value = cache.get(key)
+                if key in order:
+                    assert value == key
+                    order.remove(key)
+                    order.append(key)
+                    hits += 1
+                else:
+                    assert value is None
+                    misses += 1
+            else:
+                cache.put(key, key)
+                if key in order:
+                    order.remove(key)
+                order.append(key)
+                order = order[-capacity:]
+            assert list(cache.entries) == order
+        assert (cache.hits, cache.misses) == (hits, misses)
+
+    assert ContextCache.key([1, 2, 3]) == ContextCache.key(np.array([1, 2, 3], dtype=np.int64))
+    assert ContextCache.key([1, 2, 3]) != ContextCache.key([1, 2, 3, 0])
@@ -0,0 +1,82 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+from os.path import join as pjoin
+
+import numpy as np
+from numpy.lib.format import open_memmap
+
+import logging
+
+logging.basicConfig(level=logging.INFO)
+
+TEACHER_LOGITS = "teacher_logits.npy"
+TEACHER_OFFSETS = "teacher_offsets.npy"
+
+
+class TeacherLogits(object):
+    """
+    Start / end logits of a teacher model over the training examples, cached by
+    cache_teacher_logits. The logits of all examples are concatenated without padding into
+    one float16 array of shape (total context tokens, 2), memory-mapped so only the rows of
+    the current batch are read; example i owns rows offsets[i]:offsets[i + 1].
+    """
+    def __init__(self, cache_dir):
+        self.logits = np.load(pjoin(cache_dir, TEACHER_LOGITS), mmap_mode='r')
+        self.offsets = np.load(pjoin(cache_dir, TEACHER_OFFSETS))
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def batch(self, indices, width):
+        """
+        :return: start and end logits of the examples @indices, padded to @width with the
+                 same -1e30 the model adds to padded positions
+        """
+        start = np.full((len(indices), width), -1e30, dtype=np.float32)
+        end = np.full((len(indices), width), -1e30, dtype=np.float32)
+        for k, i in enumerate(indices):
+            rows = self.logits[self.offsets[i]:self.offsets[i + 1]]
+            start[k, :len(rows)] = rows[:, 0]
+            end[k, :len(rows)] = rows[:, 1]
+        return start, end
+
+
+def load_teacher_logits(cache_dir, context_ids):
+    """
+    :return: the TeacherLogits cached in @cache_dir, or None when there are none or they were
+             computed over other examples than @context_ids (different windowing / truncation)
+    """
+    if not os.path.exists(pjoin(cache_dir, TEACHER_OFFSETS)):
+        return None
+    teacher_logits = TeacherLogits(cache_dir)
+    lengths = np.diff(teacher_logits.offsets)
+    if len(lengths) != len(context_ids) or np.any(lengths != [len(ids) for ids in context_ids]):
+        logging.info("Cached teacher logits in %s do not match the training examples", cache_dir)
+        return None
+    return teacher_logits
+
+
+def cache_teacher_logits(sess, teacher, context_ids, question_ids, cache_dir, batch_size):
+    """
+    Decodes every training example once with the @teacher QASystem and writes its logits
+    to @cache_dir in the TeacherLogits layout. The offsets are written last, so an
+    interrupted run leaves no cache behind.
+    """
+    if os.path.exists(pjoin(cache_dir, TEACHER_OFFSETS)):
+        # stale cache of other examples
+        os.remove(pjoin(cache_dir, TEACHER_OFFSETS))
+    offsets = np.concatenate([[0], np.cumsum([len(ids) for ids in context_ids])]).astype(np.int64)
+    logits = open_memmap(pjoin(cache_dir, TEACHER_LOGITS), mode='w+', dtype=np.float16, shape=(int(offsets[-1]), 2))
+    for i in range(0, len(context_ids), batch_size):
+        start_logits, end_logits = teacher.decode_batches(sess, context_ids[i:i + batch_size],
+                                                          question_ids[i:i + batch_size], batch_size)
+        for j, (start, end) in enumerate(zip(start_logits, end_logits)):
+            logits[offsets[i + j]:offsets[i + j + 1]] = np.stack([start, end], axis=1)
+    logits.flush()
+    del logits
+    np.save(pjoin(cache_dir, TEACHER_OFFSETS), offsets)
+    logging.info("Cached teacher logits of %d examples (%d tokens, %.1f MB) in %s", len(context_ids), offsets[-1],
+                 offsets[-1] * 2 * 2 / 2. ** 20, cache_dir)
@@ -0,0 +1,144 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+import os
+import shutil
+import time
+from os.path import join as pjoin
+
+import numpy as np
+import tensorflow as tf
+from tensorflow.python.framework import graph_util
+
+from inference_bundle import GRAPH_FILE, META_FILE, OUTPUTS, VOCAB_FILE, InferenceBundle
+from np_engine import WEIGHTS_FILE, NumpyEngine
+from qa_answer import FLAGS, build_qa_system, get_normalized_train_dir, initialize_embeddings, initialize_model
+
+import logging
+
+logging.basicConfig(level=logging.INFO)
+
+tf.app.flags.DEFINE_string("bundle_format", "graph", "graph writes a frozen GraphDef, numpy the variables for np_engine.NumpyEngine (gru and lstm models with the basic rnn_backend).")
+tf.app.flags.DEFINE_integer("parity_batches", 4, "Number of random batches the numpy bundle is checked against the TensorFlow model on.")
+tf.app.flags.DEFINE_float("parity_tolerance", 1e-4, "Largest abs logit difference between the numpy bundle and the TensorFlow model accepted by the parity check.")
+
+# the flags qa_answer needs to window and decode like the exported model
+BUNDLE_FLAGS = ["model_type", "output_size", "window_size", "doc_stride", "max_answer_len", "embedding_size",
+                "state_size", "dropout", "decoder_type", "attn_precompute", "rnn_backend"]
+
+
+def dir_size(path):
+    return sum(os.path.getsize(pjoin(path, f)) for f in os.listdir(path) if os.path.isfile(pjoin(path, f)))
+
+
+def write_meta(bundle_dir, vocab_path, inputs):
+    if not os.path.exists(bundle_dir):
+        os.makedirs(bundle_dir)
+    shutil.copy(vocab_path, pjoin(bundle_dir, VOCAB_FILE))
+    meta = {"inputs": inputs, "flags": dict((name, getattr(FLAGS, name)) for name in BUNDLE_FLAGS)}
+    with open(pjoin(bundle_dir, META_FILE), "w") as f:
+        json.dump(meta, f, indent=2)
+
+
+def export_bundle(sess, qa, bundle_dir, vocab_path):
+    """
+    Freezes the inference graph of @qa, restored in @sess, into @bundle_dir: only the ops
+    the start / end logits depend on are kept (no optimizer, loss or answer span input),
+    the variables are folded in as constants, and the vocabulary is copied along.
+    """
+    with sess.graph.as_default():
+        tf.identity(qa.start_probs, name=OUTPUTS[0])
+        tf.identity(qa.end_probs, name=OUTPUTS[1])
+    graph_def = graph_util.convert_variables_to_constants(sess, sess.graph.as_graph_def(), OUTPUTS)
+
+    inputs = [node.name for node in graph_def.node if node.op == "Placeholder"]
+    write_meta(bundle_dir, vocab_path, inputs)
+    with tf.gfile.GFile(pjoin(bundle_dir, GRAPH_FILE), "wb") as f:
+        f.write(graph_def.SerializeToString())
+    logging.info("Exported %d ops (inputs %s) to %s", len(graph_def.node), ", ".join(inputs), bundle_dir)
+
+
+def export_numpy(sess, qa, bundle_dir, vocab_path):
+    """
+    Writes the model variables of @qa, restored in @sess, and the embedding matrix to
+    @bundle_dir for np_engine.NumpyEngine, keyed by variable name.
+    """
+    variables = [v for v in set(qa.saver_vars) | {qa.embeddings} if v.op.name.startswith("qa/")]
+    values = sess.run(variables)
+    weights = dict((v.op.name, np.asarray(value, dtype=np.float32)) for v, value in zip(variables, values))
+
+    write_meta(bundle_dir, vocab_path, [])
+    np.savez(pjoin(bundle_dir, WEIGHTS_FILE), **weights)
+    logging.info("Exported %d variables to %s", len(weights), bundle_dir)
+
+
+def check_parity(sess, qa, engine, vocab_size, batches, tolerance):
+    """
+    Decodes random batches with @qa and @engine and logs the largest logit difference over
+    the unpadded positions, how often the best start / end agree, and both decode times.
+    Raises a ValueError when the difference exceeds @tolerance.
+    """
+    ctx_len, q_len, batch_size = FLAGS.window_size or FLAGS.output_size, 30, FLAGS.batch_size
+    max_diff, agree, total, tf_time, np_time = 0., 0, 0, 0., 0.
+    for _ in range(batches):
+        ctx = np.random.randint(vocab_size, size=(batch_size, ctx_len))
+        q = np.random.randint(vocab_size, size=(batch_size, q_len))
+        mask_ctx = np.random.randint(1, ctx_len + 1, size=batch_size)
+        mask_q = np.random.randint(1, q_len + 1, size=batch_size)
+
+        tic = time.time()
+        expected = qa.decode(sess, ctx, q, None, mask_ctx, mask_q)
+        tf_time += time.time() - tic
+        tic = time.time()
+        actual = engine.decode(None, ctx, q, None, mask_ctx, mask_q)
+        np_time += time.time() - tic
+
+        valid = np.arange(ctx_len)[None, :] < mask_ctx[:, None]
+        for e, a in zip(expected, actual):
+            max_diff = max(max_diff, np.abs(e - a)[valid].max())
+            agree += np.sum(e.argmax(axis=1) == a.argmax(axis=1))
+            total += batch_size
+
+    logging.info("Numpy engine parity over %d batches: max abs logit diff %.2e, argmax agreement %.2f%%",
+                 batches, max_diff, 100. * agree / total)
+    logging.info("Decode time per batch of %d: TensorFlow %.1f ms, numpy %.1f ms",
+                 batch_size, 1000 * tf_time / batches, 1000 * np_time / batches)
+    if max_diff > tolerance:
+        raise ValueError("The numpy engine diverges from the TensorFlow model: max abs logit diff %.2e > %.2e" % (
+            max_diff, tolerance))
+
+
+def main(_):
+    tic = time.time()
+    embed_path = FLAGS.embed_path or pjoin("data", "squad", "glove.trimmed.{}.npz".format(FLAGS.embedding_size))
+    embeddings = initialize_embeddings(embed_path)
+
+    train_dir = get_normalized_train_dir(FLAGS.train_dir)
+    if not tf.train.get_checkpoint_state(train_dir):
+        raise ValueError("No checkpoint to export in %s" % FLAGS.train_dir)
+    bundle_dir = FLAGS.bundle_dir or "bundle"
+    qa = build_qa_system(embeddings, max_q_len=None)
+    with tf.Session() as sess:
+        initialize_model(sess, qa, train_dir)
+        cold_start = time.time() - tic
+        if FLAGS.bundle_format == "numpy":
+            export_numpy(sess, qa, bundle_dir, FLAGS.vocab_path)
+            bundle = NumpyEngine.load(bundle_dir)
+            check_parity(sess, qa, bundle, embeddings.shape[0], FLAGS.parity_batches, FLAGS.parity_tolerance)
+        else:
+            export_bundle(sess, qa, bundle_dir, FLAGS.vocab_path)
+
+    if FLAGS.bundle_format != "numpy":
+        bundle = InferenceBundle(bundle_dir)
+        bundle.session.close()
+
+    logging.info("Checkpoint directory: %.1f MB, cold start (build + restore) %.2f secs",
+                 dir_size(os.path.realpath(FLAGS.train_dir)) / 2. ** 20, cold_start)
+    logging.info("%s bundle: %.1f MB, cold start (load) %.2f secs",
+                 FLAGS.bundle_format, dir_size(bundle_dir) / 2. ** 20, bundle.load_time)
+
+
+if __name__ == "__main__":
+    tf.app.run()
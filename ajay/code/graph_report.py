@@ -0,0 +1,219 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import re
+import time
+from collections import Counter, defaultdict
+from os.path import join as pjoin
+
+import numpy as np
+import tensorflow as tf
+
+from benchmark import model_flags, print_table, time_run
+from qa_model import build_model
+from train import FLAGS, initialize_embeddings
+
+import logging
+
+logging.basicConfig(level=logging.INFO)
+
+tf.app.flags.DEFINE_integer("report_batch_size", 32, "Batch size of the traced and timed runs.")
+tf.app.flags.DEFINE_integer("report_q_len", 30, "Question length of the traced and timed runs.")
+tf.app.flags.DEFINE_integer("report_depth", 2, "Number of name scope levels the report groups ops and variables by.")
+
+ELEMENTWISE = {"Add", "Sub", "Mul", "Div", "RealDiv", "Neg", "Square", "Sqrt", "Rsqrt", "Exp", "Log", "Tanh",
+               "Sigmoid", "Relu", "Maximum", "Minimum", "BiasAdd", "Select", "AddN", "TanhGrad", "SigmoidGrad",
+               "ReluGrad", "RsqrtGrad", "SquaredDifference"}
+REDUCTIONS = {"Sum", "Mean", "Max", "Min", "Prod"}
+
+
+def scope_of(name, depth):
+    """
+    Groups op and variable names by their first @depth name scopes. Gradient ops are
+    grouped with the scope they differentiate, and the "_1" suffixes of re-entered name
+    scopes are dropped.
+    """
+    parts = name.split("/")
+    if parts[0] == "gradients":
+        parts = parts[1:]
+    return "/".join(re.sub(r"_\d+$", "", part) for part in parts[:depth])
+
+
+def live_ops(fetches):
+    """
+    All ops @fetches (tensors or ops) depend on, through data and control inputs.
+    """
+    live = set()
+    stack = [t if isinstance(t, tf.Operation) else t.op for t in fetches]
+    while stack:
+        op = stack.pop()
+        if op in live:
+            continue
+        live.add(op)
+        stack.extend(t.op for t in op.inputs)
+        stack.extend(op.control_inputs)
+    return live
+
+
+def op_flops(op, shapes):
+    """
+    Estimated floating point operations of one execution of @op, from the shapes its
+    inputs and outputs had in a traced run (@shapes maps (op name, slot) to a shape).
+    Ops that do no arithmetic (reshapes, gathers, control flow) count as 0.
+    """
+    def shape(tensor):
+        return shapes.get((tensor.op.name, tensor.value_index))
+
+    out = shapes.get((op.name, 0))
+    if out is None:
+        return 0
+    size = int(np.prod(out))
+
+    if op.type == "MatMul":
+        a = shape(op.inputs[0])
+        k = a[0] if op.get_attr("transpose_a") else a[1]
+        return 2 * size * k
+    if op.type == "BatchMatMul":
+        a = shape(op.inputs[0])
+        k = a[-2] if op.get_attr("adj_x") else a[-1]
+        return 2 * size * k
+    if op.type == "Conv2D":
+        kh, kw, in_channels, _ = shape(op.inputs[1])
+        return 2 * size * kh * kw * in_channels
+    if op.type == "DepthwiseConv2dNative":
+        kh, kw, _, _ = shape(op.inputs[1])
+        return 2 * size * kh * kw
+    if op.type in ("LSTMBlockCell", "GRUBlockCell", "BlockLSTM"):
+        # the fused kernels do the gate matmul of [x, h] with all gates
+        x = shape(op.inputs[1] if op.type == "BlockLSTM" else op.inputs[0])
+        gates = 3 if op.type == "GRUBlockCell" else 4
+        num_units = out[-1]
+        return 2 * int(np.prod(x[:-1])) * (x[-1] + num_units) * gates * num_units
+    if op.type in ELEMENTWISE:
+        return size
+    if op.type in REDUCTIONS or op.type in ("Softmax", "SparseSoftmaxCrossEntropyWithLogits"):
+        a = shape(op.inputs[0])
+        return 3 * int(np.prod(a)) if a is not None else 0
+    return 0
+
+
+def traced_flops(sess, fetches, feed, graph):
+    """
+    Runs @fetches once with a full trace and sums the estimated flops of every executed
+    op, per op (ops inside RNN loops are counted once per iteration).
+    """
+    options = tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE)
+    metadata = tf.RunMetadata()
+    sess.run(fetches, feed, options=options, run_metadata=metadata)
+
+    shapes = {}
+    executions = Counter()
+    for device in metadata.step_stats.dev_stats:
+        for node in device.node_stats:
+            executions[node.node_name] += 1
+            for output in node.output:
+                shapes[(node.node_name, output.slot)] = [d.size for d in output.tensor_description.shape.dim]
+
+    flops = {}
+    for name, count in executions.items():
+        try:
+            op = graph.get_operation_by_name(name)
+        except (KeyError, ValueError):
+            # _SOURCE, _SINK and send / recv nodes
+            continue
+        try:
+            flops[op] = count * op_flops(op, shapes)
+        except (TypeError, IndexError, ValueError):
+            flops[op] = 0
+    return flops
+
+
+def report(name, overrides, embeddings):
+    """
+    Builds the QASystem configured by FLAGS and @overrides and prints its parameters,
+    estimated forward / backward flops and dead ops per scope.
+    :return: summary row
+    """
+    batch_size, ctx_len, q_len = FLAGS.report_batch_size, FLAGS.output_size, FLAGS.report_q_len
+    depth = FLAGS.report_depth
+
+    graph = tf.Graph()
+    with graph.as_default():
+        tic = time.time()
+        qa = build_model(model_flags(**overrides), embeddings, ctx_len, q_len)
+        build_time = time.time() - tic
+
+        # model variables, without the optimizer slots
+        forward_ops = live_ops([qa.loss, qa.start_probs, qa.end_probs])
+        trainable = set(tf.trainable_variables())
+        variables = [v for v in tf.global_variables() if v.name.startswith("qa/") and
+                     (v in trainable or v.op in forward_ops)]
+
+        # everything under the model scope that neither the loss, the logits nor the update
+        # depend on, apart from the initializers of the variables that are used
+        live = live_ops([qa.loss, qa.start_probs, qa.end_probs, qa.train_op])
+        dead_variables = [v for v in variables if v.op not in live]
+        live |= live_ops([v.initializer for v in variables if v.op in live])
+        dead = [op for op in graph.get_operations() if op.name.startswith("qa/") and op not in live]
+
+        params = defaultdict(int)
+        for v in variables:
+            params[scope_of(v.op.name, depth)] += v.get_shape().num_elements()
+        dead_ops = Counter(scope_of(op.name, depth) for op in dead)
+
+        vocab_size = embeddings.shape[0]
+        feed = {qa.context_placeholder: np.random.randint(vocab_size, size=(batch_size, ctx_len)),
+                qa.question_placeholder: np.random.randint(vocab_size, size=(batch_size, q_len)),
+                qa.answer_span_placeholder: np.sort(np.random.randint(ctx_len, size=(batch_size, 2)), axis=1),
+                qa.mask_ctx_placeholder: np.full(batch_size, ctx_len, dtype=np.int32),
+                qa.mask_q_placeholder: np.full(batch_size, q_len, dtype=np.int32),
+                qa.dropout_placeholder: FLAGS.dropout}
+
+        with tf.Session() as sess:
+            sess.run(tf.global_variables_initializer(), qa.initializer_feed())
+            forward_flops = defaultdict(int)
+            backward_flops = defaultdict(int)
+            for op, flops in traced_flops(sess, [qa.loss, qa.start_probs, qa.end_probs], feed, graph).items():
+                forward_flops[scope_of(op.name, depth)] += flops
+            for op, flops in traced_flops(sess, qa.train_op, feed, graph).items():
+                if op.name.startswith("gradients/"):
+                    backward_flops[scope_of(op.name, depth)] += flops
+
+            forward = time_run(sess, [qa.start_probs, qa.end_probs], feed)
+            step = time_run(sess, [qa.train_op, qa.loss], feed)
+
+    scopes = sorted(set(params) | set(forward_flops) | set(backward_flops) | set(dead_ops))
+    rows = [(scope, params[scope], forward_flops[scope] / 1e6, backward_flops[scope] / 1e6, dead_ops[scope])
+            for scope in scopes if scope.startswith("qa/")]
+    rows.append(("total", sum(params.values()), sum(forward_flops.values()) / 1e6,
+                 sum(backward_flops.values()) / 1e6, len(dead)))
+    print_table("%s: batch %d, %d context tokens, %d question tokens" % (name, batch_size, ctx_len, q_len),
+                ["scope", "params", "forward MFLOPs", "backward MFLOPs", "dead ops"], rows)
+
+    if dead:
+        print("Dead variables: %s" % ", ".join(v.op.name for v in dead_variables))
+
+    return (name, len(graph.get_operations()), sum(params.values()), len(dead),
+            sum(v.get_shape().num_elements() for v in dead_variables), build_time, 1000 * forward, 1000 * step)
+
+
+def main(_):
+    embed_path = FLAGS.embed_path or pjoin(FLAGS.data_dir, "glove.trimmed.{}.npz".format(FLAGS.embedding_size))
+    if tf.gfile.Exists(embed_path):
+        embeddings = initialize_embeddings(embed_path)
+    else:
+        logging.info("%s not found, using random embeddings", embed_path)
+        embeddings = np.random.randn(1000, FLAGS.embedding_size).astype(np.float32)
+
+    rows = [report("model_type %s" % FLAGS.model_type, {"prune_dead": 0}, embeddings),
+            report("model_type %s, pruned" % FLAGS.model_type, {"prune_dead": 1}, embeddings)]
+
+    # TF only runs the ops the fetches depend on, so the dead subgraph costs graph
+    # construction, variable initialization and checkpoint size rather than step time
+    print_table("Dead subgraph pruning", ["variant", "ops", "params", "dead ops", "dead params", "build secs",
+                                          "forward ms/batch", "train ms/step"], rows)
+
+
+if __name__ == "__main__":
+    tf.app.run()
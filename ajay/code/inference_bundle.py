@@ -0,0 +1,63 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+import time
+from os.path import join as pjoin
+
+import tensorflow as tf
+
+import logging
+
+logging.basicConfig(level=logging.INFO)
+
+GRAPH_FILE = "model.pb"
+VOCAB_FILE = "vocab.dat"
+META_FILE = "bundle.json"
+OUTPUTS = ["start_logits", "end_logits"]
+
+
+class InferenceBundle(object):
+    """
+    Inference model written by export.py: a frozen GraphDef holding only the ops from the
+    input placeholders to the start / end logits, with the weights stored as constants,
+    next to the vocabulary and the flags the model was built with. Loading it does not
+    build any Python model code and restores no checkpoint.
+
+    decode has the signature of QASystem.decode, so the bundle can stand in for a
+    QASystem in qa_answer.generate_answers.
+    """
+    def __init__(self, bundle_dir, config=None):
+        tic = time.time()
+        with open(pjoin(bundle_dir, META_FILE)) as f:
+            meta = json.load(f)
+        self.flags = meta["flags"]
+        self.vocab_path = pjoin(bundle_dir, VOCAB_FILE)
+
+        graph_def = tf.GraphDef()
+        with tf.gfile.GFile(pjoin(bundle_dir, GRAPH_FILE), "rb") as f:
+            graph_def.ParseFromString(f.read())
+
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            tf.import_graph_def(graph_def, name="")
+        self.inputs = dict((name, self.graph.get_tensor_by_name(name + ":0")) for name in meta["inputs"])
+        self.outputs = [self.graph.get_tensor_by_name(name + ":0") for name in OUTPUTS]
+        self.session = tf.Session(graph=self.graph, config=config)
+
+        self.load_time = time.time() - tic
+        logging.info("Loaded inference bundle %s in %.2f secs", bundle_dir, self.load_time)
+
+    def decode(self, session, context_batch, question_batch, answer_span_batch, mask_ctx_batch, mask_q_batch):
+        """
+        :return: padded start and end logits like QASystem.decode
+        """
+        values = {"context_placeholder": context_batch,
+                  "question_placeholder": question_batch,
+                  "mask_ctx_placeholder": mask_ctx_batch,
+                  "mask_q_placeholder": mask_q_batch,
+                  "dropout_placeholder": self.flags.get("dropout", 0.)}
+        # placeholders the logits do not depend on were pruned by the export
+        input_feed = dict((tensor, values[name]) for name, tensor in self.inputs.items())
+        return session.run(self.outputs, input_feed)
@@ -0,0 +1,314 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+import time
+from os.path import join as pjoin
+
+import numpy as np
+from six.moves import xrange  # pylint: disable=redefined-builtin
+
+import logging
+
+logging.basicConfig(level=logging.INFO)
+
+# same bundle layout as inference_bundle, which is not imported so the engine loads without TensorFlow
+VOCAB_FILE = "vocab.dat"
+META_FILE = "bundle.json"
+WEIGHTS_FILE = "weights.npz"
+# int8 weights written by quantize.py are stored with their float32 per-channel scales under name + SCALE_SUFFIX
+SCALE_SUFFIX = "/scale"
+EMBEDDING = "qa/embeddings/embedding"
+
+
+def sigmoid(x):
+    # tanh form, does not overflow for large negative inputs
+    return 0.5 * (1. + np.tanh(0.5 * x))
+
+
+def masked_softmax(scores, mask, axis):
+    """
+    Same as qa_model.masked_softmax, @mask may be None for the unmasked softmax of the
+    original attention cells.
+    """
+    if mask is not None:
+        scores = scores + (-1e30 * (1.0 - mask))
+    scores = np.exp(scores - scores.max(axis=axis, keepdims=True))
+    if mask is not None:
+        scores = scores * mask
+    return scores / (1e-6 + scores.sum(axis=axis, keepdims=True))
+
+
+class NumpyEngine(object):
+    """
+    Forward pass of a trained QASystem in NumPy, for hosts that should not load TensorFlow.
+    Covers the recurrent models (model_type gru / lstm with the basic rnn_backend): the
+    question encoder, the MatchLSTM paragraph encoder, and the rnn or pointer decoder.
+
+    The input-to-hidden part of every RNN step is computed for all timesteps with one
+    matmul before the loop, only the hidden-to-hidden part runs per step, batched over the
+    examples. Padded steps keep the previous state and output zeros like tf.nn.dynamic_rnn.
+
+    decode has the signature of QASystem.decode, so the engine can stand in for a QASystem
+    in qa_answer.generate_answers like an InferenceBundle; there is no session to pass.
+
+    Arguments:
+        -weights: dict of checkpoint variable name to float32 array, with the embedding
+                  matrix under qa/embeddings/embedding. Weights may be int8 with per-channel
+                  scales (see quantize.py): the matrices are dequantized once here, the
+                  embedding matrix stays int8 in memory and is dequantized only for the
+                  looked up rows.
+        -flags: dict of the flags the model was trained with
+    """
+    session = None
+    vocab_path = None
+
+    def __init__(self, weights, flags):
+        if flags["model_type"] not in ("gru", "lstm"):
+            raise Exception('The numpy engine only runs the gru and lstm model types.')
+        if flags.get("rnn_backend", "basic") != "basic":
+            raise Exception('The numpy engine only reads checkpoints of the basic rnn backend.')
+        # numpy has no int8 matmul, x.dot(int8) would convert the matrix on every call
+        self.weights = {}
+        for name, value in weights.items():
+            if value.dtype == np.int8 and name != EMBEDDING:
+                value = value.astype(np.float32) * weights[name + SCALE_SUFFIX]
+            self.weights[name] = value
+        self.flags = flags
+
+    @classmethod
+    def load(cls, bundle_dir):
+        """
+        Loads the numpy bundle export.py writes with --bundle_format=numpy.
+        """
+        tic = time.time()
+        with open(pjoin(bundle_dir, META_FILE)) as f:
+            meta = json.load(f)
+        with np.load(pjoin(bundle_dir, WEIGHTS_FILE)) as data:
+            weights = dict((name, data[name]) for name in data.files)
+        engine = cls(weights, meta["flags"])
+        engine.vocab_path = pjoin(bundle_dir, VOCAB_FILE)
+        engine.load_time = time.time() - tic
+        logging.info("Loaded numpy engine %s in %.2f secs", bundle_dir, engine.load_time)
+        return engine
+
+    def embed(self, ids):
+        embeddings = self.weights[EMBEDDING]
+        if embeddings.dtype == np.int8:
+            # one scale per vocabulary row
+            return embeddings[ids].astype(np.float32) * self.weights[EMBEDDING + SCALE_SUFFIX][ids]
+        return embeddings[ids]
+
+    def linear(self, scope, input_dims):
+        """
+        Splits the Matrix of tf.nn.rnn_cell._linear in @scope by rows into one block per
+        concatenated input, @input_dims are the widths of all inputs but the last one.
+        :return: (list of matrix blocks, bias)
+        """
+        matrix = self.weights[scope + "/Linear/Matrix"]
+        blocks = np.split(matrix, np.cumsum(input_dims), axis=0)
+        return blocks, self.weights[scope + "/Linear/Bias"]
+
+    def rnn(self, inputs, lengths, cell, scope):
+        """
+        Runs @cell ("gru" or "lstm") over @inputs of shape (batch_size, T, dim) like
+        tf.nn.dynamic_rnn with sequence_length=@lengths.
+        :return: outputs of shape (batch_size, T, num_units)
+        """
+        batch_size, T, dim = inputs.shape
+        # time-major so every step reads a contiguous block
+        x = inputs.transpose(1, 0, 2).reshape(T * batch_size, dim)
+
+        if cell == "gru":
+            (gx, gh), gb = self.linear(scope + "/GRUCell/Gates", [dim])
+            (cx, ch), cb = self.linear(scope + "/GRUCell/Candidate", [dim])
+            num_units = ch.shape[0]
+            gates_x = (x.dot(gx) + gb).reshape(T, batch_size, -1)
+            candidate_x = (x.dot(cx) + cb).reshape(T, batch_size, -1)
+        else:
+            (lx, lh), lb = self.linear(scope + "/BasicLSTMCell", [dim])
+            num_units = lh.shape[0]
+            lstm_x = (x.dot(lx) + lb).reshape(T, batch_size, -1)
+            c = np.zeros((batch_size, num_units), dtype=np.float32)
+
+        h = np.zeros((batch_size, num_units), dtype=np.float32)
+        outputs = np.zeros((T, batch_size, num_units), dtype=np.float32)
+        for t in xrange(T):
+            valid = (t < lengths)[:, None]
+            if cell == "gru":
+                r, u = np.split(sigmoid(gates_x[t] + h.dot(gh)), 2, axis=1)
+                candidate = np.tanh(candidate_x[t] + (r * h).dot(ch))
+                new_h = u * h + (1 - u) * candidate
+            else:
+                i, j, f, o = np.split(lstm_x[t] + h.dot(lh), 4, axis=1)
+                new_c = c * sigmoid(f + 1.0) + sigmoid(i) * np.tanh(j)
+                new_h = np.tanh(new_c) * sigmoid(o)
+                c = np.where(valid, new_c, c)
+            h = np.where(valid, new_h, h)
+            outputs[t] = np.where(valid, new_h, 0.)
+        return outputs.transpose(1, 0, 2)
+
+    def match_lstm(self, inputs, lengths, question_states, question_lengths, scope):
+        """
+        MatchLSTMCell (or PrecomputedMatchLSTMCell with attn_precompute, which masks the
+        padded question slots) over the paragraph @inputs.
+        """
+        batch_size, T, dim = inputs.shape
+        cell_scope = scope + "/MatchLSTMCell"
+        W_q = self.weights[cell_scope + "/Attn/W_q"][0]
+        w_score = self.weights[cell_scope + "/w_score"].reshape(-1)
+        num_units = W_q.shape[0]
+        (ax, ah), ab = self.linear(cell_scope + "/Attn", [dim])
+        (lx, lctx, lh), lb = self.linear(cell_scope, [dim, num_units])
+
+        J = question_states.shape[1]
+        mask = None
+        if self.flags.get("attn_precompute"):
+            mask = (np.arange(J)[None, :] < question_lengths[:, None]).astype(np.float32)
+
+        x = inputs.transpose(1, 0, 2).reshape(T * batch_size, dim)
+        par_x = (x.dot(ax) + ab).reshape(T, batch_size, num_units)
+        lstm_x = (x.dot(lx) + lb).reshape(T, batch_size, -1)
+        # shape (batch_size, J, num_units), computed once for all steps
+        ques_attn = question_states.dot(W_q)
+
+        c = np.zeros((batch_size, num_units), dtype=np.float32)
+        h = np.zeros((batch_size, num_units), dtype=np.float32)
+        outputs = np.zeros((T, batch_size, num_units), dtype=np.float32)
+        for t in xrange(T):
+            valid = (t < lengths)[:, None]
+            g = np.tanh(ques_attn + (par_x[t] + h.dot(ah))[:, None, :])
+            weights = masked_softmax(g.dot(w_score), mask, 1)
+            context = np.einsum("bj,bjn->bn", weights, g)
+
+            i, j, f, o = np.split(lstm_x[t] + context.dot(lctx) + h.dot(lh), 4, axis=1)
+            new_c = c * sigmoid(f + 1.0) + sigmoid(i) * np.tanh(j)
+            new_h = np.tanh(new_c) * sigmoid(o)
+            c = np.where(valid, new_c, c)
+            h = np.where(valid, new_h, h)
+            outputs[t] = np.where(valid, new_h, 0.)
+        return outputs.transpose(1, 0, 2)
+
+    def pointer(self, paragraph, mask):
+        def score(states, scope):
+            hidden = np.maximum(states.dot(self.weights[scope + "/W"]) + self.weights[scope + "/b"], 0.)
+            return hidden.dot(self.weights[scope + "/w"])[:, :, 0]
+
+        start = score(paragraph, "qa/decoder/start")
+        start_weights = masked_softmax(start, mask, 1)
+        summary = np.einsum("bt,btd->bd", start_weights, paragraph)[:, None, :]
+        summary = np.broadcast_to(summary, paragraph.shape)
+        end = score(np.concatenate([paragraph, summary, paragraph * summary], axis=2), "qa/decoder/end")
+        return start, end
+
+    def decode(self, session, context_batch, question_batch, answer_span_batch, mask_ctx_batch, mask_q_batch):
+        """
+        Same signature and result as QASystem.decode, @session is ignored.
+        :return: padded start and end logits, shape (batch_size, T)
+        """
+        context_batch = np.asarray(context_batch)
+        question_batch = np.asarray(question_batch)
+        mask_ctx_batch = np.asarray(mask_ctx_batch)
+        mask_q_batch = np.asarray(mask_q_batch)
+        cell = self.flags["model_type"]
+
+        question = self.embed(question_batch)
+        context = self.embed(context_batch)
+
+        question_states = self.rnn(question, mask_q_batch, cell, "qa/question_encoder/RNN")
+        match_states = self.match_lstm(context, mask_ctx_batch, question_states, mask_q_batch,
+                                       "qa/context_encoder/RNN")
+
+        T = context_batch.shape[1]
+        mask = (np.arange(T)[None, :] < mask_ctx_batch[:, None]).astype(np.float32)
+        if self.flags.get("decoder_type", "rnn") == "pointer":
+            start, end = self.pointer(match_states, mask)
+        else:
+            start_states = self.rnn(match_states, mask_ctx_batch, cell, "qa/decoder/start_decoder/RNN")
+            end_states = self.rnn(start_states, mask_ctx_batch, cell, "qa/decoder/end_decoder/RNN")
+            start = (start_states * self.weights["qa/decoder/W_start"]).sum(axis=2)
+            end = (end_states * self.weights["qa/decoder/W_end"]).sum(axis=2)
+
+        add_mask = -1e30 * (1.0 - mask)
+        return start + add_mask, end + add_mask
+
+
+
+def reference_rnn(weights, inputs, lengths, cell, scope, question_states=None, question_lengths=None):
+    """
+    Plain per-example, per-timestep loop of GRUCell, BasicLSTMCell or, with
+    @question_states, MatchLSTMCell attending over the first question_lengths slots,
+    concatenating the inputs of every _linear call like TF does. Used by test_rnn_steps.
+    """
+    def linear(name, args):
+        return np.concatenate(args).dot(weights[name + "/Linear/Matrix"]) + weights[name + "/Linear/Bias"]
+
+    if cell == "gru":
+        num_units = weights[scope + "/GRUCell/Candidate/Linear/Bias"].shape[0]
+    elif question_states is None:
+        num_units = weights[scope + "/BasicLSTMCell/Linear/Bias"].shape[0] // 4
+    else:
+        num_units = weights[scope + "/MatchLSTMCell/Attn/Linear/Bias"].shape[0]
+
+    batch_size, T, _ = inputs.shape
+    outputs = np.zeros((batch_size, T, num_units))
+    for b in range(batch_size):
+        h, c = np.zeros(num_units), np.zeros(num_units)
+        for t in range(lengths[b]):
+            x = inputs[b, t]
+            if cell == "gru":
+                r, u = np.split(sigmoid(linear(scope + "/GRUCell/Gates", [x, h])), 2)
+                candidate = np.tanh(linear(scope + "/GRUCell/Candidate", [x, r * h]))
+                h = u * h + (1 - u) * candidate
+            else:
+                lstm_scope = scope + "/BasicLSTMCell"
+                if question_states is not None:
+                    lstm_scope = scope + "/MatchLSTMCell"
+                    W_q = weights[lstm_scope + "/Attn/W_q"][0]
+                    g = np.tanh(question_states[b, :question_lengths[b]].dot(W_q) +
+                                linear(lstm_scope + "/Attn", [x, h]))
+                    scores = np.exp(g.dot(weights[lstm_scope + "/w_score"].reshape(-1)))
+                    x = np.concatenate([x, (scores / scores.sum()).dot(g)])
+                i, j, f, o = np.split(linear(lstm_scope, [x, h]), 4)
+                c = c * sigmoid(f + 1.0) + sigmoid(i) * np.tanh(j)
+                h = np.tanh(c) * sigmoid(o)
+            outputs[b, t] = h
+    return outputs
+
+
+def test_rnn_steps():
+    rng = np.random.RandomState(0)
+    batch_size, T, J, dim, n = 3, 7, 5, 4, 6
+
+    def random(*shape):
+        return (0.5 * rng.randn(*shape)).astype(np.float32)
+
+    weights = {"g/GRUCell/Gates/Linear/Matrix": random(dim + n, 2 * n), "g/GRUCell/Gates/Linear/Bias": random(2 * n),
+               "g/GRUCell/Candidate/Linear/Matrix": random(dim + n, n), "g/GRUCell/Candidate/Linear/Bias": random(n),
+               "l/BasicLSTMCell/Linear/Matrix": random(dim + n, 4 * n), "l/BasicLSTMCell/Linear/Bias": random(4 * n),
+               "m/MatchLSTMCell/Attn/W_q": random(1, n, n), "m/MatchLSTMCell/w_score": random(n, 1),
+               "m/MatchLSTMCell/Attn/Linear/Matrix": random(dim + n, n), "m/MatchLSTMCell/Attn/Linear/Bias": random(n),
+               "m/MatchLSTMCell/Linear/Matrix": random(dim + 2 * n, 4 * n),
+               "m/MatchLSTMCell/Linear/Bias": random(4 * n)}
+    inputs = random(batch_size, T, dim)
+    # the padded steps of the shorter rows must keep the state and output zeros
+    lengths = np.array([T, 3, 1])
+    question_states = random(batch_size, J, n)
+
+    engine = NumpyEngine(weights, {"model_type": "gru"})
+    for cell, scope in [("gru", "g"), ("lstm", "l")]:
+        expected = reference_rnn(weights, inputs, lengths, cell, scope)
+        assert np.allclose(engine.rnn(inputs, lengths, cell, scope), expected, atol=1e-5)
+
+    # the original cell attends over every question slot, attn_precompute masks the padded ones
+    full = np.full(batch_size, J)
+    expected = reference_rnn(weights, inputs, lengths, "lstm", "m", question_states, full)
+    assert np.allclose(engine.match_lstm(inputs, lengths, question_states, full, "m"), expected, atol=1e-5)
+
+    question_lengths = np.array([J, 2, 4])
+    engine = NumpyEngine(weights, {"model_type": "lstm", "attn_precompute": 1})
+    expected = reference_rnn(weights, inputs, lengths, "lstm", "m", question_states, question_lengths)
+    actual = engine.match_lstm(inputs, lengths, question_states, question_lengths, "m")
+    assert np.allclose(actual, expected, atol=1e-5)
+    assert (actual[1, 3:] == 0).all() and (actual[2, 1:] == 0).all()
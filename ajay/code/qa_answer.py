@@ -7,6 +7,7 @@ import os
 import json
 import sys
 import random
+import time
 from os.path import join as pjoin
 
 from tqdm import tqdm
@@ -14,7 +15,15 @@ import numpy as np
 from six.moves import xrange
 import tensorflow as tf
 
-from qa_model import Encoder, QASystem, Decoder
+from qa_model import build_model
+from inference_bundle import InferenceBundle
+from np_engine import WEIGHTS_FILE, NumpyEngine
+from context_cache import ContextCache
+from cascade import Cascade, calibrate_threshold
+from checkpoint import best_checkpoint
+from evaluate import f1_score, metric_max_over_ground_truths
+from util import command_line_flags, load_model_flags, load_tuned_config, pad_sequences, tuned_model
+from windowing import check_window_flags, window_dataset, merge_window_spans
 from preprocessing.squad_preprocess import data_from_json, maybe_download, squad_base_url, \
     invert_map, tokenize, token_idx_map
 import qa_data
@@ -26,28 +35,58 @@ logging.basicConfig(level=logging.INFO)
 FLAGS = tf.app.flags.FLAGS
 
 tf.app.flags.DEFINE_float("learning_rate", 0.001, "Learning rate.")
+tf.app.flags.DEFINE_float("max_gradient_norm", 10.0, "Clip gradients to this norm.")
 tf.app.flags.DEFINE_float("dropout", 0.15, "Fraction of units randomly dropped on non-recurrent connections.")
-tf.app.flags.DEFINE_integer("batch_size", 10, "Batch size to use during training.")
+tf.app.flags.DEFINE_integer("batch_size", 100, "Batch size to use during inference.")
 tf.app.flags.DEFINE_integer("epochs", 0, "Number of epochs to train.")
-tf.app.flags.DEFINE_integer("state_size", 50, "Size of each model layer.") # 200
+tf.app.flags.DEFINE_integer("state_size", 100, "Size of each model layer.") # 200
 tf.app.flags.DEFINE_integer("embedding_size", 100, "Size of the pretrained vocabulary.")
-tf.app.flags.DEFINE_integer("output_size", 750, "The output size of your model.")
+tf.app.flags.DEFINE_integer("output_size", 766, "The output size of your model.")
 tf.app.flags.DEFINE_integer("keep", 0, "How many checkpoints to keep, 0 indicates keep all.")
 tf.app.flags.DEFINE_string("train_dir", "train", "Training directory (default: ./train).")
 tf.app.flags.DEFINE_string("log_dir", "log", "Path to store log and flag files (default: ./log)")
 tf.app.flags.DEFINE_string("vocab_path", "data/squad/vocab.dat", "Path to vocab file (default: ./data/squad/vocab.dat)")
-tf.app.flags.DEFINE_string("embed_path", "", "Path to the trimmed GLoVe embedding (default: ./data/squad/glove.trimmed.{embedding_size}.npz)")
+tf.app.flags.DEFINE_string("embed_path", "", "Path to the trimmed GLoVe embedding, .npz or memory-mapped .npy (default: ./data/squad/glove.trimmed.{embedding_size}.npz)")
 tf.app.flags.DEFINE_string("dev_path", "data/squad/dev-v1.1.json", "Path to the JSON dev set to evaluate against (default: ./data/squad/dev-v1.1.json)")
 
+# must match the flags the model was trained with
+tf.app.flags.DEFINE_string("model_type", "gru", "specify either gru or lstm cell type for encoding, flow for GRU encoders joined by an attention-flow layer, or conv for convolutional/self-attention encoders and decoder around the attention-flow layer")
+tf.app.flags.DEFINE_integer("debug", 0, "whether to set debug or not")
+tf.app.flags.DEFINE_integer("grad_clip", 1, "whether to clip gradients or not")
+tf.app.flags.DEFINE_integer("window_size", 0, "Split paragraphs into overlapping windows of this many tokens instead of truncating them to output_size, 0 disables windowing.")
+tf.app.flags.DEFINE_integer("doc_stride", 128, "Distance in tokens between the starts of consecutive windows, between 1 and window_size so every token is covered.")
+tf.app.flags.DEFINE_integer("max_answer_len", 15, "Maximum number of tokens in a predicted answer span.")
+tf.app.flags.DEFINE_integer("attn_precompute", 0, "Project the question states once before the context RNN loop instead of at every step, and mask padded question slots in the attention.")
+tf.app.flags.DEFINE_integer("conv_layers", 4, "Number of depthwise-separable convolution blocks per conv encoder.")
+tf.app.flags.DEFINE_integer("conv_kernel", 7, "Width of the conv encoder convolutions.")
+tf.app.flags.DEFINE_integer("conv_self_attention", 1, "Add a self-attention block after the convolutions of the conv encoders.")
+tf.app.flags.DEFINE_string("decoder_type", "rnn", "rnn decodes start and end with two RNN passes over the paragraph, pointer scores them with feed-forward layers")
+tf.app.flags.DEFINE_string("rnn_backend", "basic", "basic (GRUCell / BasicLSTMCell), block (GRUBlockCell / LSTMBlockCell kernels) or fused (block kernels, time-major from embeddings to logits and LSTMBlockFusedCell for attention-free LSTMs). block and fused checkpoints are not interchangeable with basic ones.")
+tf.app.flags.DEFINE_integer("parallel_iterations", 32, "Number of RNN timesteps tf.nn.dynamic_rnn may run in parallel.")
+tf.app.flags.DEFINE_integer("swap_memory", 0, "Let tf.nn.dynamic_rnn swap the activations of the RNN loops to host memory.")
+tf.app.flags.DEFINE_integer("prune_dead", 0, "Do not build the context encoder pass whose output the decoder never uses. Checkpoints of unpruned models load into pruned ones, not the other way round.")
+tf.app.flags.DEFINE_integer("share_encoder", 0, "With the flow and conv model types, encode questions and paragraphs with the same weights in one encoder call, stacked along the batch axis.")
+tf.app.flags.DEFINE_integer("feed_embeddings", 0, "Initialize the frozen embedding matrix from a fed placeholder instead of a graph constant, and leave it out of the checkpoints.")
+tf.app.flags.DEFINE_integer("context_cache_size", 0, "Cache the question-independent encoding of up to this many paragraphs, 0 disables the cache. Only model_type flow or conv without share_encoder encode paragraphs without the question, the cache is disabled for the other models.")
+tf.app.flags.DEFINE_string("bundle_dir", "", "Answer with the inference bundle in this directory instead of building the model and restoring train_dir (export.py writes it, default ./bundle there). Numpy bundles run without a TensorFlow session.")
+tf.app.flags.DEFINE_string("cascade_dir", "", "Answer with the cheaper model trained in this directory (built with its flags.json), or exported to it as a numpy bundle, first, and re-answer only the questions it is unsure about with the train_dir model.")
+tf.app.flags.DEFINE_float("cascade_threshold", 0.3, "Questions whose cheap answer has a joint start / end probability under this are re-answered by the train_dir model.")
+tf.app.flags.DEFINE_float("cascade_max_f1_loss", 0., "If > 0, answer dev_path with both models and set cascade_threshold to escalate as few questions as possible while losing at most this many F1 points against the train_dir model. Calibrate on held-out data, then pass the logged threshold.")
+tf.app.flags.DEFINE_string("autotune_path", "autotune.json", "Per-host settings written by autotune.py. The thread pool sizes, parallel_iterations and batch_size tuned for decoding this model (same model_type, state_size, context length, ...) on this host are used, the flags only when not given on the command line. Empty disables them.")
+
 def initialize_model(session, model, train_dir):
     ckpt = tf.train.get_checkpoint_state(train_dir)
-    v2_path = ckpt.model_checkpoint_path + ".index" if ckpt else ""
-    if ckpt and (tf.gfile.Exists(ckpt.model_checkpoint_path) or tf.gfile.Exists(v2_path)):
-        logging.info("Reading model parameters from %s" % ckpt.model_checkpoint_path)
-        model.saver.restore(session, ckpt.model_checkpoint_path)
+    # answer with the best checkpoint by val F1 rather than the latest one
+    path = best_checkpoint(train_dir) or (ckpt.model_checkpoint_path if ckpt else "")
+    if path and (tf.gfile.Exists(path) or tf.gfile.Exists(path + ".index")):
+        logging.info("Reading model parameters from %s" % path)
+        model.saver.restore(session, path)
+        if model.embedding_placeholder is not None:
+            # not part of the checkpoint
+            session.run(model.embeddings.initializer, model.initializer_feed())
     else:
         logging.info("Created model with fresh parameters.")
-        session.run(tf.global_variables_initializer())
+        session.run(tf.global_variables_initializer(), model.initializer_feed())
         logging.info('Num params: %d' % sum(v.get_shape().num_elements() for v in tf.trainable_variables()))
     return model
 
@@ -72,6 +111,8 @@ def read_dataset(dataset, tier, vocab):
     context_data = []
     query_data = []
     question_uuid_data = []
+    context_text_data = []
+    context_token_data = []
 
     for articles_id in tqdm(range(len(dataset['data'])), desc="Preprocessing {}".format(tier)):
         article_paragraphs = dataset['data'][articles_id]['paragraphs']
@@ -83,6 +124,8 @@ def read_dataset(dataset, tier, vocab):
             context = context.replace("``", '" ')
 
             context_tokens = tokenize(context)
+            # token index -> [token, character offset in context]
+            token_offsets = invert_map(token_idx_map(context, context_tokens))
 
             qas = article_paragraphs[pid]['qas']
             for qid in range(len(qas)):
@@ -96,8 +139,10 @@ def read_dataset(dataset, tier, vocab):
                 context_data.append(' '.join(context_ids))
                 query_data.append(' '.join(qustion_ids))
                 question_uuid_data.append(question_uuid)
+                context_text_data.append((context, token_offsets))
+                context_token_data.append(context_tokens)
 
-    return context_data, query_data, question_uuid_data
+    return context_data, query_data, question_uuid_data, context_text_data, context_token_data
 
 
 def prepare_dev(prefix, dev_filename, vocab):
@@ -105,12 +150,10 @@ def prepare_dev(prefix, dev_filename, vocab):
     dev_dataset = maybe_download(squad_base_url, dev_filename, prefix)
 
     dev_data = data_from_json(os.path.join(prefix, dev_filename))
-    context_data, question_data, question_uuid_data = read_dataset(dev_data, 'dev', vocab)
-
-    return context_data, question_data, question_uuid_data
+    return read_dataset(dev_data, 'dev', vocab)
 
 
-def generate_answers(sess, model, dataset, rev_vocab):
+def generate_answers(sess, model, dataset, rev_vocab, cascade=None):
     """
     Loop over the dev or test dataset and generate answer.
 
@@ -127,13 +170,228 @@ def generate_answers(sess, model, dataset, rev_vocab):
     :param sess: active TF session
     :param model: a built QASystem model
     :param rev_vocab: this is a list of vocabulary that maps index to actual words
+    :param cascade: (Optional) a Cascade whose cheap model answers first, see cascade_spans
     :return:
     """
+    context_data, question_data, question_uuid_data, context_text_data, context_token_data = dataset
+
+    context_ids = [[int(w) for w in ctx.split()] for ctx in context_data]
+    question_ids = [[int(w) for w in q.split()] for q in question_data]
+    num_examples = len(context_ids)
+
+    cache = ContextCache(FLAGS.context_cache_size) if FLAGS.context_cache_size > 0 else None
+
+    tic = time.time()
+    if cascade is not None:
+        a_s, a_e, num_windows, latencies = cascade_spans(sess, model, cascade, context_ids, question_ids, cache=cache)
+    else:
+        a_s, a_e, num_windows, latencies = answer_spans(sess, model, context_ids, question_ids, cache=cache)
+    toc = time.time()
+
+    latencies = np.array(latencies) * 1000
+    logging.info("Answered %d questions (%d windows) in %.2f secs: %.1f examples/sec, "
+                 "per-batch latency mean %.1f ms, p50 %.1f ms, max %.1f ms",
+                 num_examples, num_windows, toc - tic, num_examples / (toc - tic),
+                 latencies.mean(), np.percentile(latencies, 50), latencies.max())
+    if cache is not None:
+        logging.info(str(cache))
+    if cascade is not None:
+        logging.info(str(cascade))
+
     answers = {}
+    for i in xrange(num_examples):
+        answers[question_uuid_data[i]] = span_to_text(context_text_data[i], context_token_data[i], a_s[i], a_e[i])
 
     return answers
 
 
+def answer_spans(sess, model, context_ids, question_ids, progress=True, cache=None, with_confidence=False):
+    """
+    Predicts the answer token span of every (context, question) pair of token ids,
+    windowing or truncating the paragraphs the same way as train.py.
+
+    :param cache: (Optional) a ContextCache, see QASystem.decode_cached
+    :param with_confidence: also return the joint start / end probability of every span
+
+    :return: (a_s, a_e, number of decoded windows, per-batch latencies in secs), with
+             the confidences after a_e if @with_confidence
+    """
+    num_examples = len(context_ids)
+    if FLAGS.window_size > 0:
+        win_context, win_question, _, example_index, offsets = window_dataset(context_ids, question_ids, None,
+                                                                              FLAGS.window_size, FLAGS.doc_stride,
+                                                                              answerable_only=False)
+    else:
+        # same truncation as in train.py
+        win_context = [ctx[:FLAGS.output_size] for ctx in context_ids]
+        win_question = question_ids
+        example_index = list(range(num_examples))
+        offsets = [0] * num_examples
+
+    start_logits, end_logits, latencies = decode_bucketed(sess, model, win_context, win_question, FLAGS.batch_size,
+                                                          progress=progress, cache=cache)
+    if with_confidence:
+        a_s, a_e, confidence = merge_window_spans(start_logits, end_logits, example_index, offsets, num_examples,
+                                                  FLAGS.max_answer_len, with_confidence=True)
+        return a_s, a_e, confidence, len(win_context), latencies
+    a_s, a_e = merge_window_spans(start_logits, end_logits, example_index, offsets, num_examples, FLAGS.max_answer_len)
+    return a_s, a_e, len(win_context), latencies
+
+
+def cascade_spans(sess, model, cascade, context_ids, question_ids, progress=True, cache=None):
+    """
+    Same as answer_spans, but the cheap model of @cascade answers every question first and
+    only the questions answered with a confidence under cascade.threshold are batched and
+    re-answered by @model.
+    """
+    tic = time.time()
+    a_s, a_e, confidence, num_windows, latencies = answer_spans(cascade.session, cascade.model, context_ids,
+                                                                question_ids, progress=progress, with_confidence=True)
+    cascade.cheap_time += time.time() - tic
+
+    escalate = np.flatnonzero(confidence < cascade.threshold)
+    cascade.questions += len(context_ids)
+    cascade.escalated += len(escalate)
+    if len(escalate):
+        tic = time.time()
+        e_s, e_e, e_windows, e_latencies = answer_spans(sess, model, [context_ids[i] for i in escalate],
+                                                        [question_ids[i] for i in escalate], progress=progress,
+                                                        cache=cache)
+        cascade.expensive_time += time.time() - tic
+        a_s[escalate] = e_s
+        a_e[escalate] = e_e
+        num_windows += e_windows
+        latencies += e_latencies
+    return a_s, a_e, num_windows, latencies
+
+
+def apply_tuned_config():
+    """
+    Takes over the parallel_iterations and batch_size autotune.py found fastest for
+    decoding this model on this host, except the ones given on the command line.
+    :return: a ConfigProto with the tuned thread pool sizes, None (TF defaults) when untuned
+    """
+    tuned = load_tuned_config(FLAGS.autotune_path, "decode", tuned_model(FLAGS))
+    if not tuned:
+        return None
+    logging.info("Using the decoding settings tuned for this host in %s: %s", FLAGS.autotune_path, tuned)
+    given = command_line_flags()
+    for name in ["parallel_iterations", "batch_size"]:
+        if name not in given:
+            setattr(FLAGS, name, tuned[name])
+    return tf.ConfigProto(intra_op_parallelism_threads=tuned["intra_op_threads"],
+                          inter_op_parallelism_threads=tuned["inter_op_threads"])
+
+
+def load_cascade(embeddings, max_q_len, config=None):
+    """
+    Builds the cheap model of FLAGS.cascade_dir in its own graph and session, with the
+    flags it was trained with (paragraphs are still windowed by the qa_answer flags).
+    A numpy bundle (export.py --bundle_format=numpy) in FLAGS.cascade_dir is loaded as a
+    NumpyEngine instead, without a session.
+    """
+    if os.path.exists(pjoin(FLAGS.cascade_dir, WEIGHTS_FILE)):
+        return Cascade(None, NumpyEngine.load(FLAGS.cascade_dir), FLAGS.cascade_threshold)
+    flags = load_model_flags(FLAGS.cascade_dir, FLAGS.__flags)
+    with tf.Graph().as_default() as graph:
+        model = build_model(flags, embeddings, FLAGS.window_size or FLAGS.output_size, max_q_len, training=False)
+        sess = tf.Session(graph=graph, config=config)
+        initialize_model(sess, model, get_normalized_train_dir(FLAGS.cascade_dir))
+    return Cascade(sess, model, FLAGS.cascade_threshold)
+
+
+def calibrate_cascade(sess, model, cascade, dataset, dev_data):
+    """
+    Answers @dataset with both models of the cascade and sets cascade.threshold with
+    cascade.calibrate_threshold for at most FLAGS.cascade_max_f1_loss F1 points lost.
+    """
+    context_data, question_data, question_uuid_data, context_text_data, context_token_data = dataset
+    context_ids = [[int(w) for w in ctx.split()] for ctx in context_data]
+    question_ids = [[int(w) for w in q.split()] for q in question_data]
+    ground_truths = dict((qa['id'], [answer['text'] for answer in qa['answers']])
+                         for article in dev_data for paragraph in article['paragraphs'] for qa in paragraph['qas'])
+
+    def per_question_f1(a_s, a_e):
+        return [metric_max_over_ground_truths(f1_score, span_to_text(context_text_data[i], context_token_data[i],
+                                                                     a_s[i], a_e[i]),
+                                              ground_truths[question_uuid_data[i]])
+                for i in xrange(len(context_ids))]
+
+    c_s, c_e, confidence, _, _ = answer_spans(cascade.session, cascade.model, context_ids, question_ids,
+                                              with_confidence=True)
+    e_s, e_e, _, _ = answer_spans(sess, model, context_ids, question_ids)
+    cheap_f1, expensive_f1 = per_question_f1(c_s, c_e), per_question_f1(e_s, e_e)
+
+    cascade.threshold, escalated, f1 = calibrate_threshold(confidence, cheap_f1, expensive_f1,
+                                                           FLAGS.cascade_max_f1_loss)
+    logging.info("Cascade calibrated on %d questions: F1 cheap %.2f, expensive %.2f, cascade %.2f with "
+                 "--cascade_threshold=%.4f escalating %.1f%%", len(context_ids), 100 * np.mean(cheap_f1),
+                 100 * np.mean(expensive_f1), f1, cascade.threshold, 100 * escalated)
+
+
+def decode_bucketed(sess, model, context_ids, question_ids, batch_size, progress=True, cache=None):
+    """
+    Runs model.decode over all examples in large minibatches. Examples are sorted by
+    context length first so every minibatch is padded to a similar width (one bucket per
+    minibatch), then the logits are returned in the original order.
+
+    :param cache: (Optional) decode through model.decode_cached with this ContextCache
+    :return: (start logits, end logits, per-batch latencies in secs), logits are unpadded
+             1-d arrays, one per example
+    """
+    # questions on the same paragraph end up next to each other, which keeps the cache warm
+    order = sorted(xrange(len(context_ids)), key=lambda i: (len(context_ids[i]), context_ids[i]))
+    start_logits = [None] * len(context_ids)
+    end_logits = [None] * len(context_ids)
+    latencies = []
+
+    for batch_start in tqdm(xrange(0, len(order), batch_size), desc="Decoding", disable=not progress):
+        batch = order[batch_start:batch_start + batch_size]
+        ctx_batch, mask_ctx_batch = pad_sequences([context_ids[i] for i in batch])
+        q_batch, mask_q_batch = pad_sequences([question_ids[i] for i in batch])
+
+        tic = time.time()
+        if cache is not None:
+            yp, yp2 = model.decode_cached(sess, cache, [context_ids[i] for i in batch], [question_ids[i] for i in batch])
+        else:
+            yp, yp2 = model.decode(sess, ctx_batch, q_batch, None, mask_ctx_batch, mask_q_batch)
+        latencies.append(time.time() - tic)
+
+        for j, i in enumerate(batch):
+            start_logits[i] = yp[j, :mask_ctx_batch[j]]
+            end_logits[i] = yp2[j, :mask_ctx_batch[j]]
+
+    return start_logits, end_logits, latencies
+
+
+def span_to_text(context_text, context_tokens, a_s, a_e):
+    """
+    Maps a token span back to the original paragraph text using the character offsets
+    of the tokens, falls back to joining the tokens when a token could not be aligned.
+    """
+    context, token_offsets = context_text
+    if a_e < a_s:
+        a_s, a_e = a_e, a_s
+    if a_s in token_offsets and a_e in token_offsets:
+        end_token, end_char = token_offsets[a_e]
+        return context[token_offsets[a_s][1]:end_char + len(end_token)]
+    return ' '.join(context_tokens[a_s:a_e + 1])
+
+
+def build_qa_system(embeddings, max_q_len):
+    return build_model(FLAGS, embeddings, FLAGS.window_size or FLAGS.output_size, max_q_len, training=False)
+
+
+def initialize_embeddings(embed_path):
+    if not tf.gfile.Exists(embed_path):
+        raise ValueError("Embeddings file %s not found.", embed_path)
+    if embed_path.endswith(".npy"):
+        # memory-mapped, pages are only read when the matrix is copied into the graph
+        return np.load(embed_path, mmap_mode='r')
+    embeddings = np.load(embed_path)
+    return embeddings['glove']
+
+
 def get_normalized_train_dir(train_dir):
     """
     Adds symlink to {train_dir} from /tmp/cs224n-squad-train to canonicalize the
@@ -150,9 +408,42 @@ def get_normalized_train_dir(train_dir):
     return global_train_dir
 
 
+def load_bundle(bundle_dir, config=None):
+    """
+    Loads an exported InferenceBundle (in a session with @config), or a NumpyEngine for
+    bundles exported with --bundle_format=numpy, and takes over the flags it was exported
+    with, so paragraphs are windowed and decoded like the model expects.
+    """
+    if os.path.exists(pjoin(bundle_dir, WEIGHTS_FILE)):
+        bundle = NumpyEngine.load(bundle_dir)
+    else:
+        bundle = InferenceBundle(bundle_dir, config)
+    for name, value in bundle.flags.items():
+        setattr(FLAGS, name, value)
+    if FLAGS.context_cache_size > 0:
+        logging.info("The context cache needs the model graph, disabled with an inference bundle")
+        FLAGS.context_cache_size = 0
+    return bundle
+
+
+def check_context_cache():
+    """
+    Disables the context cache for the models whose paragraph encoding depends on the
+    question (the gru/lstm ones attend over it, share_encoder encodes both in one call),
+    where it would only save the embedding lookup.
+    """
+    if FLAGS.context_cache_size > 0 and (FLAGS.model_type not in ("flow", "conv") or FLAGS.share_encoder):
+        logging.info("The context cache only saves work for model_type flow or conv without share_encoder, disabled")
+        FLAGS.context_cache_size = 0
+
+
 def main(_):
 
-    vocab, rev_vocab = initialize_vocab(FLAGS.vocab_path)
+    config = apply_tuned_config()
+    bundle = load_bundle(FLAGS.bundle_dir, config) if FLAGS.bundle_dir else None
+    check_window_flags(FLAGS.window_size, FLAGS.doc_stride)
+    check_context_cache()
+    vocab, rev_vocab = initialize_vocab(bundle.vocab_path if bundle else FLAGS.vocab_path)
 
     embed_path = FLAGS.embed_path or pjoin("data", "squad", "glove.trimmed.{}.npz".format(FLAGS.embedding_size))
 
@@ -170,21 +461,30 @@ def main(_):
 
     dev_dirname = os.path.dirname(os.path.abspath(FLAGS.dev_path))
     dev_filename = os.path.basename(FLAGS.dev_path)
-    context_data, question_data, question_uuid_data = prepare_dev(dev_dirname, dev_filename, vocab)
-    dataset = (context_data, question_data, question_uuid_data)
+    dataset = prepare_dev(dev_dirname, dev_filename, vocab)
+
+    if bundle is not None:
+        answers = generate_answers(bundle.session, bundle, dataset, rev_vocab)
+        with io.open('dev-prediction.json', 'w', encoding='utf-8') as f:
+            f.write(unicode(json.dumps(answers, ensure_ascii=False)))
+        return
 
     # ========= Model-specific =========
     # You must change the following code to adjust to your model
 
-    encoder = Encoder(size=FLAGS.state_size, vocab_dim=FLAGS.embedding_size)
-    decoder = Decoder(output_size=FLAGS.output_size)
+    embeddings = initialize_embeddings(embed_path)
+    max_q_len = max(len(q.split()) for q in dataset[1])
+
+    cascade = load_cascade(embeddings, max_q_len, config) if FLAGS.cascade_dir else None
 
-    qa = QASystem(encoder, decoder)
+    qa = build_qa_system(embeddings, max_q_len)
 
-    with tf.Session() as sess:
+    with tf.Session(config=config) as sess:
         train_dir = get_normalized_train_dir(FLAGS.train_dir)
         initialize_model(sess, qa, train_dir)
-        answers = generate_answers(sess, qa, dataset, rev_vocab)
+        if cascade is not None and FLAGS.cascade_max_f1_loss > 0:
+            calibrate_cascade(sess, qa, cascade, dataset, data_from_json(FLAGS.dev_path)['data'])
+        answers = generate_answers(sess, qa, dataset, rev_vocab, cascade=cascade)
 
         # write to json file to root dir
         with io.open('dev-prediction.json', 'w', encoding='utf-8') as f:
@@ -35,6 +35,9 @@ def setup_args():
     parser.add_argument("--vocab_dir", default=vocab_dir)
     parser.add_argument("--glove_dim", default=100, type=int)
     parser.add_argument("--random_init", default=True, type=bool)
+    parser.add_argument("--glove_format", default="npz", choices=["npz", "npy"],
+                        help="npz writes a compressed archive, npy an uncompressed array that can be memory-mapped")
+    parser.add_argument("--glove_dtype", default="float32", choices=["float32", "float16"])
     return parser.parse_args()
 
 
@@ -63,12 +66,14 @@ def process_glove(args, vocab_list, save_path, size=4e5, random_init=True):
     :param vocab_list: [vocab]
     :return:
     """
-    if not gfile.Exists(save_path + ".npz"):
+    glove_format = getattr(args, "glove_format", "npz")
+    dtype = np.dtype(getattr(args, "glove_dtype", "float32"))
+    if not gfile.Exists(save_path + "." + glove_format):
         glove_path = os.path.join(args.glove_dir, "glove.6B.{}d.txt".format(args.glove_dim))
         if random_init:
-            glove = np.random.randn(len(vocab_list), args.glove_dim)
+            glove = np.random.randn(len(vocab_list), args.glove_dim).astype(dtype)
         else:
-            glove = np.zeros((len(vocab_list), args.glove_dim))
+            glove = np.zeros((len(vocab_list), args.glove_dim), dtype=dtype)
         found = 0
         with open(glove_path, 'r') as fh:
             for line in tqdm(fh, total=size):
@@ -89,8 +94,12 @@ def process_glove(args, vocab_list, save_path, size=4e5, random_init=True):
                     found += 1
 
         print("{}/{} of word vocab have corresponding vectors in {}".format(found, len(vocab_list), glove_path))
-        np.savez_compressed(save_path, glove=glove)
-        print("saved trimmed glove matrix at: {}".format(save_path))
+        if glove_format == "npy":
+            # uncompressed, so train.py / qa_answer.py can memory-map it instead of decompressing it
+            np.save(save_path + ".npy", glove)
+        else:
+            np.savez_compressed(save_path, glove=glove)
+        print("saved trimmed glove matrix at: {}.{}".format(save_path, glove_format))
 
 
 def create_vocabulary(vocabulary_path, data_paths, tokenizer=None):
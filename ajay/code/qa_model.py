@@ -4,13 +4,18 @@ from __future__ import print_function
 
 import time
 import logging
+from collections import OrderedDict
 
 import numpy as np
 from six.moves import xrange  # pylint: disable=redefined-builtin
 import tensorflow as tf
 from tensorflow.python.ops import variable_scope as vs
+from tensorflow.python.util import nest
 
-from util import Progbar, minibatches
+from checkpoint import CheckpointManager
+from util import Progbar, minibatches, pad_sequences
+from windowing import window_dataset, merge_window_spans
+from span_decoder import best_spans, top_k_spans
 
 from evaluate import exact_match_score, f1_score
 
@@ -198,17 +203,400 @@ class MatchLSTMCell(tf.nn.rnn_cell.BasicLSTMCell):
         return (lstm_out, lstm_state)
 
 
+def average_gradients(tower_grads):
+    """
+    Averages the (gradient, variable) lists returned by compute_gradients for every tower,
+    variables without a gradient in the towers are left out.
+    """
+    averaged = []
+    for grads_and_vars in zip(*tower_grads):
+        grads = [grad for grad, _ in grads_and_vars if grad is not None]
+        if grads:
+            averaged.append((tf.add_n(grads) / len(grads), grads_and_vars[0][1]))
+    return averaged
+
+
+def sample_indices(num_examples, sample, indices=None):
+    """
+    Rows an evaluation looks at: @indices when given, all @num_examples rows when @sample is
+    None, else @sample distinct random rows (all of them when there are fewer).
+    """
+    if indices is not None:
+        return np.asarray(indices)
+    if sample is None or sample >= num_examples:
+        return np.arange(num_examples)
+    return np.random.choice(num_examples, sample, replace=False)
+
+
+def add_gradients(a, b):
+    # sum of two gradients of the same variable, either of which may be None
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return tf.convert_to_tensor(a) + tf.convert_to_tensor(b)
+
+
+class SegmentRecompute(object):
+    """
+    Runs an RNN over the time axis of @inputs as @num_segments consecutive tf.nn.dynamic_rnn
+    segments, each started from the final state of the previous one, and keeps only those
+    segment-boundary states for backprop instead of the activations of every timestep.
+
+    The outputs and final state do not carry gradients: the forward segments are never
+    differentiated, so TF keeps none of their per-step activations. gradients() instead
+    rebuilds the forward pass of every segment inside the backward pass, last segment first,
+    and backpropagates through that copy. Each rebuilt segment waits for the gradients of
+    its outputs and final state, so only one segment's activations are live at a time, at
+    the cost of running the forward pass twice.
+
+    Arguments:
+        -segment_fn: (inputs, lengths, initial_state, attention_inputs) -> (outputs,
+                     final_state) of one batch-major segment; called under the variable
+                     scope of the constructor, with reuse after the first call
+        -inputs: (batch_size, T, dim)
+        -lengths: sequence lengths of @inputs
+        -initial_state: initial state of the first segment, None for the zero state
+        -attention_inputs: (Optional) tensor @segment_fn attends over
+    """
+    def __init__(self, segment_fn, inputs, lengths, initial_state, attention_inputs, num_segments):
+        self.segment_fn = segment_fn
+        self.inputs = inputs
+        self.initial_state = initial_state
+        self.attention_inputs = attention_inputs
+        self.num_segments = num_segments
+        self.scope = tf.get_variable_scope()
+
+        # pad T to a multiple of the segment length, so no segment is empty; the padding
+        # is past every sequence length
+        self.max_len = tf.shape(inputs)[1]
+        self.segment_len = (self.max_len + num_segments - 1) // num_segments
+        self.paddings = tf.reshape(tf.pack([0, 0, 0, num_segments * self.segment_len - self.max_len, 0, 0]), [3, 2])
+        self.padded_inputs = self.pad(inputs)
+        self.lengths = [tf.clip_by_value(lengths - k * self.segment_len, 0, self.segment_len)
+                        for k in xrange(num_segments)]
+
+        state = initial_state
+        self.boundaries, outputs = [], []
+        for k in xrange(num_segments):
+            self.boundaries.append(state)
+            with vs.variable_scope(self.scope, reuse=True if k > 0 else None):
+                segment_outputs, state = segment_fn(self.segment(self.padded_inputs, k), self.lengths[k], state,
+                                                    attention_inputs)
+            outputs.append(segment_outputs)
+
+        self.final_state = nest.pack_sequence_as(state, [tf.stop_gradient(s) for s in nest.flatten(state)])
+        self.outputs = tf.stop_gradient(tf.slice(tf.concat(1, outputs), [0, 0, 0], tf.pack([-1, self.max_len, -1])))
+        self.outputs.set_shape([None, None, outputs[0].get_shape()[2].value])
+
+    def pad(self, tensor):
+        # pads the time axis of a (batch_size, T, dim) tensor to num_segments * segment_len
+        padded = tf.pad(tensor, self.paddings)
+        padded.set_shape([None, None, tensor.get_shape()[2].value])
+        return padded
+
+    def segment(self, padded, k):
+        # time steps of segment @k of a padded (batch_size, T, dim) tensor
+        segment = tf.slice(padded, tf.pack([0, k * self.segment_len, 0]), tf.pack([-1, self.segment_len, -1]))
+        segment.set_shape([None, None, padded.get_shape()[2].value])
+        return segment
+
+    def gradients(self, loss, variables):
+        """
+        Gradients of @loss with respect to @variables along the paths through this layer,
+        which tf.gradients does not see: through the recomputed segments to their
+        variables, and on to the variables @inputs, @attention_inputs and @initial_state
+        depend on.
+        :return: list aligned with @variables (None for unconnected ones), or None when
+                 @loss does not depend on this layer
+        """
+        final_state = nest.flatten(self.final_state)
+        grads = tf.gradients(loss, [self.outputs] + final_state)
+        if all(g is None for g in grads):
+            return None
+        g_outputs = grads[0] if grads[0] is not None else tf.zeros_like(self.outputs)
+        g_state = [g if g is not None else tf.zeros_like(s) for g, s in zip(grads[1:], final_state)]
+        g_outputs = self.pad(g_outputs)
+
+        total = [None] * len(variables)
+        g_inputs = [None] * self.num_segments
+        g_attention = None
+        for k in reversed(xrange(self.num_segments)):
+            g_segment = self.segment(g_outputs, k)
+            # nothing of the rebuilt segment runs before its gradients are known
+            with tf.control_dependencies([g_segment] + g_state):
+                inputs = tf.identity(self.segment(self.padded_inputs, k))
+                attention_inputs = None
+                if self.attention_inputs is not None:
+                    attention_inputs = tf.identity(self.attention_inputs)
+                boundary = self.boundaries[k]
+                if boundary is not None:
+                    boundary = nest.pack_sequence_as(boundary, [tf.identity(s) for s in nest.flatten(boundary)])
+            with vs.variable_scope(self.scope, reuse=True):
+                outputs, state = self.segment_fn(inputs, self.lengths[k], boundary, attention_inputs)
+
+            sources = [inputs] + ([attention_inputs] if attention_inputs is not None else [])
+            boundary_states = nest.flatten(boundary) if boundary is not None else []
+            grads = tf.gradients([outputs] + nest.flatten(state), sources + boundary_states + list(variables),
+                                 grad_ys=[g_segment] + g_state)
+            g_inputs[k] = grads[0]
+            if attention_inputs is not None:
+                g_attention = add_gradients(g_attention, grads[1])
+            g_state = [g if g is not None else tf.zeros_like(s)
+                       for g, s in zip(grads[len(sources):len(sources) + len(boundary_states)], boundary_states)]
+            for i, g in enumerate(grads[len(sources) + len(boundary_states):]):
+                total[i] = add_gradients(total[i], g)
+
+        # on to the variables the inputs of the layer depend on
+        g_inputs = [g if g is not None else tf.zeros_like(self.segment(self.padded_inputs, k))
+                    for k, g in enumerate(g_inputs)]
+        ys = [self.inputs]
+        grad_ys = [tf.slice(tf.concat(1, g_inputs), [0, 0, 0], tf.pack([-1, self.max_len, -1]))]
+        if g_attention is not None:
+            ys.append(self.attention_inputs)
+            grad_ys.append(g_attention)
+        if self.initial_state is not None:
+            ys += nest.flatten(self.initial_state)
+            grad_ys += g_state
+        for i, g in enumerate(tf.gradients(ys, list(variables), grad_ys=grad_ys)):
+            total[i] = add_gradients(total[i], g)
+        return total
+
+
+def attention_mask(lengths, maxlen):
+    """
+    Returns a float mask of shape (batch_size, maxlen, 1) that is 1 on the first
+    @lengths slots of every row and 0 on the padding.
+    """
+    return tf.expand_dims(tf.cast(tf.sequence_mask(lengths, maxlen=maxlen), tf.float32), 2)
+
+
+def masked_softmax(scores, mask, dim):
+    """
+    Softmax of @scores along @dim that gives zero weight to the slots where @mask is 0.
+    """
+    scores = scores + (-1e30 * (1.0 - mask))
+    scores = tf.exp(scores - tf.reduce_max(scores, reduction_indices=dim, keep_dims=True)) * mask
+    return scores / (1e-6 + tf.reduce_sum(scores, reduction_indices=dim, keep_dims=True))
+
+
+def layer_norm(inputs, epsilon=1e-6, scope="LayerNorm"):
+    """
+    Normalizes @inputs over its last dimension, with a learned gain and bias.
+    """
+    dim = inputs.get_shape()[-1].value
+    with vs.variable_scope(scope):
+        gain = tf.get_variable("gain", shape=(dim,), initializer=tf.constant_initializer(1.0))
+        bias = tf.get_variable("bias", shape=(dim,), initializer=tf.constant_initializer(0.0))
+        mean, variance = tf.nn.moments(inputs, [inputs.get_shape().ndims - 1], keep_dims=True)
+        return (inputs - mean) * tf.rsqrt(variance + epsilon) * gain + bias
+
+
+def _get_cell_variable(path, name, shape, initializer=None):
+    """
+    Creates variable @name under the nested variable scopes of @path, e.g.
+    "RNN/GRUAttnCell/Attn/Linear". The precomputed attention cells create their memory
+    projection weights before tf.nn.dynamic_rnn enters its loop, under the same names the
+    in-loop cells use, so checkpoints of either kind load into both.
+    """
+    if not path:
+        return tf.get_variable(name, shape=shape, initializer=initializer)
+    head, _, rest = path.partition("/")
+    with vs.variable_scope(head):
+        return _get_cell_variable(rest, name, shape, initializer)
+
+
+class PrecomputedAttention(object):
+    """
+    Dot-product attention of GRUAttnCell / LSTMAttnCell with the memory side projected
+    once, before the RNN loop: hs.T * (W * ht + b) = (hs * W.T) * ht + hs.T * b. Every step
+    then only does a batched dot product with the projected memory, and padded question
+    slots get no attention weight.
+
+    Arguments:
+        -num_units: hidden state dimensions
+        -encoder_output: hidden states to compute attention over
+        -encoder_lengths: number of valid slots in each row of @encoder_output
+        -rnn_scope: variable scope the cell runs in, relative to the encoder scope
+    """
+    base_name = None
+
+    def setup_attention(self, num_units, encoder_output, encoder_lengths, rnn_scope):
+        # attn_states is shape (batch_size, N, hid_dim)
+        self.attn_states = encoder_output
+        self.attn_mask = attention_mask(encoder_lengths, tf.shape(encoder_output)[1])
+
+        path = rnn_scope + "/" + self.base_name + "/Attn/Linear"
+        W_score = _get_cell_variable(path, "Matrix", (num_units, num_units))
+        b_score = _get_cell_variable(path, "Bias", (num_units,), tf.constant_initializer(1.0))
+
+        hid_dim = encoder_output.get_shape()[2].value
+        flat_states = tf.reshape(encoder_output, [-1, hid_dim])
+        batch_size = tf.shape(encoder_output)[0]
+        # shapes (batch_size, N, num_units) and (batch_size, N, 1)
+        self.proj_states = tf.reshape(tf.matmul(flat_states, W_score, transpose_b=True),
+                                      tf.pack([batch_size, -1, num_units]))
+        self.proj_bias = tf.reshape(tf.matmul(flat_states, tf.expand_dims(b_score, 1)),
+                                    tf.pack([batch_size, -1, 1]))
+
+    def attend(self, cell_out):
+        # scores is shape (batch_size, N, 1)
+        scores = tf.batch_matmul(self.proj_states, tf.expand_dims(cell_out, 2)) + self.proj_bias
+        scores = masked_softmax(scores, self.attn_mask, 1)
+
+        # context is shape (batch_size, hid_dim)
+        context = tf.squeeze(tf.batch_matmul(scores, self.attn_states, adj_x=True), [1])
+
+        with vs.variable_scope("AttnConcat"):
+            return tf.nn.tanh(tf.nn.rnn_cell._linear([context, cell_out], self._num_units, True, 1.0))
+
+
+class PrecomputedGRUAttnCell(PrecomputedAttention, tf.nn.rnn_cell.GRUCell):
+    base_name = "GRUAttnCell"
+
+    def __init__(self, num_units, encoder_output, encoder_lengths, rnn_scope="RNN"):
+        tf.nn.rnn_cell.GRUCell.__init__(self, num_units)
+        self.setup_attention(num_units, encoder_output, encoder_lengths, rnn_scope)
+
+    def __call__(self, inputs, state, scope=None):
+        scope = scope or self.base_name
+        gru_out, gru_state = tf.nn.rnn_cell.GRUCell.__call__(self, inputs, state, scope)
+        with vs.variable_scope(scope):
+            return (self.attend(gru_out), gru_state)
+
+
+class PrecomputedLSTMAttnCell(PrecomputedAttention, tf.nn.rnn_cell.BasicLSTMCell):
+    base_name = "LSTMAttnCell"
+
+    def __init__(self, num_units, encoder_output, encoder_lengths, rnn_scope="RNN"):
+        tf.nn.rnn_cell.BasicLSTMCell.__init__(self, num_units)
+        self.setup_attention(num_units, encoder_output, encoder_lengths, rnn_scope)
+
+    def __call__(self, inputs, state, scope=None):
+        scope = scope or self.base_name
+        lstm_out, lstm_state = tf.nn.rnn_cell.BasicLSTMCell.__call__(self, inputs, state, scope)
+        with vs.variable_scope(scope):
+            return (self.attend(lstm_out), lstm_state)
+
+
+class PrecomputedMatchLSTMCell(tf.nn.rnn_cell.BasicLSTMCell):
+    """
+    MatchLSTMCell with the question projection W_q * hq computed once before the RNN
+    loop instead of tiling W_q and running a batch_matmul at every paragraph step.
+    Padded question slots get no attention weight.
+
+    Arguments:
+        -num_units: hidden state dimensions
+        -encoder_output: question encodings, shape (batch_size, Nq, num_units)
+        -encoder_lengths: question lengths
+        -rnn_scope: variable scope the cell runs in, relative to the encoder scope
+    """
+    base_name = "MatchLSTMCell"
+
+    def __init__(self, num_units, encoder_output, encoder_lengths, rnn_scope="RNN"):
+        super(PrecomputedMatchLSTMCell, self).__init__(num_units)
+        self.attn_mask = attention_mask(encoder_lengths, tf.shape(encoder_output)[1])
+
+        W_q = _get_cell_variable(rnn_scope + "/" + self.base_name + "/Attn", "W_q", (1, num_units, num_units),
+                                 tf.contrib.layers.xavier_initializer())
+        flat_states = tf.reshape(encoder_output, [-1, num_units])
+        # shape (batch_size, Nq, num_units)
+        self.ques_attn = tf.reshape(tf.matmul(flat_states, tf.reshape(W_q, [num_units, num_units])),
+                                    tf.pack([tf.shape(encoder_output)[0], -1, num_units]))
+
+    # note: inputs should be paragraph encodings
+    def __call__(self, inputs, state, scope=None):
+        scope = scope or self.base_name
+        with vs.variable_scope(scope):
+
+            with vs.variable_scope("Attn"):
+                par_attn = tf.nn.rnn_cell._linear([inputs, state[-1]], self._num_units, True, 1.0)
+
+                # use expand_dims with broadcasting, this is shape [?, 1, hidden_size] now
+                g_i = tf.nn.tanh(self.ques_attn + tf.expand_dims(par_attn, 1))
+
+            w_score = tf.get_variable("w_score", shape=(1, 1, self._num_units),
+                                      initializer=tf.contrib.layers.xavier_initializer())
+            scores = tf.reduce_sum(g_i * w_score, reduction_indices=2, keep_dims=True)
+            scores = masked_softmax(scores, self.attn_mask, 1)
+
+            # context is shape (batch_size, hid_dim)
+            context = tf.squeeze(tf.batch_matmul(scores, g_i, adj_x=True), [1])
+
+            z = tf.concat(1, [inputs, context])
+
+        lstm_out, lstm_state = super(PrecomputedMatchLSTMCell, self).__call__(z, state, scope)
+        return (lstm_out, lstm_state)
+
+
 class Encoder(object):
     """
     Arguments:
         -size: dimension of the hidden states
         -vocab_dim: dimension of the embeddings
+        -conv_layers: number of convolution blocks of the "conv" model type
+        -conv_kernel: width of their convolutions
+        -conv_self_attention: add a self-attention block after the convolutions
+        -rnn_backend: "basic" uses the GRUCell / BasicLSTMCell graphs, "block" the fused
+                      per-step GRUBlockCell / LSTMBlockCell kernels, "fused" additionally
+                      runs attention-free LSTMs as one LSTMBlockFusedCell op over all steps
+        -parallel_iterations, swap_memory: passed on to tf.nn.dynamic_rnn
+        -recompute_segments: if > 0, run unidirectional RNNs as SegmentRecompute layers of
+                             this many segments, see QASystem.compute_gradients
     """
-    def __init__(self, size, name):
+    def __init__(self, size, name, conv_layers=4, conv_kernel=7, conv_self_attention=True, rnn_backend="basic",
+                 parallel_iterations=32, swap_memory=False, recompute_segments=0):
         self.size = size
         self.name = name
+        self.conv_layers = conv_layers
+        self.conv_kernel = conv_kernel
+        self.conv_self_attention = conv_self_attention
+        self.rnn_backend = rnn_backend
+        self.parallel_iterations = parallel_iterations
+        self.swap_memory = swap_memory
+        self.recompute_segments = recompute_segments
+        self.recomputed = []
+
+    def cell(self, model_type):
+        """
+        Attention-free RNN cell of @model_type for the configured backend.
+        """
+        if model_type == "gru":
+            if self.rnn_backend == "basic":
+                return tf.nn.rnn_cell.GRUCell(self.size)
+            return tf.contrib.rnn.GRUBlockCell(self.size)
+        elif model_type == "lstm":
+            if self.rnn_backend == "basic":
+                return tf.nn.rnn_cell.BasicLSTMCell(self.size)
+            return tf.contrib.rnn.LSTMBlockCell(self.size)
+        else:
+            raise Exception('Must specify model type.')
 
-    def encode(self, inputs, masks, encoder_state_input=None, attention_inputs=None, model_type="gru", bidir=True):
+    def unidirectional_cell(self, model_type, attention_inputs=None, attention_lengths=None,
+                            precompute_attention=False):
+        """
+        Cell of a unidirectional encode call, see encode for the arguments.
+        """
+        if attention_inputs is None:
+            return self.cell(model_type)
+        if precompute_attention:
+            cell_types = {"gru": PrecomputedGRUAttnCell,
+                          "lstm": PrecomputedLSTMAttnCell,
+                          "match": PrecomputedMatchLSTMCell}
+            if model_type not in cell_types:
+                raise Exception('Must specify model type.')
+            return cell_types[model_type](self.size, attention_inputs, attention_lengths)
+        # use an attention cell - each cell uses attention to compute context
+        # over the @attention_inputs
+        cell_types = {"gru": GRUAttnCell,
+                      "lstm": LSTMAttnCell,
+                      "match": MatchLSTMCell}
+        if model_type not in cell_types:
+            raise Exception('Must specify model type.')
+        return cell_types[model_type](self.size, attention_inputs)
+
+    def encode(self, inputs, masks, encoder_state_input=None, attention_inputs=None, model_type="gru", bidir=True,
+               attention_lengths=None, precompute_attention=False, time_major=False):
         """
         In a generalized encode function, you pass in your inputs,
         masks, and an initial
@@ -221,50 +609,61 @@ class Encoder(object):
                                     to tf.nn.dynamic_rnn to build conditional representations
         :param attention_inputs: (Optional) pass this to compute attention and context 
                                     over these encodings
+        :param attention_lengths: (Optional) lengths of @attention_inputs, required with
+                                  @precompute_attention
+        :param precompute_attention: use the Precomputed*Cell variants, which project
+                                     @attention_inputs once before the RNN loop
+        :param time_major: @inputs and the returned outputs are (T, batch_size, dim) instead
+                           of (batch_size, T, dim), @attention_inputs stay batch-major
         :return: an encoded representation of your input.
                  It can be context-level representation, word-level representation,
                  or both.
         """
         with tf.variable_scope(self.name):
 
+            if model_type == "conv":
+                if attention_inputs is not None:
+                    raise Exception('The conv encoder does not take attention inputs.')
+                if time_major:
+                    raise Exception('The conv encoder is batch-major.')
+                outputs, final_state = self.conv_encode(inputs, masks)
+                if bidir:
+                    # every position already sees both directions
+                    return outputs, final_state, outputs, final_state
+                return outputs, final_state
+
             ### Define the correct cell type.
-            if attention_inputs is None:
-                if model_type == "gru":
-                    if bidir:
-                        fw_cell = tf.nn.rnn_cell.GRUCell(self.size)
-                        bw_cell = tf.nn.rnn_cell.GRUCell(self.size)
-                    else:
-                        cell = tf.nn.rnn_cell.GRUCell(self.size)
-                elif model_type == "lstm":
-                    if bidir:
-                        fw_cell = tf.nn.rnn_cell.BasicLSTMCell(self.size)
-                        bw_cell = tf.nn.rnn_cell.BasicLSTMCell(self.size)
-                    else:
-                        cell = tf.nn.rnn_cell.BasicLSTMCell(self.size)
-                else:
+            if not bidir:
+                if attention_inputs is None and self.rnn_backend == "fused" and model_type == "lstm":
+                    return self.fused_lstm_encode(inputs, masks, encoder_state_input, time_major)
+                if self.recompute_segments > 0:
+                    return self.recompute_encode(inputs, masks, encoder_state_input, attention_inputs, model_type,
+                                                 attention_lengths, precompute_attention, time_major)
+                cell = self.unidirectional_cell(model_type, attention_inputs, attention_lengths,
+                                                precompute_attention)
+            elif attention_inputs is None:
+                fw_cell = self.cell(model_type)
+                bw_cell = self.cell(model_type)
+            elif precompute_attention:
+                cell_types = {"gru": PrecomputedGRUAttnCell,
+                              "lstm": PrecomputedLSTMAttnCell,
+                              "match": PrecomputedMatchLSTMCell}
+                if model_type not in cell_types:
                     raise Exception('Must specify model type.')
+                fw_cell = cell_types[model_type](self.size, attention_inputs[0], attention_lengths[0], "BiRNN/FW")
+                bw_cell = cell_types[model_type](self.size, attention_inputs[1], attention_lengths[1], "BiRNN/BW")
             else:
                 # use an attention cell - each cell uses attention to compute context
                 # over the @attention_inputs
                 if model_type == "gru":
-                    if bidir:
-                        fw_cell = GRUAttnCell(self.size, attention_inputs[0])
-                        bw_cell = GRUAttnCell(self.size, attention_inputs[1])
-                    else:
-                        cell = GRUAttnCell(self.size, attention_inputs)
+                    fw_cell = GRUAttnCell(self.size, attention_inputs[0])
+                    bw_cell = GRUAttnCell(self.size, attention_inputs[1])
                 elif model_type == "lstm":
-                    if bidir:
-                        fw_cell = LSTMAttnCell(self.size, attention_inputs[0])
-                        bw_cell = LSTMAttnCell(self.size, attention_inputs[1])
-                    else:
-                        cell = LSTMAttnCell(self.size, attention_inputs)
+                    fw_cell = LSTMAttnCell(self.size, attention_inputs[0])
+                    bw_cell = LSTMAttnCell(self.size, attention_inputs[1])
                 elif model_type == "match":
-                    if bidir:
-                        fw_cell = MatchLSTMCell(self.size, attention_inputs[0])
-                        bw_cell = MatchLSTMCell(self.size, attention_inputs[1])
-                    else:
-                        cell = MatchLSTMCell(self.size, attention_inputs)
-
+                    fw_cell = MatchLSTMCell(self.size, attention_inputs[0])
+                    bw_cell = MatchLSTMCell(self.size, attention_inputs[1])
                 else:
                     raise Exception('Must specify model type.')                
 
@@ -276,7 +675,10 @@ class Encoder(object):
                                                                        sequence_length=masks, 
                                                                        dtype=tf.float32, 
                                                                        initial_state_fw=encoder_state_input[0], 
-                                                                       initial_state_bw=encoder_state_input[1])
+                                                                       initial_state_bw=encoder_state_input[1],
+                                                                       parallel_iterations=self.parallel_iterations,
+                                                                       swap_memory=self.swap_memory,
+                                                                       time_major=time_major)
                 # get concatenated stuff
                 if model_type == "gru":
                     concat_final_state = tf.concat(1, final_state)
@@ -295,7 +697,10 @@ class Encoder(object):
                 outputs, final_state = tf.nn.dynamic_rnn(cell, inputs, 
                                            sequence_length=masks, 
                                            dtype=tf.float32,
-                                           initial_state=encoder_state_input)
+                                           initial_state=encoder_state_input,
+                                           parallel_iterations=self.parallel_iterations,
+                                           swap_memory=self.swap_memory,
+                                           time_major=time_major)
                 # get rid of "c"
                 if model_type == "lstm" or model_type == "match":
                     final_state = final_state[-1]
@@ -315,17 +720,176 @@ class Encoder(object):
         # # return all hidden states and the final hidden state
         # return encoded_outputs, encoded_outputs[:, -1, :]
 
+    def recompute_encode(self, inputs, masks, encoder_state_input, attention_inputs, model_type, attention_lengths,
+                         precompute_attention, time_major):
+        """
+        Unidirectional encode call as a SegmentRecompute layer of self.recompute_segments
+        segments, with the same variables as the plain tf.nn.dynamic_rnn call.
+        """
+        if time_major:
+            raise Exception('Recomputed RNNs run batch-major.')
+
+        def segment(segment_inputs, lengths, initial_state, segment_attention_inputs):
+            cell = self.unidirectional_cell(model_type, segment_attention_inputs, attention_lengths,
+                                            precompute_attention)
+            return tf.nn.dynamic_rnn(cell, segment_inputs,
+                                     sequence_length=lengths,
+                                     dtype=tf.float32,
+                                     initial_state=initial_state,
+                                     parallel_iterations=self.parallel_iterations,
+                                     swap_memory=self.swap_memory)
+
+        layer = SegmentRecompute(segment, inputs, masks, encoder_state_input, attention_inputs,
+                                 self.recompute_segments)
+        self.recomputed.append(layer)
+        final_state = layer.final_state
+        # get rid of "c"
+        if model_type == "lstm" or model_type == "match":
+            final_state = final_state[-1]
+        return layer.outputs, final_state
+
+    def fused_lstm_encode(self, inputs, masks, encoder_state_input=None, time_major=False):
+        """
+        Unidirectional attention-free LSTM as a single LSTMBlockFusedCell op, which loops
+        over the (time-major) sequence inside one kernel instead of a tf.while_loop.
+        :return: (outputs, final h state) like encode
+        """
+        if not time_major:
+            inputs = tf.transpose(inputs, [1, 0, 2])
+        cell = tf.contrib.rnn.LSTMBlockFusedCell(self.size)
+        outputs, final_state = cell(inputs, initial_state=encoder_state_input, dtype=tf.float32,
+                                    sequence_length=masks, scope="RNN")
+        if not time_major:
+            outputs = tf.transpose(outputs, [1, 0, 2])
+        return outputs, final_state[-1]
+
+    def conv_encode(self, inputs, masks):
+        """
+        Non-recurrent encoder: a stack of residual depthwise-separable convolution blocks,
+        optionally followed by a masked self-attention block. Every layer processes all
+        positions of the sequence at once instead of one timestep after the other.
+
+        :return: (outputs of shape (batch_size, T, size), masked mean of the outputs)
+        """
+        batch_size = tf.shape(inputs)[0]
+        T = tf.shape(inputs)[1]
+        input_dim = inputs.get_shape()[2].value
+        mask = attention_mask(masks, T)
+
+        with vs.variable_scope("Input"):
+            W = tf.get_variable("W", shape=(input_dim, self.size), initializer=tf.contrib.layers.xavier_initializer())
+            b = tf.get_variable("b", shape=(self.size,), initializer=tf.constant_initializer(0.0))
+            states = tf.matmul(tf.reshape(inputs, [-1, input_dim]), W) + b
+            states = tf.reshape(states, tf.pack([batch_size, T, self.size])) * mask
+
+        for i in xrange(self.conv_layers):
+            with vs.variable_scope("Conv%d" % i):
+                # padded positions are kept at zero so they act as the convolution's zero padding
+                x = tf.expand_dims(layer_norm(states) * mask, 2)
+                depthwise = tf.get_variable("depthwise", shape=(self.conv_kernel, 1, self.size, 1),
+                                            initializer=tf.contrib.layers.xavier_initializer())
+                pointwise = tf.get_variable("pointwise", shape=(1, 1, self.size, self.size),
+                                            initializer=tf.contrib.layers.xavier_initializer())
+                b = tf.get_variable("b", shape=(self.size,), initializer=tf.constant_initializer(0.0))
+                x = tf.nn.separable_conv2d(x, depthwise, pointwise, strides=[1, 1, 1, 1], padding="SAME")
+                states = (states + tf.nn.relu(tf.squeeze(x, [2]) + b)) * mask
+
+        if self.conv_self_attention:
+            with vs.variable_scope("SelfAttention"):
+                x = layer_norm(states)
+                W = tf.get_variable("W", shape=(self.size, 3 * self.size),
+                                    initializer=tf.contrib.layers.xavier_initializer())
+                qkv = tf.reshape(tf.matmul(tf.reshape(x, [-1, self.size]), W), tf.pack([batch_size, T, 3 * self.size]))
+                q, k, v = tf.split(2, 3, qkv)
+                scores = tf.batch_matmul(q, k, adj_y=True) / np.sqrt(self.size)
+                weights = masked_softmax(scores, tf.transpose(mask, [0, 2, 1]), 2)
+                states = (states + tf.batch_matmul(weights, v)) * mask
+
+        lengths = tf.maximum(tf.cast(tf.expand_dims(masks, 1), tf.float32), 1.0)
+        final_state = tf.reduce_sum(states, reduction_indices=1) / lengths
+        return states, final_state
+
+
+class AttentionFlow(object):
+    """
+    Non-recurrent context/question interaction (attention flow, Seo et al., 2016).
+    The full context x question similarity matrix is computed with one batched matmul,
+    and the context-to-question and question-to-context summaries are computed from it
+    for all paragraph positions at once, outside of any RNN loop.
+
+    Arguments:
+        -size: dimension of the output states
+        -name: variable scope
+    """
+    def __init__(self, size, name):
+        self.size = size
+        self.name = name
+
+    def attend(self, context_states, question_states, context_lengths, question_lengths):
+        """
+        :param context_states: shape (batch_size, T, hid_dim)
+        :param question_states: shape (batch_size, J, hid_dim)
+        :return: question-aware paragraph states, shape (batch_size, T, size)
+        """
+        with vs.variable_scope(self.name):
+            hid_dim = context_states.get_shape()[2].value
+            batch_size = tf.shape(context_states)[0]
+            T = tf.shape(context_states)[1]
+            J = tf.shape(question_states)[1]
+
+            w_c = tf.get_variable("w_c", shape=(hid_dim, 1), initializer=tf.contrib.layers.xavier_initializer())
+            w_q = tf.get_variable("w_q", shape=(hid_dim, 1), initializer=tf.contrib.layers.xavier_initializer())
+            w_cq = tf.get_variable("w_cq", shape=(1, 1, hid_dim), initializer=tf.contrib.layers.xavier_initializer())
+
+            # similarity S_tj = w_c.c_t + w_q.q_j + w_cq.(c_t * q_j), shape (batch_size, T, J)
+            s_c = tf.reshape(tf.matmul(tf.reshape(context_states, [-1, hid_dim]), w_c), tf.pack([batch_size, T, 1]))
+            s_q = tf.reshape(tf.matmul(tf.reshape(question_states, [-1, hid_dim]), w_q), tf.pack([batch_size, 1, J]))
+            similarity = s_c + s_q + tf.batch_matmul(context_states * w_cq, question_states, adj_y=True)
+
+            # shapes (batch_size, T, 1) and (batch_size, 1, J)
+            ctx_mask = attention_mask(context_lengths, T)
+            q_mask = tf.transpose(attention_mask(question_lengths, J), [0, 2, 1])
+
+            # context-to-question: every paragraph position attends over the question
+            c2q_weights = masked_softmax(similarity, q_mask, 2)
+            c2q = tf.batch_matmul(c2q_weights, question_states)
+
+            # question-to-context: attend over the paragraph positions most similar to any question word
+            best = tf.reduce_max(similarity + (-1e30 * (1.0 - q_mask)), reduction_indices=2, keep_dims=True)
+            q2c_weights = masked_softmax(best, ctx_mask, 1)
+            q2c = tf.batch_matmul(q2c_weights, context_states, adj_x=True)
+
+            flow = tf.concat(2, [context_states, c2q, context_states * c2q, context_states * q2c])
+
+            with vs.variable_scope("Projection"):
+                W = tf.get_variable("W", shape=(4 * hid_dim, self.size), initializer=tf.contrib.layers.xavier_initializer())
+                b = tf.get_variable("b", shape=(self.size,), initializer=tf.constant_initializer(0.0))
+                out = tf.nn.tanh(tf.matmul(tf.reshape(flow, [-1, 4 * hid_dim]), W) + b)
+
+            return tf.reshape(out, tf.pack([batch_size, T, self.size])) * ctx_mask
+
 
 class Decoder(object):
-    def __init__(self, hidden_size, output_size):
+    """
+    Arguments:
+        -hidden_size: dimension of the decoder states
+        -decoder_type: "rnn" runs a start and an end RNN over the paragraph, "pointer"
+                       scores start and end positions with feed-forward layers
+        -rnn_backend, parallel_iterations, swap_memory: see Encoder
+    """
+    def __init__(self, hidden_size, output_size, decoder_type="rnn", rnn_backend="basic", parallel_iterations=32,
+                 swap_memory=False):
         self.hidden_size = hidden_size
         self.output_size = output_size
+        self.decoder_type = decoder_type
 
         # use another set of encoders to decode the start and end indices conditionally
-        self.start_decoder = Encoder(size=self.hidden_size, name="start_decoder")
-        self.end_decoder = Encoder(size=self.hidden_size, name="end_decoder")
+        self.start_decoder = Encoder(size=self.hidden_size, name="start_decoder", rnn_backend=rnn_backend,
+                                     parallel_iterations=parallel_iterations, swap_memory=swap_memory)
+        self.end_decoder = Encoder(size=self.hidden_size, name="end_decoder", rnn_backend=rnn_backend,
+                                   parallel_iterations=parallel_iterations, swap_memory=swap_memory)
 
-    def decode(self, knowledge_rep, masks, maxlen, model_type):
+    def decode(self, knowledge_rep, masks, maxlen, model_type, time_major=False):
         """
         takes in a knowledge representation
         and output a probability estimation over
@@ -335,12 +899,19 @@ class Decoder(object):
 
         :param knowledge_rep: it is a representation of the paragraph and question,
                               decided by how you choose to implement the encoder
+        :param time_major: the paragraph representation is (T, batch_size, dim), the
+                           returned logits are batch-major either way
         :return:
         """
 
         question_enc, paragraph_enc = knowledge_rep
 
-        assert(paragraph_enc.get_shape()[1] == self.output_size)
+        if self.decoder_type == "pointer":
+            if time_major:
+                paragraph_enc = tf.transpose(paragraph_enc, [1, 0, 2])
+            return self.decode_pointer(paragraph_enc, masks, maxlen)
+        elif self.decoder_type != "rnn":
+            raise Exception('Must specify decoder type.')
 
         with vs.variable_scope("decoder"):
 
@@ -351,14 +922,16 @@ class Decoder(object):
                                                               encoder_state_input=None, 
                                                               attention_inputs=None, 
                                                               model_type=model_type,
-                                                              bidir=False)        
+                                                              bidir=False,
+                                                              time_major=time_major)
 
             #end_states, _, _, _ = self.end_decoder.encode(start_states, masks, 
             end_states, _, = self.end_decoder.encode(start_states, masks, 
                                                           encoder_state_input=None, 
                                                           attention_inputs=None, 
                                                           model_type=model_type,
-                                                          bidir=False)  
+                                                          bidir=False,
+                                                          time_major=time_major)
 
             #embed()
 
@@ -373,6 +946,10 @@ class Decoder(object):
             end_probs = tf.reduce_sum(end_states * W_end, reduction_indices=2)
             #end_probs = tf.nn.rnn_cell._linear(end_states, 1, True, 1.0)
 
+            if time_major:
+                start_probs = tf.transpose(start_probs)
+                end_probs = tf.transpose(end_probs)
+
             # Do masking.
 
             bool_masks = tf.cast(tf.sequence_mask(masks, maxlen=maxlen), tf.float32)
@@ -397,14 +974,57 @@ class Decoder(object):
 
         return start_probs, end_probs
 
+    def decode_pointer(self, paragraph_enc, masks, maxlen):
+        """
+        Feed-forward pointer head: the start logits are a projection of every paragraph
+        state, the end logits additionally see the paragraph states pooled under the
+        start distribution. All positions are scored at once, without the two extra
+        sequential passes of the RNN decoder.
+
+        :param paragraph_enc: shape (batch_size, T, hid_dim)
+        :return: masked start and end logits, shape (batch_size, T)
+        """
+        with vs.variable_scope("decoder"):
+            hid_dim = paragraph_enc.get_shape()[2].value
+            batch_size = tf.shape(paragraph_enc)[0]
+            T = tf.shape(paragraph_enc)[1]
+            mask = attention_mask(masks, maxlen)
+
+            def score(states, scope):
+                # one hidden layer then a projection to a single logit per position
+                dim = states.get_shape()[2].value
+                with vs.variable_scope(scope):
+                    W = tf.get_variable("W", shape=(dim, self.hidden_size),
+                                        initializer=tf.contrib.layers.xavier_initializer())
+                    b = tf.get_variable("b", shape=(self.hidden_size,), initializer=tf.constant_initializer(0.0))
+                    w = tf.get_variable("w", shape=(self.hidden_size, 1),
+                                        initializer=tf.contrib.layers.xavier_initializer())
+                    hidden = tf.nn.relu(tf.matmul(tf.reshape(states, [-1, dim]), W) + b)
+                    return tf.reshape(tf.matmul(hidden, w), tf.pack([batch_size, T]))
+
+            start_probs = score(paragraph_enc, "start")
+
+            # expected paragraph state under the start distribution, shape (batch_size, 1, hid_dim)
+            start_weights = masked_softmax(tf.expand_dims(start_probs, 2), mask, 1)
+            start_summary = tf.batch_matmul(start_weights, paragraph_enc, adj_x=True)
+            start_summary = tf.tile(start_summary, tf.pack([1, T, 1]))
+            end_inputs = tf.concat(2, [paragraph_enc, start_summary, paragraph_enc * start_summary])
+            end_inputs.set_shape([None, None, 3 * hid_dim])
+            end_probs = score(end_inputs, "end")
+
+            add_mask = -1e30 * (1.0 - tf.squeeze(mask, [2]))
+            return start_probs + add_mask, end_probs + add_mask
+
 class QASystem(object):
-    def __init__(self, encoder, decoder, pretrained_embeddings, max_ctx_len, max_q_len, flags):
+    def __init__(self, encoder, decoder, pretrained_embeddings, max_ctx_len, max_q_len, flags, training=True):
         """
         Initializes your System
 
         :param encoder: tuple of 2 encoders that you constructed in train.py
         :param decoder: a decoder that you constructed in train.py
         :param args: pass in more arguments as needed
+        :param training: False builds an inference-only graph, without the loss, the
+                         optimizer and its slot variables
         """
         self.pretrained_embeddings = pretrained_embeddings
         self.question_encoder, self.context_encoder = encoder # unpack tuple of encoders
@@ -413,21 +1033,52 @@ class QASystem(object):
         self.max_q_len = max_q_len
         self.flags = flags
         self.embed_size = self.flags.embedding_size
+        self.embedding_placeholder = None
+        # the recurrent models run time-major from the embeddings to the logits with the fused
+        # backend, the attention-flow and conv models need batch-major states
+        self.time_major = self.flags.rnn_backend == "fused" and self.flags.model_type not in ("flow", "conv")
         # ==== set up placeholder tokens ========
 
-        self.context_placeholder = tf.placeholder(tf.int32, shape=(None, self.max_ctx_len), name='context_placeholder')
-        self.question_placeholder = tf.placeholder(tf.int32, shape=(None, self.max_q_len), name='question_placeholder')
+        # the time dimension is left open so every batch is only padded to its own longest example
+        self.context_placeholder = tf.placeholder(tf.int32, shape=(None, None), name='context_placeholder')
+        self.question_placeholder = tf.placeholder(tf.int32, shape=(None, None), name='question_placeholder')
         self.answer_span_placeholder = tf.placeholder(tf.int32, shape=(None, 2), name='answer_span_placeholder')
         self.mask_q_placeholder = tf.placeholder(tf.int32, shape=(None,), name='mask_q_placeholder')
         self.mask_ctx_placeholder = tf.placeholder(tf.int32, shape=(None,), name='mask_ctx_placeholder')
         self.dropout_placeholder = tf.placeholder(tf.float32, shape=(), name='dropout_placeholder')
 
+        # distillation: padded start / end logits of the teacher, looked up in self.teacher
+        # (a distill.TeacherLogits set by train.py) by the example indices optimize gets
+        self.teacher = None
+        self.teacher_start_placeholder = None
+        self.teacher_end_placeholder = None
+        if training and self.flags.teacher_dir:
+            self.teacher_start_placeholder = tf.placeholder(tf.float32, shape=(None, None), name='teacher_start_placeholder')
+            self.teacher_end_placeholder = tf.placeholder(tf.float32, shape=(None, None), name='teacher_end_placeholder')
+
         # ==== assemble pieces ====
+        self.tower_losses = None
+        self.accumulators = []
         with tf.variable_scope("qa", initializer=tf.uniform_unit_scaling_initializer(1.0)):
             self.setup_embeddings()
-            self.setup_system()
-            self.setup_loss()
+            if training and self.flags.num_towers > 1:
+                self.setup_towers()
+            else:
+                self.setup_system()
+                if training:
+                    self.setup_loss()
+
+        if training:
+            self.setup_training()
 
+        # with feed_embeddings the frozen embedding matrix is left out of the checkpoints, and
+        # the gradient accumulators always are
+        self.saver_vars = [v for v in tf.global_variables()
+                           if (self.embedding_placeholder is None or v is not self.embeddings)
+                           and v not in self.accumulators]
+        self.saver = tf.train.Saver(var_list=self.saver_vars)
+
+    def setup_training(self):
         # ==== set up training/updating procedure ====
         self.global_step = tf.Variable(0, trainable=False)
         self.starter_learning_rate = self.flags.learning_rate
@@ -438,18 +1089,64 @@ class QASystem(object):
         # self.learning_rate = tf.train.exponential_decay(self.starter_learning_rate, self.global_step,
         #                                    1000, 0.96, staircase=True)
 
-        self.optimizer = get_optimizer("adam")
-        
+        self.optimizer = get_optimizer("adam")(self.learning_rate)
+
+        if self.tower_losses is not None:
+            # average the gradients of the towers, then clip and apply them once
+            grads = average_gradients([self.compute_gradients(loss) for loss in self.tower_losses])
+        else:
+            grads = self.compute_gradients(self.loss)
         if self.flags.grad_clip:
             # gradient clipping
-            self.optimizer = self.optimizer(self.learning_rate)
-            grads = self.optimizer.compute_gradients(self.loss)
-            for i, (grad, var) in enumerate(grads):
-                if grad is not None:
-                    grads[i] = (tf.clip_by_norm(grad, self.flags.max_gradient_norm), var)
-            self.train_op = self.optimizer.apply_gradients(grads, global_step=self.global_step) #NOTE: I don't specify to minimize anywhere...Not sure if I should...  
+            grads = [(grad if grad is None else tf.clip_by_norm(grad, self.flags.max_gradient_norm), var)
+                     for grad, var in grads]
+        if self.flags.accum_steps > 1:
+            self.setup_accumulation(grads)
         else:
-            self.train_op = self.optimizer(self.learning_rate).minimize(self.loss, global_step=self.global_step) #No gradient clipping
+            self.train_op = self.optimizer.apply_gradients(grads, global_step=self.global_step)
+
+    def compute_gradients(self, loss):
+        """
+        optimizer.compute_gradients, plus the gradients through the SegmentRecompute layers
+        of the context encoder (flags.recompute_segments), whose outputs do not carry
+        gradients in the graph. Layers @loss does not depend on (those of other towers) add
+        nothing.
+        """
+        grads = self.optimizer.compute_gradients(loss)
+        variables = [var for _, var in grads]
+        for layer in self.context_encoder.recomputed:
+            extra = layer.gradients(loss, variables)
+            if extra is not None:
+                grads = [(add_gradients(grad, g), var) for (grad, var), g in zip(grads, extra)]
+        return grads
+
+    def setup_accumulation(self, grads):
+        """
+        Gradient accumulation over flags.accum_steps micro-batches, see optimize.
+        accumulate_op adds the (clipped) gradients of one micro-batch, weighted by its share
+        of the whole batch, to non-trainable accumulator variables. train_op then applies the
+        accumulated gradients in one optimizer update and zeroes them, without a feed.
+        """
+        self.accum_weight_placeholder = tf.placeholder(tf.float32, shape=(), name='accum_weight_placeholder')
+        grads = [(grad, var) for grad, var in grads if grad is not None]
+        with tf.name_scope("accumulators"):
+            self.accumulators = [tf.Variable(tf.zeros(var.get_shape(), dtype=var.dtype.base_dtype), trainable=False,
+                                             name=var.op.name.replace("/", "_")) for _, var in grads]
+        self.accumulate_op = tf.group(*[acc.assign_add(self.accum_weight_placeholder * tf.convert_to_tensor(grad))
+                                        for acc, (grad, _) in zip(self.accumulators, grads)])
+        apply_op = self.optimizer.apply_gradients([(acc.value(), var) for acc, (_, var) in zip(self.accumulators, grads)],
+                                                  global_step=self.global_step)
+        with tf.control_dependencies([apply_op]):
+            self.train_op = tf.group(*[acc.assign(tf.zeros_like(acc)) for acc in self.accumulators])
+
+    def initializer_feed(self):
+        """
+        Feed dict the variable initializers need: the embedding initializer reads the
+        embedding matrix from a placeholder with feed_embeddings.
+        """
+        if self.embedding_placeholder is None:
+            return {}
+        return {self.embedding_placeholder: self.pretrained_embeddings}
 
 
     def pad(self, sequence, max_length):
@@ -472,24 +1169,47 @@ class QASystem(object):
         :return:
         """
 
+        if self.flags.model_type in ("flow", "conv"):
+            # "conv" also decodes with conv encoders, so no part of the model is recurrent
+            encoder_type = "conv" if self.flags.model_type == "conv" else "gru"
+            question_states, match_states = self.setup_attention_flow(encoder_type)
+            self.start_probs, self.end_probs = self.decoder.decode(knowledge_rep=(question_states, match_states),
+                                                                   masks=self.mask_ctx_placeholder,
+                                                                   maxlen=tf.shape(self.context_placeholder)[1],
+                                                                   model_type=encoder_type)
+            return
+
         # simple encoder stuff here
         question_states, final_question_state = self.question_encoder.encode(self.question_embeddings, self.mask_q_placeholder, 
                                                                              encoder_state_input=None, 
                                                                              attention_inputs=None, 
                                                                              model_type=self.flags.model_type,
-                                                                             bidir=False)
-        ctx_states, final_ctx_state = self.context_encoder.encode(self.context_embeddings, self.mask_ctx_placeholder, 
-                                                                             encoder_state_input=None, #final_question_state, 
-                                                                             attention_inputs=question_states,
-                                                                             model_type=self.flags.model_type,
-                                                                             bidir=False)
+                                                                             bidir=False,
+                                                                             time_major=self.time_major)
+        if self.time_major:
+            # the attention cells read the question states batch-major
+            question_states = tf.transpose(question_states, [1, 0, 2])
+        if not self.flags.prune_dead:
+            # ctx_states never reaches the decoder, only match_states does; TF skips it at run
+            # time but still builds, initializes and checkpoints its variables
+            ctx_states, final_ctx_state = self.context_encoder.encode(self.context_embeddings, self.mask_ctx_placeholder,
+                                                                      encoder_state_input=None, #final_question_state,
+                                                                      attention_inputs=question_states,
+                                                                      model_type=self.flags.model_type,
+                                                                      bidir=False,
+                                                                      attention_lengths=self.mask_q_placeholder,
+                                                                      precompute_attention=self.flags.attn_precompute,
+                                                                      time_major=self.time_major)
 
         # match LSTM layer
         match_states, final_match_state = self.context_encoder.encode(self.context_embeddings, self.mask_ctx_placeholder, 
                                                                              encoder_state_input=None, #final_question_state, 
                                                                              attention_inputs=question_states,
                                                                              model_type="match",
-                                                                             bidir=False)      
+                                                                             bidir=False,
+                                                                             attention_lengths=self.mask_q_placeholder,
+                                                                             precompute_attention=self.flags.attn_precompute,
+                                                                             time_major=self.time_major)
 
         # question_states, final_question_state, ctx_att_input, ctx_input = self.question_encoder.encode(self.question_embeddings, self.mask_q_placeholder, 
         #                                                                      encoder_state_input=None, 
@@ -502,12 +1222,62 @@ class QASystem(object):
         #                                                                      model_type=self.flags.model_type,
         #                                                                      bidir=False)
 
+        # the gru/lstm context encoder attends over the question at every step, only the
+        # embedding lookup is question-independent and not worth caching, see decode_cached
+        self.context_repr = None
+
         # decoder takes encoded representation to probability dists over start / end index
         self.start_probs, self.end_probs = self.decoder.decode(knowledge_rep=(question_states, match_states), 
                                                                masks=self.mask_ctx_placeholder,
                                                                #maxlen=self.flags.output_size)
-                                                               maxlen=self.max_ctx_len,
-                                                               model_type=self.flags.model_type)
+                                                               maxlen=tf.shape(self.context_placeholder)[1],
+                                                               model_type=self.flags.model_type,
+                                                               time_major=self.time_major)
+
+    def setup_attention_flow(self, encoder_type="gru"):
+        """
+        Encodes question and paragraph independently and lets them interact through an
+        AttentionFlow layer instead of attention inside the RNN cells.
+        :param encoder_type: "gru" or "conv"
+        :return: (question states, question-aware paragraph states)
+        """
+        if self.flags.share_encoder:
+            question_states, ctx_states = self.shared_encode(encoder_type)
+            # questions and paragraphs go through one encoder call, nothing worth caching
+            self.context_repr = None
+        else:
+            question_states, _ = self.question_encoder.encode(self.question_embeddings, self.mask_q_placeholder,
+                                                              model_type=encoder_type, bidir=False)
+            ctx_states, _ = self.context_encoder.encode(self.context_embeddings, self.mask_ctx_placeholder,
+                                                        model_type=encoder_type, bidir=False)
+
+            # the paragraph encoding does not see the question, so the whole context RNN can be cached
+            self.context_repr = ctx_states
+
+        flow = AttentionFlow(size=self.context_encoder.size, name="attention_flow")
+        match_states = flow.attend(ctx_states, question_states, self.mask_ctx_placeholder, self.mask_q_placeholder)
+        return question_states, match_states
+
+    def shared_encode(self, encoder_type):
+        """
+        Encodes questions and paragraphs with the weights of the context encoder in a single
+        encoder call: both are padded to the same width and stacked along the batch axis,
+        with their own lengths per row, and the outputs are split again afterwards. The
+        questions then add rows to the paragraph RNN loop instead of running their own loop.
+        :return: (question states, paragraph states)
+        """
+        batch_size = tf.shape(self.context_embeddings)[0]
+        J = tf.shape(self.question_embeddings)[1]
+        T = tf.shape(self.context_embeddings)[1]
+        width = tf.maximum(J, T)
+
+        questions = tf.pad(self.question_embeddings, tf.reshape(tf.pack([0, 0, 0, width - J, 0, 0]), [3, 2]))
+        contexts = tf.pad(self.context_embeddings, tf.reshape(tf.pack([0, 0, 0, width - T, 0, 0]), [3, 2]))
+        inputs = tf.concat(0, [questions, contexts])
+        lengths = tf.concat(0, [self.mask_q_placeholder, self.mask_ctx_placeholder])
+
+        states, _ = self.context_encoder.encode(inputs, lengths, model_type=encoder_type, bidir=False)
+        return states[:batch_size, :J], states[batch_size:, :T]
 
     def setup_loss(self):
         """
@@ -517,6 +1287,19 @@ class QASystem(object):
         with vs.variable_scope("loss"):
             self.loss = tf.reduce_mean(tf.nn.sparse_softmax_cross_entropy_with_logits(self.start_probs, self.answer_span_placeholder[:, 0])) + \
                         tf.reduce_mean(tf.nn.sparse_softmax_cross_entropy_with_logits(self.end_probs, self.answer_span_placeholder[:, 1]))
+
+            if self.teacher_start_placeholder is not None:
+                # cross entropy to the temperature-softened teacher distributions, which is the KL
+                # divergence up to the teacher entropy; scaled by T^2 so its gradients keep the
+                # magnitude of the gold-span loss. Padded positions have probability 0 on both sides.
+                T = self.flags.distill_temperature
+
+                def soft_cross_entropy(logits, teacher_logits):
+                    return tf.reduce_mean(tf.nn.softmax_cross_entropy_with_logits(logits / T, tf.nn.softmax(teacher_logits / T)))
+
+                self.distill_loss = soft_cross_entropy(self.start_probs, self.teacher_start_placeholder) + \
+                                    soft_cross_entropy(self.end_probs, self.teacher_end_placeholder)
+                self.loss = (1 - self.flags.distill_weight) * self.loss + self.flags.distill_weight * T * T * self.distill_loss
             
             #pass
 
@@ -526,21 +1309,107 @@ class QASystem(object):
         :return:
         """
         with vs.variable_scope("embeddings"):
-            embeddings = tf.Variable(self.pretrained_embeddings, name='embedding', dtype=tf.float32, trainable=False) #only learn one common embedding
+            if self.flags.feed_embeddings:
+                # initialized from a placeholder, so the matrix is not stored as a constant in the GraphDef
+                self.embedding_placeholder = tf.placeholder(tf.float32, shape=self.pretrained_embeddings.shape,
+                                                            name='embedding_placeholder')
+                embeddings = tf.Variable(self.embedding_placeholder, name='embedding', trainable=False)
+            else:
+                # np.asarray reads memory-mapped and float16 matrices in as float32
+                embeddings = tf.Variable(np.asarray(self.pretrained_embeddings, dtype=np.float32), name='embedding', dtype=tf.float32, trainable=False) #only learn one common embedding
+            self.embeddings = embeddings
+            self.lookup_embeddings()
 
-            question_embeddings = tf.nn.embedding_lookup(embeddings, self.question_placeholder)
-            self.question_embeddings = tf.reshape(question_embeddings, [-1, self.max_q_len, self.embed_size])
+    def lookup_embeddings(self):
+        """
+        Embeds the question and context token ids, called again by every tower with its
+        shard of the ids (see setup_towers).
+        """
+        if self.time_major:
+            # transposing the int ids is cheaper than transposing the embedded batch
+            self.question_embeddings = tf.nn.embedding_lookup(self.embeddings, tf.transpose(self.question_placeholder))
+            self.context_embeddings = tf.nn.embedding_lookup(self.embeddings, tf.transpose(self.context_placeholder))
+            return
+
+        # shape (batch_size, max_q_len, embed_size), max_q_len is the width of the fed batch
+        self.question_embeddings = tf.nn.embedding_lookup(self.embeddings, self.question_placeholder)
 
-            context_embeddings = tf.nn.embedding_lookup(embeddings, self.context_placeholder)
-            self.context_embeddings = tf.reshape(context_embeddings, [-1, self.max_ctx_len, self.embed_size])
+        # shape (batch_size, max_ctx_len, embed_size)
+        self.context_embeddings = tf.nn.embedding_lookup(self.embeddings, self.context_placeholder)
 
+    def setup_towers(self):
+        """
+        Data parallelism: splits every batch into flags.num_towers shards along the batch
+        axis and builds the system and loss once per shard, all towers sharing the variables.
+        The towers are independent subgraphs, so TF runs them concurrently on the inter-op
+        thread pool. setup_training averages the tower gradients before applying them.
 
-    def optimize(self, session, context_batch, question_batch, answer_span_batch, mask_ctx_batch, mask_q_batch):
+        The placeholder attributes are pointed at each tower's shard while it is built; the
+        logits of all towers are concatenated back into the batch order.
+        """
+        inputs = ["context_placeholder", "question_placeholder", "answer_span_placeholder", "mask_q_placeholder",
+                  "mask_ctx_placeholder"]
+        if self.teacher_start_placeholder is not None:
+            inputs += ["teacher_start_placeholder", "teacher_end_placeholder"]
+        placeholders = dict((name, getattr(self, name)) for name in inputs)
+
+        num_towers = self.flags.num_towers
+        batch_size = tf.shape(self.context_placeholder)[0]
+        self.tower_losses, start_probs, end_probs = [], [], []
+        for k in xrange(num_towers):
+            begin = batch_size * k // num_towers
+            size = batch_size * (k + 1) // num_towers - begin
+            for name, placeholder in placeholders.items():
+                rank = placeholder.get_shape().ndims
+                setattr(self, name, tf.slice(placeholder, tf.pack([begin] + [0] * (rank - 1)),
+                                             tf.pack([size] + [-1] * (rank - 1))))
+            with tf.name_scope("tower%d" % k), vs.variable_scope(tf.get_variable_scope(), reuse=k > 0):
+                self.lookup_embeddings()
+                self.setup_system()
+                self.setup_loss()
+            self.tower_losses.append(self.loss)
+            start_probs.append(self.start_probs)
+            end_probs.append(self.end_probs)
+
+        for name, placeholder in placeholders.items():
+            setattr(self, name, placeholder)
+        self.loss = tf.add_n(self.tower_losses) / num_towers
+        self.start_probs = tf.concat(0, start_probs)
+        self.end_probs = tf.concat(0, end_probs)
+
+
+    def optimize(self, session, context_batch, question_batch, answer_span_batch, mask_ctx_batch, mask_q_batch,
+                 example_index_batch=None):
         """
         Takes in actual data to optimize your model
         This method is equivalent to a step() function
-        :return:
+
+        With flags.accum_steps > 1 the batch is split into that many micro-batches that are
+        run one at a time, and their accumulated gradients are applied in one update, so only
+        one micro-batch of activations is held in memory.
+
+        :param example_index_batch: (Optional) indices of the examples in the training set,
+                                    to feed their cached teacher logits when distilling
+        :return: the mean loss over the batch
         """
+        batch = [context_batch, question_batch, answer_span_batch, mask_ctx_batch, mask_q_batch, example_index_batch]
+        if not self.accumulators:
+            _, loss = session.run([self.train_op, self.loss], self.train_feed(*batch))
+            return loss
+
+        size = len(context_batch)
+        bounds = np.linspace(0, size, min(self.flags.accum_steps, size) + 1).astype(np.int32)
+        loss = 0.
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            input_feed = self.train_feed(*[col if col is None else col[start:end] for col in batch])
+            input_feed[self.accum_weight_placeholder] = (end - start) / size
+            _, micro_loss = session.run([self.accumulate_op, self.loss], input_feed)
+            loss += micro_loss * (end - start) / size
+        session.run(self.train_op)
+        return loss
+
+    def train_feed(self, context_batch, question_batch, answer_span_batch, mask_ctx_batch, mask_q_batch,
+                   example_index_batch=None):
         input_feed = {}
 
         # fill in this feed_dictionary like:
@@ -552,12 +1421,11 @@ class QASystem(object):
         input_feed[self.mask_q_placeholder] = mask_q_batch
         input_feed[self.dropout_placeholder] = self.flags.dropout
         input_feed[self.answer_span_placeholder] = answer_span_batch
-
-        output_feed = [self.train_op, self.loss]
-
-        _, loss = session.run(output_feed, input_feed)
-
-        return loss
+        if self.teacher_start_placeholder is not None:
+            start, end = self.teacher.batch(example_index_batch, np.shape(context_batch)[1])
+            input_feed[self.teacher_start_placeholder] = start
+            input_feed[self.teacher_end_placeholder] = end
+        return input_feed
 
     def test(self, session, context_batch, question_batch, answer_span_batch, mask_ctx_batch, mask_q_batch):
         """
@@ -607,16 +1475,102 @@ class QASystem(object):
 
         return outputs
 
-    def answer(self, session, data):
+    def decode_cached(self, session, cache, context_batch, question_batch):
+        """
+        Same as decode, but for unpadded token id lists and with the question-independent
+        part of the computation (self.context_repr) looked up per paragraph in @cache.
+        Only the paragraphs missing from the cache are run through it, the rest of the graph
+        then runs per question on the fed representations.
+
+        :param cache: a context_cache.ContextCache
+        :return: padded start and end logits like decode
+        """
+        if self.context_repr is None:
+            raise ValueError("Only model_type flow or conv without share_encoder have a question-independent "
+                             "paragraph encoding to cache")
+        # those models always run batch-major, see self.time_major
+        assert not self.time_major
+        keys = [cache.key(ctx) for ctx in context_batch]
+        reprs = [cache.get(key) for key in keys]
+
+        missing = OrderedDict((key, ctx) for key, ctx, r in zip(keys, context_batch, reprs) if r is None)
+        if missing:
+            ctx_batch, mask_ctx_batch = pad_sequences(list(missing.values()))
+            computed = session.run(self.context_repr, {self.context_placeholder: ctx_batch,
+                                                       self.mask_ctx_placeholder: mask_ctx_batch})
+            computed = dict((key, computed[j, :mask_ctx_batch[j]]) for j, key in enumerate(missing))
+            for key in missing:
+                cache.put(key, computed[key])
+            reprs = [computed[key] if r is None else r for key, r in zip(keys, reprs)]
+
+        mask_ctx_batch = np.array([len(r) for r in reprs], dtype=np.int32)
+        repr_batch = np.zeros((len(reprs), mask_ctx_batch.max()) + reprs[0].shape[1:], dtype=np.float32)
+        for j, r in enumerate(reprs):
+            repr_batch[j, :len(r)] = r
+        q_batch, mask_q_batch = pad_sequences(question_batch)
+
+        input_feed = {}
+        input_feed[self.context_repr] = repr_batch
+        # only the width of the context batch is read from the placeholder
+        input_feed[self.context_placeholder] = np.zeros(repr_batch.shape[:2], dtype=np.int32)
+        input_feed[self.question_placeholder] = q_batch
+        input_feed[self.mask_ctx_placeholder] = mask_ctx_batch
+        input_feed[self.mask_q_placeholder] = mask_q_batch
+        input_feed[self.dropout_placeholder] = self.flags.dropout
+
+        return session.run([self.start_probs, self.end_probs], input_feed)
+
+    def answer(self, session, data, top_k=None):
+        """
+        Decodes the best span of every example jointly, maximizing start + end score
+        with start <= end < start + flags.max_answer_len.
+
+        :param top_k: (Optional) return the top_k spans of every example and their scores,
+                      as arrays of shape (num_examples, top_k), instead of the best span only
+        """
 
         data = np.array(data).T
         yp, yp2 = self.decode(session, *data)
 
-        a_s = np.argmax(yp, axis=1)
-        a_e = np.argmax(yp2, axis=1)
+        if top_k is not None:
+            return top_k_spans(yp, yp2, self.flags.max_answer_len, top_k)
+
+        a_s, a_e, _ = best_spans(yp, yp2, self.flags.max_answer_len)
 
         return (a_s, a_e)
 
+    def decode_batches(self, session, context_ids, question_ids, batch_size=None):
+        """
+        Runs self.decode over unpadded examples in minibatches. Each minibatch is only
+        padded to its own longest context / question.
+
+        :return: lists of unpadded start and end logits, one 1-d array per example
+        """
+        batch_size = batch_size or self.flags.batch_size
+        start_logits, end_logits = [], []
+        for i in range(0, len(context_ids), batch_size):
+            ctx_batch, mask_ctx_batch = pad_sequences(context_ids[i:i + batch_size])
+            q_batch, mask_q_batch = pad_sequences(question_ids[i:i + batch_size])
+            yp, yp2 = self.decode(session, ctx_batch, q_batch, None, mask_ctx_batch, mask_q_batch)
+            for j, length in enumerate(mask_ctx_batch):
+                start_logits.append(yp[j, :length])
+                end_logits.append(yp2[j, :length])
+        return start_logits, end_logits
+
+    def answer_windows(self, session, context_ids, question_ids):
+        """
+        Answers full paragraphs by splitting them into overlapping windows of
+        flags.window_size tokens, decoding all windows in batches and merging the
+        span scores back per paragraph.
+        """
+        win_context, win_question, _, example_index, offsets = window_dataset(context_ids, question_ids, None,
+                                                                              self.flags.window_size,
+                                                                              self.flags.doc_stride,
+                                                                              answerable_only=False)
+        start_logits, end_logits = self.decode_batches(session, win_context, win_question)
+        return merge_window_spans(start_logits, end_logits, example_index, offsets, len(context_ids),
+                                  self.flags.max_answer_len)
+
     def validate(self, sess, context_batch, question_batch, answer_span_batch, mask_ctx_batch, mask_q_batch):
         """
         Iterate through the validation dataset and determine what
@@ -632,7 +1586,7 @@ class QASystem(object):
 
         return self.test(sess, context_batch, question_batch, answer_span_batch, mask_ctx_batch, mask_q_batch)
 
-    def evaluate_answer(self, session, dataset, context, sample=100, log=False, eval_set='train'):
+    def evaluate_answer(self, session, dataset, context, sample=100, log=False, eval_set='train', indices=None):
         """
         Evaluate the model's performance using the harmonic mean of F1 and Exact Match (EM)
         with the set of true answer labels
@@ -645,14 +1599,12 @@ class QASystem(object):
                         pass in multiple components (arguments) of one dataset to this function
         :param sample: how many examples in dataset we look at
         :param log: whether we print to std out stream
+        :param indices: (Optional) evaluate exactly these rows of @dataset instead of a sample
         :return:
         """
 
-        if sample is None:
-            sampled = dataset
-        else:
-            #np.random.seed(0)
-            sampled = dataset[np.random.choice(dataset.shape[0], sample)]
+        indices = sample_indices(len(dataset), sample, indices)
+        sampled = dataset[indices]
 
         a_s, a_e = self.answer(session, sampled)
 
@@ -660,27 +1612,52 @@ class QASystem(object):
         em=[]
         #embed()
         sampled = sampled.T
-        for i in range(len(sampled[0])):
-            pred_words=' '.join(context[i][a_s[i]:a_e[i]+1])
-            actual_words=' '.join(context[i][sampled[2][i][0]:sampled[2][i][1]+1])
-            # print('I:',i)
-            # print ("INDICES",a_s[i],a_e[i])
-            # print ("PRED_WORDS:",pred_words)
-            # print ("ACTUAL WORD",actual_words)
+        for k, i in enumerate(indices):
+            # the words of the sampled paragraph, not of the k-th one
+            pred_words=' '.join(context[i][a_s[k]:a_e[k]+1])
+            actual_words=' '.join(context[i][sampled[2][k][0]:sampled[2][k][1]+1])
             f1.append(f1_score(pred_words,actual_words))
-            # print('F1:',f1)
             em.append(exact_match_score(pred_words,actual_words))
-            # print('EM:',em)
-            # print (" ")
 
         if log:
-            logging.info("{},F1: {}, EM: {}, for {} samples".format(eval_set,np.mean(f1), None , sample))
+            logging.info("{},F1: {}, EM: {}, for {} samples".format(eval_set, np.mean(f1), np.mean(em), len(indices)))
         f1=sum(f1)/len(f1)
         em=sum(em)/len(em)
         return f1, em
 
+    def evaluate_answer_windows(self, session, examples, context, sample=100, log=False, eval_set='train',
+                                indices=None):
+        """
+        Same as evaluate_answer, but on full (untruncated) paragraphs answered through
+        self.answer_windows.
+
+        :param examples: (context_ids, question_ids, answer_spans) in paragraph coordinates
+        :param context: the paragraph words, aligned with @examples
+        """
+        context_ids, question_ids, answer_spans = examples
+        indices = sample_indices(len(context_ids), sample, indices)
+
+        a_s, a_e = self.answer_windows(session, [context_ids[i] for i in indices], [question_ids[i] for i in indices])
+
+        f1 = []
+        em = []
+        for k, i in enumerate(indices):
+            pred_words = ' '.join(context[i][a_s[k]:a_e[k] + 1])
+            actual_words = ' '.join(context[i][answer_spans[i][0]:answer_spans[i][1] + 1])
+            f1.append(f1_score(pred_words, actual_words))
+            em.append(exact_match_score(pred_words, actual_words))
+
+        if log:
+            logging.info("{},F1: {}, EM: {}, for {} samples".format(eval_set, np.mean(f1), np.mean(em), len(indices)))
+        return np.mean(f1), np.mean(em)
+
     ### Imported from NERModel
-    def run_epoch(self, sess, train_set, val_set, context):
+    def run_epoch(self, sess, train_set, val_set, context, examples=None, val_indices=None):
+        """
+        Trains one epoch and evaluates F1 / EM on 100 random train examples and on the
+        @val_indices val examples (100 random ones without).
+        :return: the val F1
+        """
         prog_train = Progbar(target=1 + int(len(train_set) / self.flags.batch_size))
         for i, batch in enumerate(minibatches(train_set, self.flags.batch_size)):
             loss = self.optimize(sess, *batch)
@@ -692,10 +1669,17 @@ class QASystem(object):
             val_loss = self.validate(sess, *batch)
             prog_val.update(i + 1, [("val loss", val_loss)])
         print("")
-        train_f1, train_em = self.evaluate_answer(sess,train_set, context=context[0], sample=100, log=True, eval_set="-TRAIN-")
-        val_f1, val_em = self.evaluate_answer(sess,val_set, context=context[1], sample=100, log=True, eval_set="-VAL-")
+        if examples is not None:
+            # windowed training, evaluate on the full paragraphs
+            train_f1, train_em = self.evaluate_answer_windows(sess, examples[0], context=context[0], sample=100, log=True, eval_set="-TRAIN-")
+            val_f1, val_em = self.evaluate_answer_windows(sess, examples[1], context=context[1], sample=100, log=True, eval_set="-VAL-", indices=val_indices)
+        else:
+            # without the example index column of distillation
+            train_f1, train_em = self.evaluate_answer(sess,train_set[:, :5], context=context[0], sample=100, log=True, eval_set="-TRAIN-")
+            val_f1, val_em = self.evaluate_answer(sess,val_set, context=context[1], sample=100, log=True, eval_set="-VAL-", indices=val_indices)
+        return val_f1
 
-    def train(self, session, saver, dataset, contexts, train_dir):
+    def train(self, session, dataset, contexts, train_dir, examples=None):
         """
         Implement main training loop
 
@@ -716,6 +1700,8 @@ class QASystem(object):
         :param dataset: a representation of our data, in some implementations, you can
                         pass in multiple components (arguments) of one dataset to this function
         :param train_dir: path to the directory where you should save the model checkpoint
+        :param examples: (Optional) (train, val) full-paragraph examples when @dataset holds
+                         windows (flags.window_size > 0), used to evaluate F1 / EM
         :return:
         """
 
@@ -754,6 +1740,9 @@ class QASystem(object):
 
         train_dataset.extend(train_mask)
         val_dataset.extend(val_mask)
+        if self.teacher is not None:
+            # batches carry their example indices to look up the teacher logits
+            train_dataset.append(list(range(len(train_dataset[0]))))
 
         # take transpose to be shape [None, num_examples]
         train_dataset = np.array(train_dataset).T
@@ -769,15 +1758,46 @@ class QASystem(object):
             val_dataset = val_dataset[:self.flags.batch_size]
             num_epochs = 100
 
+        # checkpoints are ranked by the val F1 of the same fixed val examples every epoch
+        num_val = len(examples[1][0]) if examples is not None else len(val_dataset)
+        val_indices = np.random.RandomState(0).permutation(num_val)[:self.flags.checkpoint_eval_sample]
+
+        # written in the background, keeping the flags.keep best checkpoints by val F1
+        checkpoints = CheckpointManager(self.saver_vars, train_dir, self.flags.keep)
         for epoch in range(num_epochs):
             #print(session.run([self.learning_rate]))
             logging.info("Epoch %d out of %d", epoch + 1, self.flags.epochs)
-            self.run_epoch(sess=session, train_set=train_dataset, val_set=val_dataset, context=val_context)
+            val_f1 = self.run_epoch(sess=session, train_set=train_dataset, val_set=val_dataset, context=contexts,
+                                    examples=examples, val_indices=val_indices)
             logging.info("Saving model in %s", train_dir)
-            saver.save(session, train_dir)
-
-        self.evaluate_answer(session, val_dataset, dev_context, sample=None, log=True)
-
+            checkpoints.save(session, session.run(self.global_step), val_f1)
+        checkpoints.close()
 
+        if examples is not None:
+            self.evaluate_answer_windows(session, examples[1], val_context, sample=None, log=True)
+        else:
+            self.evaluate_answer(session, val_dataset, val_context, sample=None, log=True)
 
 
+def build_model(flags, pretrained_embeddings, max_ctx_len, max_q_len, training=True):
+    """
+    Builds the encoders, decoder and QASystem graph configured by @flags.
+    """
+    encoder_args = dict(conv_layers=flags.conv_layers, conv_kernel=flags.conv_kernel,
+                        conv_self_attention=flags.conv_self_attention, rnn_backend=flags.rnn_backend,
+                        parallel_iterations=flags.parallel_iterations, swap_memory=bool(flags.swap_memory))
+    question_encoder = Encoder(size=flags.state_size, name="question_encoder", **encoder_args)
+    # only training keeps activations for backprop
+    context_encoder = Encoder(size=flags.state_size, name="context_encoder",
+                              recompute_segments=flags.recompute_segments if training else 0, **encoder_args)
+    decoder = Decoder(hidden_size=flags.state_size, output_size=flags.output_size, decoder_type=flags.decoder_type,
+                      rnn_backend=flags.rnn_backend, parallel_iterations=flags.parallel_iterations,
+                      swap_memory=bool(flags.swap_memory))
+
+    return QASystem(encoder=(question_encoder, context_encoder),
+                    decoder=decoder,
+                    pretrained_embeddings=pretrained_embeddings,
+                    max_ctx_len=max_ctx_len,
+                    max_q_len=max_q_len,
+                    flags=flags,
+                    training=training)
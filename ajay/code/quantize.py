@@ -0,0 +1,144 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import shutil
+import time
+from os.path import join as pjoin
+
+import numpy as np
+import tensorflow as tf
+
+from evaluate import evaluate
+from export import dir_size
+from np_engine import EMBEDDING, META_FILE, SCALE_SUFFIX, VOCAB_FILE, WEIGHTS_FILE, NumpyEngine
+from preprocessing.squad_preprocess import data_from_json
+from qa_answer import FLAGS, generate_answers, initialize_vocab, load_bundle, prepare_dev
+
+import logging
+
+logging.basicConfig(level=logging.INFO)
+
+tf.app.flags.DEFINE_string("quantized_dir", "", "Where to write the int8 copy of the numpy bundle in bundle_dir (default: {bundle_dir}_int8).")
+
+
+def quantize(value, axis):
+    """
+    Symmetric int8 quantization of @value with one scale per slice along @axis.
+    :return: (int8 values, float32 scales broadcastable against @value)
+    """
+    reduce_axes = tuple(a for a in range(value.ndim) if a != axis % value.ndim)
+    scale = np.abs(value).max(axis=reduce_axes, keepdims=True) / 127.
+    scale[scale == 0] = 1.
+    q = np.clip(np.round(value / scale), -127, 127).astype(np.int8)
+    return q, scale.astype(np.float32)
+
+
+def quantize_weights(weights):
+    """
+    Quantizes the embedding matrix per vocabulary row and every weight matrix per output
+    channel (last axis). Biases and vectors with one value per scale stay float32.
+    """
+    quantized = {}
+    for name, value in weights.items():
+        if name == EMBEDDING:
+            axis = 0
+        elif value.ndim >= 2 and value.size // value.shape[-1] > 1:
+            axis = -1
+        else:
+            quantized[name] = value
+            continue
+        quantized[name], quantized[name + SCALE_SUFFIX] = quantize(value, axis)
+    return quantized
+
+
+def score(bundle_dir, dataset, dev_data, rev_vocab):
+    """
+    Answers the dev set with the numpy bundle in @bundle_dir.
+    :return: (load secs, answer secs, f1, exact match)
+    """
+    engine = load_bundle(bundle_dir)
+    tic = time.time()
+    answers = generate_answers(None, engine, dataset, rev_vocab)
+    answer_time = time.time() - tic
+    result = evaluate(dev_data, answers)
+    return engine.load_time, answer_time, result["f1"], result["exact_match"]
+
+
+def main(_):
+    bundle_dir = FLAGS.bundle_dir or "bundle"
+    if not os.path.exists(pjoin(bundle_dir, WEIGHTS_FILE)):
+        raise ValueError("%s is not a numpy bundle, export it with --bundle_format=numpy" % bundle_dir)
+    quantized_dir = FLAGS.quantized_dir or bundle_dir.rstrip("/") + "_int8"
+
+    with np.load(pjoin(bundle_dir, WEIGHTS_FILE)) as data:
+        weights = dict((name, data[name]) for name in data.files)
+    quantized = quantize_weights(weights)
+    if not os.path.exists(quantized_dir):
+        os.makedirs(quantized_dir)
+    for name in (VOCAB_FILE, META_FILE):
+        shutil.copy(pjoin(bundle_dir, name), pjoin(quantized_dir, name))
+    np.savez(pjoin(quantized_dir, WEIGHTS_FILE), **quantized)
+
+    errors = [np.abs(weights[name] - quantized[name].astype(np.float32) * quantized[name + SCALE_SUFFIX]).max()
+              for name in weights if name + SCALE_SUFFIX in quantized]
+    logging.info("Quantized %d of %d weights to int8, max abs weight error %.2e",
+                 len(errors), len(weights), max(errors))
+
+    vocab, rev_vocab = initialize_vocab(pjoin(bundle_dir, VOCAB_FILE))
+    dev_dirname = os.path.dirname(os.path.abspath(FLAGS.dev_path))
+    dev_filename = os.path.basename(FLAGS.dev_path)
+    dataset = prepare_dev(dev_dirname, dev_filename, vocab)
+    dev_data = data_from_json(FLAGS.dev_path)["data"]
+
+    rows = []
+    for name, path in (("float32", bundle_dir), ("int8", quantized_dir)):
+        rows.append((name, dir_size(path) / 2. ** 20) + score(path, dataset, dev_data, rev_vocab))
+
+    print("\n%-8s %10s %10s %12s %8s %8s" % ("weights", "size MB", "load secs", "answer secs", "F1", "EM"))
+    for row in rows:
+        print("%-8s %10.1f %10.2f %12.1f %8.2f %8.2f" % row)
+    print("int8 - float32: F1 %+.2f, EM %+.2f" % (rows[1][4] - rows[0][4], rows[1][5] - rows[0][5]))
+
+
+def test_quantize():
+    rng = np.random.RandomState(0)
+    value = rng.randn(6, 4).astype(np.float32) * np.array([0.01, 1., 100., 0.], dtype=np.float32)
+    q, scale = quantize(value, -1)
+    assert q.dtype == np.int8 and scale.shape == (1, 4)
+    # every non-zero channel uses the full int8 range, the zero one keeps scale 1
+    assert (np.abs(q[:, :3]).max(axis=0) == 127).all()
+    assert (q[:, 3] == 0).all() and scale[0, 3] == 1.
+    assert (np.abs(q * scale - value) <= scale / 2 + 1e-6 * np.abs(value)).all()
+
+    q, scale = quantize(value.T, 0)
+    assert scale.shape == (4, 1)
+    assert (np.abs(q[:3]).max(axis=1) == 127).all()
+
+
+def test_quantize_weights():
+    rng = np.random.RandomState(0)
+    weights = {EMBEDDING: rng.randn(50, 8).astype(np.float32),
+               "qa/question_encoder/RNN/GRUCell/Gates/Linear/Matrix": rng.randn(12, 8).astype(np.float32),
+               "qa/question_encoder/RNN/GRUCell/Gates/Linear/Bias": rng.randn(8).astype(np.float32),
+               "qa/decoder/W_start": rng.randn(4).astype(np.float32)}
+    quantized = quantize_weights(weights)
+    assert quantized[EMBEDDING + SCALE_SUFFIX].shape == (50, 1)
+    assert quantized["qa/question_encoder/RNN/GRUCell/Gates/Linear/Matrix" + SCALE_SUFFIX].shape == (1, 8)
+    for name in ("qa/question_encoder/RNN/GRUCell/Gates/Linear/Bias", "qa/decoder/W_start"):
+        assert quantized[name] is weights[name] and name + SCALE_SUFFIX not in quantized
+
+    # the engine dequantizes the matrices once and keeps the embeddings int8
+    engine = NumpyEngine(quantized, {"model_type": "gru"})
+    name = "qa/question_encoder/RNN/GRUCell/Gates/Linear/Matrix"
+    assert engine.weights[name].dtype == np.float32
+    assert np.abs(engine.weights[name] - weights[name]).max() <= quantized[name + SCALE_SUFFIX].max() / 2 + 1e-6
+    assert engine.weights[EMBEDDING].dtype == np.int8
+    ids = np.array([[3, 7], [49, 0]])
+    error = np.abs(engine.embed(ids) - weights[EMBEDDING][ids]).max()
+    assert error <= quantized[EMBEDDING + SCALE_SUFFIX].max() / 2 + 1e-6
+
+
+if __name__ == "__main__":
+    tf.app.run()
@@ -0,0 +1,286 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import json
+import sys
+import threading
+import time
+
+import numpy as np
+from six.moves import queue, socketserver
+import tensorflow as tf
+
+import qa_data
+from context_cache import ContextCache
+from qa_answer import FLAGS, answer_spans, apply_tuned_config, build_qa_system, check_context_cache, \
+    get_normalized_train_dir, initialize_embeddings, initialize_model, initialize_vocab, load_bundle, span_to_text
+from preprocessing.squad_preprocess import invert_map, tokenize, token_idx_map
+from windowing import check_window_flags
+
+import logging
+
+logging.basicConfig(level=logging.INFO)
+
+tf.app.flags.DEFINE_integer("port", 0, "Serve JSON-lines requests on this localhost TCP port, 0 reads them from stdin.")
+tf.app.flags.DEFINE_integer("max_batch", 32, "Maximum number of requests decoded together.")
+tf.app.flags.DEFINE_float("max_wait_ms", 5.0, "How long the first request of a batch waits for more requests to arrive.")
+tf.app.flags.DEFINE_integer("report_every", 100, "Log latency percentiles every this many requests.")
+tf.app.flags.DEFINE_integer("max_q_len", 60, "Longest question (in tokens) the model is built for.")
+
+
+class Request(object):
+    """
+    A (context, question) pair waiting to be answered. @done is set once @answer
+    (or @error) has been filled in by the batcher, which then calls @callback (if any)
+    with the request.
+    """
+    def __init__(self, uid, context, question, callback=None):
+        self.uid = uid
+        self.context = context
+        self.question = question
+        self.callback = callback
+        self.arrival = time.time()
+        self.answer = None
+        self.error = None
+        self.done = threading.Event()
+
+    def finish(self):
+        self.done.set()
+        if self.callback is not None:
+            self.callback(self)
+
+    def response(self):
+        if self.error is not None:
+            return {"id": self.uid, "error": self.error}
+        return {"id": self.uid, "answer": self.answer}
+
+
+class LatencyStats(object):
+    """
+    Keeps the end-to-end latencies (arrival to answer) of the last @window requests.
+    """
+    def __init__(self, window=10000):
+        self.latencies = collections.deque(maxlen=window)
+        self.batch_sizes = collections.deque(maxlen=window)
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def add(self, latencies, batch_size):
+        with self.lock:
+            self.latencies.extend(latencies)
+            self.batch_sizes.append(batch_size)
+            self.count += len(latencies)
+
+    def report(self):
+        with self.lock:
+            latencies = np.array(self.latencies) * 1000
+            batch_sizes = np.array(self.batch_sizes)
+        if len(latencies) == 0:
+            return
+        logging.info("Served %d requests: latency p50 %.1f ms, p99 %.1f ms, mean batch size %.1f",
+                     self.count, np.percentile(latencies, 50), np.percentile(latencies, 99), batch_sizes.mean())
+
+
+class Batcher(object):
+    """
+    Dynamic micro-batching: requests are queued as they arrive, the serving thread takes
+    the first one and keeps collecting until either max_batch requests are queued or
+    max_wait_ms has passed since the first one arrived, then answers them with one
+    decode call.
+    """
+    def __init__(self, sess, model, vocab, max_batch, max_wait_ms, report_every):
+        self.sess = sess
+        self.model = model
+        self.vocab = vocab
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000.
+        self.report_every = report_every
+        self.requests = queue.Queue()
+        self.stats = LatencyStats()
+        self.cache = ContextCache(FLAGS.context_cache_size) if FLAGS.context_cache_size > 0 else None
+
+    def submit(self, request):
+        self.requests.put(request)
+        return request
+
+    def next_batch(self):
+        batch = [self.requests.get()]
+        deadline = batch[0].arrival + self.max_wait
+        while len(batch) < self.max_batch:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.requests.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def run(self):
+        while True:
+            batch = self.next_batch()
+            try:
+                self.answer(batch)
+            except Exception as e:
+                logging.exception("Failed to answer a batch of %d requests", len(batch))
+                for request in batch:
+                    request.error = str(e)
+            done = time.time()
+            for request in batch:
+                request.finish()
+
+            self.stats.add([done - request.arrival for request in batch], len(batch))
+            if self.report_every and self.stats.count // self.report_every != \
+                    (self.stats.count - len(batch)) // self.report_every:
+                self.stats.report()
+                if self.cache is not None:
+                    logging.info(str(self.cache))
+
+    def answer(self, batch):
+        # same preprocessing as qa_answer.read_dataset
+        context_ids, question_ids, texts, tokens = [], [], [], []
+        for request in batch:
+            context = request.context.replace("''", '" ').replace("``", '" ')
+            context_tokens = tokenize(context)
+            question_tokens = tokenize(request.question)
+            context_ids.append([self.vocab.get(w, qa_data.UNK_ID) for w in context_tokens])
+            question_ids.append([self.vocab.get(w, qa_data.UNK_ID) for w in question_tokens][:FLAGS.max_q_len])
+            texts.append((context, invert_map(token_idx_map(context, context_tokens))))
+            tokens.append(context_tokens)
+
+        a_s, a_e, _, _ = answer_spans(self.sess, self.model, context_ids, question_ids, progress=False,
+                                      cache=self.cache)
+        for i, request in enumerate(batch):
+            request.answer = span_to_text(texts[i], tokens[i], a_s[i], a_e[i])
+
+
+def parse_request(line, default_id, callback=None):
+    message = json.loads(line)
+    return Request(message.get("id", default_id), message["context"], message["question"], callback)
+
+
+def serve_stdin(batcher):
+    """
+    Reads one JSON request per line from stdin and writes one JSON response per line to
+    stdout as soon as each is answered (not necessarily in input order). The batcher
+    queues the responses of the answered requests for a single writer thread.
+    """
+    responses = queue.Queue()
+    # number of responses to write in total, known once stdin is exhausted
+    expected = []
+
+    def write():
+        written = 0
+        while not expected or written < expected[0]:
+            response = responses.get()
+            if response is None:
+                continue
+            sys.stdout.write(json.dumps(response) + "\n")
+            sys.stdout.flush()
+            written += 1
+
+    writer = threading.Thread(target=write)
+    writer.daemon = True
+    writer.start()
+
+    count = 0
+    for i, line in enumerate(iter(sys.stdin.readline, '')):
+        if not line.strip():
+            continue
+        count += 1
+        try:
+            batcher.submit(parse_request(line, i, lambda request: responses.put(request.response())))
+        except (ValueError, KeyError) as e:
+            responses.put({"id": i, "error": "bad request: %s" % e})
+
+    # wakes the writer up in case every response is already written
+    expected.append(count)
+    responses.put(None)
+    writer.join()
+
+
+def serve_socket(batcher, port):
+    """
+    Serves JSON-lines requests on localhost:@port, every connection can send any number
+    of requests and gets its responses back in order. Every line is submitted as soon as
+    it is read, so the requests a client pipelines on one connection are batched together;
+    a writer thread per connection writes the responses in order as they are answered.
+    """
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            # requests (or ready error responses) in arrival order, None after the last line
+            pending = queue.Queue()
+
+            def write():
+                while True:
+                    item = pending.get()
+                    if item is None:
+                        return
+                    if isinstance(item, Request):
+                        item.done.wait()
+                        item = item.response()
+                    self.wfile.write(json.dumps(item).encode("utf-8") + b"\n")
+                    self.wfile.flush()
+
+            writer = threading.Thread(target=write)
+            writer.daemon = True
+            writer.start()
+            try:
+                for i, line in enumerate(iter(self.rfile.readline, b'')):
+                    if not line.strip():
+                        continue
+                    try:
+                        pending.put(batcher.submit(parse_request(line, i)))
+                    except (ValueError, KeyError) as e:
+                        pending.put({"id": i, "error": "bad request: %s" % e})
+            finally:
+                pending.put(None)
+                writer.join()
+
+    socketserver.ThreadingTCPServer.daemon_threads = True
+    socketserver.ThreadingTCPServer.allow_reuse_address = True
+    server = socketserver.ThreadingTCPServer(("127.0.0.1", port), Handler)
+    logging.info("Serving on 127.0.0.1:%d", port)
+    server.serve_forever()
+
+
+def main(_):
+    tic = time.time()
+    config = apply_tuned_config()
+    if FLAGS.bundle_dir:
+        qa = load_bundle(FLAGS.bundle_dir, config)
+        sess = qa.session
+        vocab, rev_vocab = initialize_vocab(qa.vocab_path)
+    else:
+        vocab, rev_vocab = initialize_vocab(FLAGS.vocab_path)
+        embed_path = FLAGS.embed_path or "data/squad/glove.trimmed.{}.npz".format(FLAGS.embedding_size)
+        embeddings = initialize_embeddings(embed_path)
+
+        qa = build_qa_system(embeddings, FLAGS.max_q_len)
+
+        sess = tf.Session(config=config)
+        initialize_model(sess, qa, get_normalized_train_dir(FLAGS.train_dir))
+    check_window_flags(FLAGS.window_size, FLAGS.doc_stride)
+    check_context_cache()
+    logging.info("Model loaded in %.2f secs", time.time() - tic)
+
+    batcher = Batcher(sess, qa, vocab, FLAGS.max_batch, FLAGS.max_wait_ms, FLAGS.report_every)
+    worker = threading.Thread(target=batcher.run)
+    worker.daemon = True
+    worker.start()
+
+    try:
+        if FLAGS.port:
+            serve_socket(batcher, FLAGS.port)
+        else:
+            serve_stdin(batcher)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        batcher.stats.report()
+
+
+if __name__ == "__main__":
+    tf.app.run()
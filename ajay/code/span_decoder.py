@@ -0,0 +1,156 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+from six.moves import xrange  # pylint: disable=redefined-builtin
+
+
+def best_spans(start_logits, end_logits, max_answer_len):
+    """
+    Finds for every example the span (i, j) maximizing start[i] + end[j]
+    subject to i <= j < i + max_answer_len.
+
+    For each end position j the best start is the running max of the start logits over
+    the window [j - max_answer_len + 1, j]. The sliding window max is computed with
+    per-block prefix / suffix maxima (van Herk / Gil-Werman), which is O(n) per example
+    and vectorized over the whole batch; the Python loops only run over the
+    max_answer_len positions inside a block.
+
+    :param start_logits: array of shape (batch_size, n), padded positions should be masked
+                         with a very negative value as done in Decoder.decode
+    :param end_logits: array of shape (batch_size, n)
+    :return: (a_s, a_e, scores) arrays of shape (batch_size,)
+    """
+    start_logits = np.asarray(start_logits)
+    end_logits = np.asarray(end_logits)
+    batch_size, n = start_logits.shape
+    L = max(1, min(max_answer_len, n))
+
+    # pad L - 1 positions in front so the window of every end position starts inside
+    # the array, and pad the back so the length is a multiple of L
+    front = L - 1
+    num_blocks = -(-(front + n) // L)
+    padded = np.full((batch_size, num_blocks * L), -np.inf, dtype=start_logits.dtype)
+    padded[:, front:front + n] = start_logits
+    blocks = padded.reshape(batch_size, num_blocks, L)
+
+    # prefix max (and argmax) from the start of each block
+    prefix_val = np.empty_like(blocks)
+    prefix_idx = np.empty(blocks.shape, dtype=np.int64)
+    prefix_val[:, :, 0] = blocks[:, :, 0]
+    prefix_idx[:, :, 0] = 0
+    for t in xrange(1, L):
+        take = blocks[:, :, t] > prefix_val[:, :, t - 1]
+        prefix_val[:, :, t] = np.where(take, blocks[:, :, t], prefix_val[:, :, t - 1])
+        prefix_idx[:, :, t] = np.where(take, t, prefix_idx[:, :, t - 1])
+
+    # suffix max (and argmax) up to the end of each block, ties go to the earlier start
+    suffix_val = np.empty_like(blocks)
+    suffix_idx = np.empty(blocks.shape, dtype=np.int64)
+    suffix_val[:, :, L - 1] = blocks[:, :, L - 1]
+    suffix_idx[:, :, L - 1] = L - 1
+    for t in xrange(L - 2, -1, -1):
+        take = blocks[:, :, t] >= suffix_val[:, :, t + 1]
+        suffix_val[:, :, t] = np.where(take, blocks[:, :, t], suffix_val[:, :, t + 1])
+        suffix_idx[:, :, t] = np.where(take, t, suffix_idx[:, :, t + 1])
+
+    block_offsets = (np.arange(num_blocks) * L)[None, :, None]
+    prefix_val = prefix_val.reshape(batch_size, -1)
+    prefix_idx = (prefix_idx + block_offsets).reshape(batch_size, -1)
+    suffix_val = suffix_val.reshape(batch_size, -1)
+    suffix_idx = (suffix_idx + block_offsets).reshape(batch_size, -1)
+
+    # the window of end position j is [j - L + 1, j], i.e. [j, j + front] once padded
+    lo_val = suffix_val[:, :n]
+    hi_val = prefix_val[:, front:front + n]
+    use_lo = lo_val >= hi_val
+    start_val = np.where(use_lo, lo_val, hi_val)
+    start_idx = np.where(use_lo, suffix_idx[:, :n], prefix_idx[:, front:front + n]) - front
+
+    scores = start_val + end_logits
+    a_e = np.argmax(scores, axis=1)
+    rows = np.arange(batch_size)
+    a_s = start_idx[rows, a_e]
+
+    return a_s, a_e, scores[rows, a_e]
+
+
+def top_k_spans(start_logits, end_logits, max_answer_len, k):
+    """
+    Returns the @k best spans of every example under the same constraint as best_spans,
+    sorted by decreasing score.
+
+    All start[i] + end[i + d] for 0 <= d < max_answer_len are scored at once as a
+    (batch_size, n, max_answer_len) band, the k best are then picked with argpartition.
+
+    :return: (a_s, a_e, scores) arrays of shape (batch_size, k), fewer columns when there
+             are not @k valid spans
+    """
+    start_logits = np.asarray(start_logits)
+    end_logits = np.asarray(end_logits)
+    batch_size, n = start_logits.shape
+    L = max(1, min(max_answer_len, n))
+    # number of valid spans, the last L - 1 starts have fewer than L ends
+    k = min(k, n * L - L * (L - 1) // 2)
+
+    band = np.full((batch_size, n, L), -np.inf, dtype=start_logits.dtype)
+    for d in xrange(L):
+        band[:, :n - d, d] = start_logits[:, :n - d] + end_logits[:, d:]
+    band = band.reshape(batch_size, -1)
+
+    top = np.argpartition(-band, k - 1, axis=1)[:, :k]
+    rows = np.arange(batch_size)[:, None]
+    order = np.argsort(-band[rows, top], axis=1)
+    top = top[rows, order]
+
+    a_s = top // L
+    a_e = a_s + top % L
+    return a_s, a_e, band[rows, top]
+
+
+def brute_force_spans(start_logits, end_logits, max_answer_len):
+    """
+    Every span (score, i, j) with i <= j < i + max_answer_len of every example, best
+    first, scored with an O(n * max_answer_len) loop.
+    """
+    spans = []
+    for start, end in zip(start_logits, end_logits):
+        n = len(start)
+        spans.append(sorted([(start[i] + end[j], i, j) for i in xrange(n)
+                             for j in xrange(i, min(n, i + max_answer_len))], key=lambda s: -s[0]))
+    return spans
+
+
+def test_best_spans():
+    rng = np.random.RandomState(0)
+    for n, max_answer_len in [(1, 1), (5, 1), (7, 3), (20, 15), (20, 40), (33, 8)]:
+        start, end = rng.randn(4, n), rng.randn(4, n)
+        a_s, a_e, scores = best_spans(start, end, max_answer_len)
+        for b, spans in enumerate(brute_force_spans(start, end, max_answer_len)):
+            assert np.isclose(scores[b], spans[0][0])
+            assert (a_s[b], a_e[b]) == spans[0][1:]
+
+    # ties: any best span will do, but it has to satisfy the length constraint
+    start, end = rng.randint(3, size=(8, 25)).astype(np.float32), rng.randint(3, size=(8, 25)).astype(np.float32)
+    a_s, a_e, scores = best_spans(start, end, 4)
+    for b, spans in enumerate(brute_force_spans(start, end, 4)):
+        assert scores[b] == spans[0][0] == start[b, a_s[b]] + end[b, a_e[b]]
+        assert 0 <= a_e[b] - a_s[b] < 4
+
+    # padded positions masked like Decoder.decode are never chosen
+    start[:, 10:] = end[:, 10:] = -1e30
+    a_s, a_e, _ = best_spans(start, end, 4)
+    assert (a_e < 10).all()
+
+
+def test_top_k_spans():
+    rng = np.random.RandomState(0)
+    for n, max_answer_len, k in [(1, 1, 1), (6, 2, 3), (12, 5, 10), (9, 20, 100)]:
+        start, end = rng.randn(3, n), rng.randn(3, n)
+        a_s, a_e, scores = top_k_spans(start, end, max_answer_len, k)
+        for b, spans in enumerate(brute_force_spans(start, end, max_answer_len)):
+            expected = spans[:k]
+            assert scores.shape[1] == len(expected)
+            assert np.allclose(scores[b], [s for s, _, _ in expected])
+            assert list(zip(a_s[b], a_e[b])) == [(i, j) for _, i, j in expected]
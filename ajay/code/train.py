@@ -7,7 +7,10 @@ import json
 
 import tensorflow as tf
 
-from qa_model import Encoder, QASystem, Decoder
+from qa_model import build_model
+from distill import cache_teacher_logits, load_teacher_logits
+from util import command_line_flags, load_model_flags, load_tuned_config, tuned_model
+from windowing import check_window_flags, window_dataset
 from os.path import join as pjoin
 import numpy as np
 
@@ -35,14 +38,36 @@ tf.app.flags.DEFINE_string("load_train_dir", "", "Training directory to load mod
 tf.app.flags.DEFINE_string("log_dir", "log", "Path to store log and flag files (default: ./log)")
 tf.app.flags.DEFINE_string("optimizer", "adam", "adam / sgd")
 tf.app.flags.DEFINE_integer("print_every", 1, "How many iterations to do per print.")
-tf.app.flags.DEFINE_integer("keep", 0, "How many checkpoints to keep, 0 indicates keep all.")
+tf.app.flags.DEFINE_integer("keep", 0, "How many of the best checkpoints by val F1 to keep besides the latest one, 0 indicates keep all.")
+tf.app.flags.DEFINE_integer("checkpoint_eval_sample", 1000, "Number of fixed val examples whose F1 ranks the checkpoints kept with --keep.")
 tf.app.flags.DEFINE_string("vocab_path", "data/squad/vocab.dat", "Path to vocab file (default: ./data/squad/vocab.dat)")
-tf.app.flags.DEFINE_string("embed_path", "", "Path to the trimmed GLoVe embedding (default: ./data/squad/glove.trimmed.{embedding_size}.npz)")
+tf.app.flags.DEFINE_string("embed_path", "", "Path to the trimmed GLoVe embedding, .npz or memory-mapped .npy (default: ./data/squad/glove.trimmed.{embedding_size}.npz)")
 
 # added
-tf.app.flags.DEFINE_string("model_type", "gru", "specify either gru or lstm cell type for encoding")
+tf.app.flags.DEFINE_string("model_type", "gru", "specify either gru or lstm cell type for encoding, flow for GRU encoders joined by an attention-flow layer, or conv for convolutional/self-attention encoders and decoder around the attention-flow layer")
 tf.app.flags.DEFINE_integer("debug", 0, "whether to set debug or not")
 tf.app.flags.DEFINE_integer("grad_clip", 1, "whether to clip gradients or not")
+tf.app.flags.DEFINE_integer("window_size", 0, "Split paragraphs into overlapping windows of this many tokens instead of truncating them to output_size, 0 disables windowing.")
+tf.app.flags.DEFINE_integer("doc_stride", 128, "Distance in tokens between the starts of consecutive windows, between 1 and window_size so every token is covered.")
+tf.app.flags.DEFINE_integer("max_answer_len", 15, "Maximum number of tokens in a predicted answer span.")
+tf.app.flags.DEFINE_integer("attn_precompute", 0, "Project the question states once before the context RNN loop instead of at every step, and mask padded question slots in the attention.")
+tf.app.flags.DEFINE_integer("conv_layers", 4, "Number of depthwise-separable convolution blocks per conv encoder.")
+tf.app.flags.DEFINE_integer("conv_kernel", 7, "Width of the conv encoder convolutions.")
+tf.app.flags.DEFINE_integer("conv_self_attention", 1, "Add a self-attention block after the convolutions of the conv encoders.")
+tf.app.flags.DEFINE_string("decoder_type", "rnn", "rnn decodes start and end with two RNN passes over the paragraph, pointer scores them with feed-forward layers")
+tf.app.flags.DEFINE_string("rnn_backend", "basic", "basic (GRUCell / BasicLSTMCell), block (GRUBlockCell / LSTMBlockCell kernels) or fused (block kernels, time-major from embeddings to logits and LSTMBlockFusedCell for attention-free LSTMs). block and fused checkpoints are not interchangeable with basic ones.")
+tf.app.flags.DEFINE_integer("parallel_iterations", 32, "Number of RNN timesteps tf.nn.dynamic_rnn may run in parallel.")
+tf.app.flags.DEFINE_integer("swap_memory", 0, "Let tf.nn.dynamic_rnn swap the activations of the RNN loops to host memory.")
+tf.app.flags.DEFINE_integer("recompute_segments", 0, "Train the context encoder RNN (the MatchLSTM layer, or the flow paragraph encoder) in this many segments, keeping only the states between segments for backprop and recomputing each segment's forward pass in the backward pass. 0 keeps the activations of every step.")
+tf.app.flags.DEFINE_integer("prune_dead", 0, "Do not build the context encoder pass whose output the decoder never uses. Checkpoints of unpruned models load into pruned ones, not the other way round.")
+tf.app.flags.DEFINE_integer("share_encoder", 0, "With the flow and conv model types, encode questions and paragraphs with the same weights in one encoder call, stacked along the batch axis.")
+tf.app.flags.DEFINE_integer("feed_embeddings", 0, "Initialize the frozen embedding matrix from a fed placeholder instead of a graph constant, and leave it out of the checkpoints.")
+tf.app.flags.DEFINE_integer("num_towers", 1, "Split every batch into this many shards, each run by its own copy of the model (tower) sharing the variables; their gradients are averaged before the update. Use a batch_size of at least num_towers.")
+tf.app.flags.DEFINE_integer("accum_steps", 1, "Split every batch into this many micro-batches run one after the other and accumulate their clipped gradients into a single update: the memory of batch_size / accum_steps examples with the updates of batch_size.")
+tf.app.flags.DEFINE_string("teacher_dir", "", "Distill from the trained model in this directory (built with the flags.json there): its logits over the training examples are cached in train_dir and mixed into the loss.")
+tf.app.flags.DEFINE_float("distill_weight", 0.5, "Weight of the distillation loss against the gold-span loss.")
+tf.app.flags.DEFINE_float("distill_temperature", 2.0, "Softmax temperature applied to the teacher and student logits in the distillation loss.")
+tf.app.flags.DEFINE_string("autotune_path", "autotune.json", "Per-host settings written by autotune.py. The thread pool sizes and parallel_iterations tuned for training this model (same model_type, state_size, context length, ...) on this host are used, parallel_iterations only when not given on the command line. Empty disables them.")
 
 FLAGS = tf.app.flags.FLAGS
 
@@ -53,9 +78,14 @@ def initialize_model(session, model, train_dir):
     if ckpt and (tf.gfile.Exists(ckpt.model_checkpoint_path) or tf.gfile.Exists(v2_path)):
         logging.info("Reading model parameters from %s" % ckpt.model_checkpoint_path)
         model.saver.restore(session, ckpt.model_checkpoint_path)
+        if model.embedding_placeholder is not None:
+            # not part of the checkpoint
+            session.run(model.embeddings.initializer, model.initializer_feed())
+        if model.accumulators:
+            session.run(tf.variables_initializer(model.accumulators))
     else:
         logging.info("Created model with fresh parameters.")
-        session.run(tf.global_variables_initializer())
+        session.run(tf.global_variables_initializer(), model.initializer_feed())
         logging.info('Num params: %d' % sum(v.get_shape().num_elements() for v in tf.trainable_variables()))
     return model
 
@@ -86,13 +116,13 @@ def initialize_data(data_path,keep_as_string=False):
 
     
 def initialize_embeddings(embed_path):
-    
-    if tf.gfile.Exists(embed_path):
-        embeddings=np.load(embed_path)
-        return embeddings['glove']
-
-    else:
+    if not tf.gfile.Exists(embed_path):
         raise ValueError("Embeddings file %s not found.", embed_path)
+    if embed_path.endswith(".npy"):
+        # memory-mapped, pages are only read when the matrix is copied into the graph
+        return np.load(embed_path, mmap_mode='r')
+    embeddings = np.load(embed_path)
+    return embeddings['glove']
 
     
 def get_normalized_train_dir(train_dir):
@@ -111,10 +141,52 @@ def get_normalized_train_dir(train_dir):
     return global_train_dir
 
 
+def apply_tuned_config():
+    """
+    Takes over the parallel_iterations autotune.py found fastest for training this model on
+    this host, unless it was given on the command line.
+    :return: a ConfigProto with the tuned thread pool sizes, None (TF defaults) when untuned
+    """
+    tuned = load_tuned_config(FLAGS.autotune_path, "train", tuned_model(FLAGS))
+    if not tuned:
+        return None
+    logging.info("Using the training settings tuned for this host in %s: %s", FLAGS.autotune_path, tuned)
+    if "parallel_iterations" not in command_line_flags():
+        FLAGS.parallel_iterations = tuned["parallel_iterations"]
+    return tf.ConfigProto(intra_op_parallelism_threads=tuned["intra_op_threads"],
+                          inter_op_parallelism_threads=tuned["inter_op_threads"])
+
+
+def initialize_teacher_logits(embeddings, context_ids, question_ids, max_ctx_len, max_q_len, config=None):
+    """
+    Runs the teacher model in FLAGS.teacher_dir once over the training examples and caches
+    its logits in FLAGS.train_dir, where later runs on the same examples find them.
+    """
+    teacher_logits = load_teacher_logits(FLAGS.train_dir, context_ids)
+    if teacher_logits is not None:
+        logging.info("Using the teacher logits cached in %s", FLAGS.train_dir)
+        return teacher_logits
+
+    if not tf.train.get_checkpoint_state(FLAGS.teacher_dir):
+        raise ValueError("No teacher checkpoint in %s" % FLAGS.teacher_dir)
+    if not os.path.exists(pjoin(FLAGS.teacher_dir, "flags.json")):
+        raise ValueError("No flags.json in %s, copy the one train.py wrote to log_dir" % FLAGS.teacher_dir)
+    teacher_flags = load_model_flags(FLAGS.teacher_dir, FLAGS.__flags)
+
+    with tf.Graph().as_default():
+        teacher = build_model(teacher_flags, embeddings, max_ctx_len, max_q_len, training=False)
+        with tf.Session(config=config) as sess:
+            initialize_model(sess, teacher, get_normalized_train_dir(FLAGS.teacher_dir))
+            cache_teacher_logits(sess, teacher, context_ids, question_ids, FLAGS.train_dir, teacher_flags.batch_size)
+    return load_teacher_logits(FLAGS.train_dir, context_ids)
+
+
 def main(_):
 
     # Do what you need to load datasets from FLAGS.data_dir
     dataset = None
+    config = apply_tuned_config()
+    check_window_flags(FLAGS.window_size, FLAGS.doc_stride)
 
 
     embed_path = FLAGS.embed_path or pjoin("data", "squad", "glove.trimmed.{}.npz".format(FLAGS.embedding_size))
@@ -140,14 +212,24 @@ def main(_):
     val_answer_spans = initialize_data(val_answer_span_path)
     val_context = initialize_data(val_context_path, keep_as_string=True)
 
-    # truncate paragraphs to output_size
-    paragraph_lengths = []
-    for i in range(0, len(context_ids)):
-        context_ids[i] = context_ids[i][:FLAGS.output_size]
-        paragraph_lengths.append(len(context_ids[i]))
-    for j in range(0, len(val_context_ids)):
-        val_context_ids[j] = val_context_ids[j][:FLAGS.output_size]
-        paragraph_lengths.append(len(val_context_ids[j]))
+    examples = None
+    if FLAGS.window_size > 0:
+        # keep the full paragraphs for evaluation, train on the windows that contain the answer
+        examples = ((context_ids, question_ids, answer_spans), (val_context_ids, val_question_ids, val_answer_spans))
+        context_ids, question_ids, answer_spans, _, _ = window_dataset(context_ids, question_ids, answer_spans,
+                                                                       FLAGS.window_size, FLAGS.doc_stride)
+        val_context_ids, val_question_ids, val_answer_spans, _, _ = window_dataset(val_context_ids, val_question_ids,
+                                                                                   val_answer_spans, FLAGS.window_size,
+                                                                                   FLAGS.doc_stride)
+    else:
+        # truncate paragraphs to output_size
+        paragraph_lengths = []
+        for i in range(0, len(context_ids)):
+            context_ids[i] = context_ids[i][:FLAGS.output_size]
+            paragraph_lengths.append(len(context_ids[i]))
+        for j in range(0, len(val_context_ids)):
+            val_context_ids[j] = val_context_ids[j][:FLAGS.output_size]
+            paragraph_lengths.append(len(val_context_ids[j]))
 
     train_dataset = [context_ids,question_ids,answer_spans]
     val_dataset = [val_context_ids,val_question_ids,val_answer_spans]
@@ -163,18 +245,19 @@ def main(_):
     assert embeddings.shape[1] == FLAGS.embedding_size, "Mismatch between embedding shape and FLAGS"
     assert len(context_ids) == len(question_ids) == len(answer_spans), "Mismatch between context, questions, and answer lengths"
 
-    print("Using model type : {}".format(FLAGS.model_type))
+    if not os.path.exists(FLAGS.train_dir):
+        os.makedirs(FLAGS.train_dir)
+
+    teacher_logits = None
+    if FLAGS.teacher_dir:
+        # before QASystem.train pads the example lists in place
+        teacher_logits = initialize_teacher_logits(embeddings, context_ids, question_ids, max_ctx_len, max_q_len,
+                                                   config)
 
-    question_encoder = Encoder(size=FLAGS.state_size, name="question_encoder")
-    context_encoder = Encoder(size=FLAGS.state_size, name="context_encoder")
-    decoder = Decoder(hidden_size=FLAGS.state_size, output_size=FLAGS.output_size)
+    print("Using model type : {}".format(FLAGS.model_type))
 
-    qa = QASystem(encoder=(question_encoder, context_encoder), 
-                  decoder=decoder, 
-                  pretrained_embeddings=embeddings,
-                  max_ctx_len=max_ctx_len,
-                  max_q_len=max_q_len,
-                  flags=FLAGS)
+    qa = build_model(FLAGS, embeddings, max_ctx_len, max_q_len)
+    qa.teacher = teacher_logits
 
     if not os.path.exists(FLAGS.log_dir):
         os.makedirs(FLAGS.log_dir)
@@ -184,15 +267,17 @@ def main(_):
     print(vars(FLAGS))
     with open(os.path.join(FLAGS.log_dir, "flags.json"), 'w') as fout:
         json.dump(FLAGS.__flags, fout)
+    # next to the checkpoints, to rebuild the model from train_dir alone (see util.load_model_flags)
+    with open(os.path.join(FLAGS.train_dir, "flags.json"), 'w') as fout:
+        json.dump(FLAGS.__flags, fout)
 
-    with tf.Session() as sess:
+    with tf.Session(config=config) as sess:
         load_train_dir = get_normalized_train_dir(FLAGS.load_train_dir or FLAGS.train_dir)
         initialize_model(sess, qa, load_train_dir)
 
         save_train_dir = get_normalized_train_dir(FLAGS.train_dir)
-        saver = tf.train.Saver()
 
-        qa.train(sess, saver, dataset, contexts, save_train_dir)
+        qa.train(sess, dataset, contexts, save_train_dir, examples=examples)
 
         #qa.evaluate_answer(sess, dataset, vocab, FLAGS.evaluate, log=True)
 
@@ -8,9 +8,14 @@ Arun Chaganty <chaganty@stanford.edu>
 
 from __future__ import division
 
+import os
 import sys
 import time
+import socket
+import json
+import argparse
 import logging
+from os.path import join as pjoin
 import StringIO
 from collections import defaultdict, Counter, OrderedDict
 import numpy as np
@@ -412,6 +417,102 @@ def minibatches(data, batch_size, shuffle=True):
     batches = [np.array(col) for col in zip(*data)]
     return get_minibatches(batches, batch_size, shuffle)
 
+def pad_sequences(sequences, max_length=None, pad_id=0):
+    """
+    Pads a list of token id lists to @max_length (default: the longest one) without
+    modifying the input lists.
+    @returns (padded int32 array of shape (len(sequences), max_length), lengths)
+    """
+    lengths = [len(seq) for seq in sequences]
+    if max_length is None:
+        max_length = max(lengths) if lengths else 0
+    padded = np.full((len(sequences), max_length), pad_id, dtype=np.int32)
+    for i, seq in enumerate(sequences):
+        padded[i, :len(seq)] = seq[:max_length]
+    return padded, np.minimum(lengths, max_length).astype(np.int32)
+
+def load_model_flags(train_dir, defaults):
+    """
+    Reads the flags the model in @train_dir was trained with, from the flags.json train.py
+    writes there. Flags missing from the file (added after the model was trained) keep
+    their value in @defaults.
+    @returns an argparse.Namespace usable as the flags of build_model
+    """
+    values = dict(defaults)
+    with open(pjoin(train_dir, "flags.json")) as f:
+        values.update(json.load(f))
+    return argparse.Namespace(**values)
+
+# flags of the model autotune.py tuned, the settings are only used for the same model
+TUNED_MODEL_FLAGS = ["model_type", "decoder_type", "rnn_backend", "state_size", "embedding_size", "share_encoder",
+                     "attn_precompute"]
+
+
+def tuned_model(flags):
+    """
+    The architecture of the model built with @flags, as recorded by autotune.py: the
+    TUNED_MODEL_FLAGS and the context length the model runs on.
+    """
+    model = dict((name, getattr(flags, name)) for name in TUNED_MODEL_FLAGS)
+    model["output_size"] = flags.window_size or flags.output_size
+    return model
+
+
+def command_line_flags(argv=None):
+    """
+    Names of the flags given on the command line @argv (default: sys.argv), as
+    --name=value or --name value.
+    """
+    argv = sys.argv[1:] if argv is None else argv
+    return set(arg[2:].split("=", 1)[0] for arg in argv if arg.startswith("--"))
+
+
+def load_tuned_config(path, mode, model):
+    """
+    Reads the @mode ("train" or "decode") settings autotune.py tuned for this host from the
+    per-host file @path. Settings tuned for another architecture than @model (see
+    tuned_model) are ignored with a warning.
+    @returns a dict with intra_op_threads, inter_op_threads, parallel_iterations (and
+             batch_size for decode), empty when @path is empty or this host was not tuned
+             for @model
+    """
+    if not path or not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        entry = json.load(f).get(socket.gethostname(), {})
+    if mode not in entry:
+        return {}
+    recorded = entry.get("model", {})
+    mismatched = ["%s %s, not %s" % (name, recorded.get(name), model[name])
+                  for name in sorted(model) if recorded.get(name) != model[name]]
+    if mismatched:
+        logger.warning("Ignoring the %s settings in %s, they were tuned for another model: %s",
+                       mode, path, "; ".join(mismatched))
+        return {}
+    return entry[mode]
+
+
+def test_load_tuned_config():
+    import tempfile
+    model = {"model_type": "gru", "state_size": 100, "output_size": 300}
+    tuned = {"train": {"parallel_iterations": 8}, "decode": {"parallel_iterations": 16, "batch_size": 64},
+             "model": model}
+    with tempfile.NamedTemporaryFile("w", suffix=".json", delete=False) as f:
+        json.dump({socket.gethostname(): tuned}, f)
+    try:
+        assert load_tuned_config(f.name, "decode", model) == tuned["decode"]
+        assert load_tuned_config(f.name, "train", dict(model, state_size=200)) == {}
+        assert load_tuned_config(f.name, "train", dict(model, window_size=0)) == {}
+        assert load_tuned_config("", "train", model) == {}
+    finally:
+        os.remove(f.name)
+
+
+def test_command_line_flags():
+    assert command_line_flags(["--batch_size=32", "--model_type", "flow", "-v", "data"]) == {"batch_size",
+                                                                                              "model_type"}
+
+
 def print_sentence(output, sentence, labels, predictions):
 
     spacings = [max(len(sentence[i]), len(labels[i]), len(predictions[i])) for i in range(len(sentence))]
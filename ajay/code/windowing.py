@@ -0,0 +1,184 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import logging
+
+import numpy as np
+
+from span_decoder import best_spans
+
+
+def check_window_flags(window_size, doc_stride):
+    """
+    Raises a ValueError unless windows of @window_size tokens started @doc_stride tokens
+    apart cover every token: a stride longer than the window skips the tokens in between.
+    """
+    if window_size > 0 and not 0 < doc_stride <= window_size:
+        raise ValueError("doc_stride must be in [1, window_size=%d] so the windows cover every token, got %d" % (
+            window_size, doc_stride))
+
+
+def split_windows(length, window_size, doc_stride):
+    """
+    Returns the token offsets of the windows covering a paragraph of @length tokens.
+
+    Consecutive windows start @doc_stride tokens apart, so neighbouring windows overlap
+    by (window_size - doc_stride) tokens. The last window is aligned with the end of the
+    paragraph so, with 0 < doc_stride <= window_size, every token is covered by at least
+    one window.
+    """
+    check_window_flags(window_size, doc_stride)
+    if length <= window_size:
+        return [0]
+    offsets = list(range(0, length - window_size, doc_stride))
+    offsets.append(length - window_size)
+    return offsets
+
+
+def window_dataset(context_ids, question_ids, answer_spans, window_size, doc_stride, answerable_only=True):
+    """
+    Splits every (context, question, span) example into overlapping windows of at most
+    @window_size context tokens.
+
+    :param answer_spans: list of [start, end] token spans in paragraph coordinates, or None
+                         when the spans are unknown (e.g. at test time)
+    :param answerable_only: drop the windows that do not contain the whole answer span.
+                            Used for training; at evaluation time every window is kept and
+                            windows without the answer get the dummy span [0, 0].
+    :return: (window contexts, window questions, window spans, example index, window offset)
+             where example index / window offset map each window back to its paragraph.
+    """
+    win_context, win_question, win_spans = [], [], []
+    example_index, offsets = [], []
+    dropped = 0
+
+    for i, ctx in enumerate(context_ids):
+        kept = 0
+        for offset in split_windows(len(ctx), window_size, doc_stride):
+            span = [0, 0]
+            if answer_spans is not None:
+                a_s, a_e = answer_spans[i][0], answer_spans[i][1]
+                if offset <= a_s and a_e < offset + window_size:
+                    span = [a_s - offset, a_e - offset]
+                elif answerable_only:
+                    continue
+            win_context.append(ctx[offset:offset + window_size])
+            win_question.append(list(question_ids[i]))
+            win_spans.append(span)
+            example_index.append(i)
+            offsets.append(offset)
+            kept += 1
+        if kept == 0:
+            dropped += 1
+
+    if dropped:
+        logging.info("Dropped %d examples whose answer does not fit in a %d token window", dropped, window_size)
+    logging.info("Split %d paragraphs into %d windows", len(context_ids), len(win_context))
+
+    return win_context, win_question, win_spans, example_index, offsets
+
+
+def log_normalizer(logits):
+    # log of the softmax denominator of a 1-d array of logits
+    top = np.max(logits)
+    return top + np.log(np.sum(np.exp(logits - top)))
+
+
+def merge_window_spans(start_logits, end_logits, example_index, offsets, num_examples, max_answer_len,
+                       with_confidence=False):
+    """
+    Merges the per-window span scores into one span per paragraph.
+
+    Every window proposes its best (start, end) pair under the max_answer_len constraint
+    (see span_decoder.best_spans); the paragraph keeps the proposal with the highest
+    start + end logit, shifted back to paragraph coordinates.
+
+    :param start_logits: list of 1-d arrays of start logits, one per window (unpadded)
+    :param end_logits: list of 1-d arrays of end logits, one per window (unpadded)
+    :param with_confidence: also return the joint probability softmax(start)[a_s] *
+                            softmax(end)[a_e] of every chosen span, normalized over the
+                            window it was found in
+    :return: (a_s, a_e) arrays of length @num_examples, and the confidences with
+             @with_confidence
+    """
+    a_s = np.zeros(num_examples, dtype=np.int32)
+    a_e = np.zeros(num_examples, dtype=np.int32)
+    best = np.full(num_examples, -np.inf)
+    chosen = np.full(num_examples, -1)
+    if not start_logits:
+        return (a_s, a_e, np.zeros(num_examples)) if with_confidence else (a_s, a_e)
+
+    # decode all windows in one batch
+    width = max(len(start) for start in start_logits)
+    start_batch = np.full((len(start_logits), width), -np.inf, dtype=np.float32)
+    end_batch = np.full((len(end_logits), width), -np.inf, dtype=np.float32)
+    for w, (start, end) in enumerate(zip(start_logits, end_logits)):
+        start_batch[w, :len(start)] = start
+        end_batch[w, :len(end)] = end
+    win_s, win_e, scores = best_spans(start_batch, end_batch, max_answer_len)
+
+    for w in range(len(start_logits)):
+        i = example_index[w]
+        if scores[w] > best[i]:
+            best[i] = scores[w]
+            a_s[i] = offsets[w] + win_s[w]
+            a_e[i] = offsets[w] + win_e[w]
+            chosen[i] = w
+
+    if with_confidence:
+        confidence = np.zeros(num_examples)
+        for i, w in enumerate(chosen):
+            if w >= 0:
+                confidence[i] = np.exp(scores[w] - log_normalizer(start_logits[w]) - log_normalizer(end_logits[w]))
+        return a_s, a_e, confidence
+
+    return a_s, a_e
+
+
+def test_split_windows():
+    for length in range(1, 40):
+        for window_size in range(1, 12):
+            for doc_stride in range(1, window_size + 1):
+                offsets = split_windows(length, window_size, doc_stride)
+                covered = np.zeros(length, dtype=bool)
+                for offset in offsets:
+                    assert 0 <= offset and (offset + window_size <= length or offset == 0)
+                    covered[offset:offset + window_size] = True
+                assert covered.all()
+                assert offsets == sorted(set(offsets))
+
+    for window_size, doc_stride in [(10, 0), (10, -1), (10, 11)]:
+        try:
+            split_windows(30, window_size, doc_stride)
+            assert False, "doc_stride %d accepted" % doc_stride
+        except ValueError:
+            pass
+
+
+def test_merge_window_spans():
+    rng = np.random.RandomState(0)
+    max_answer_len, window_size, doc_stride = 4, 8, 5
+    lengths = [3, 8, 9, 23]
+    start_logits, end_logits, example_index, offsets = [], [], [], []
+    paragraphs = []
+    for i, length in enumerate(lengths):
+        start, end = rng.randn(length), rng.randn(length)
+        paragraphs.append((start, end))
+        for offset in split_windows(length, window_size, doc_stride):
+            start_logits.append(start[offset:offset + window_size])
+            end_logits.append(end[offset:offset + window_size])
+            example_index.append(i)
+            offsets.append(offset)
+
+    a_s, a_e, confidence = merge_window_spans(start_logits, end_logits, example_index, offsets, len(lengths),
+                                              max_answer_len, with_confidence=True)
+    for i, (start, end) in enumerate(paragraphs):
+        # best span of the paragraph that fits in one of its windows
+        windows = split_windows(len(start), window_size, doc_stride)
+        spans = [(start[s] + end[e], s, e) for s in range(len(start))
+                 for e in range(s, min(len(start), s + max_answer_len))
+                 if any(o <= s and e < o + window_size for o in windows)]
+        _, s, e = max(spans)
+        assert (a_s[i], a_e[i]) == (s, e)
+        assert 0 < confidence[i] <= 1